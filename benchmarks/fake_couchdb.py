@@ -0,0 +1,325 @@
+"""
+An in-process CouchDB stand-in serving the endpoints the exporter uses.
+
+Only the subset of the CouchDB API touched by ``CouchDBHelper``, the backup
+code and ``interface.py`` is implemented: project lookup, single documents
+and their attachments, ``_all_docs`` (with ``keys``, key ranges, paging and
+``include_docs``), ``_find`` with bookmarks, ``_bulk_docs`` and ``_changes``.
+Every request can be delayed by ``latency`` seconds to mimic a remote server.
+"""
+
+import base64
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from uuid import uuid4
+
+
+def _matches(doc, selector):
+    """
+    Evaluate the small subset of Mango selectors the exporter sends.
+    """
+    for key, condition in selector.items():
+        if key == "$not":
+            if _matches(doc, condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(_matches(doc, option) for option in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if operator == "$exists" and (key in doc) != operand:
+                    return False
+                if operator == "$eq" and value != operand:
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator == "$in" and value not in operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _couch_layout(result):
+    """
+    Render an ``_all_docs`` result the way CouchDB does, one row per line.
+    """
+    header = {key: value for key, value in result.items() if key != "rows"}
+    lines = [json.dumps(header)[:-1] + ',"rows":[']
+    lines.append(",\r\n".join(json.dumps(row) for row in result["rows"]))
+    lines.append("]}")
+    return "\r\n".join(lines).encode("utf-8")
+
+
+class FakeCouchDB:
+    """
+    Serve ``databases`` (``{db name: {doc id: doc}}``) over HTTP.
+
+    Use as a context manager; ``url`` is the base url to hand to
+    ``CouchDBHelper``. ``requests`` counts requests per endpoint.
+    """
+
+    def __init__(self, databases, latency=0.0, host="127.0.0.1", port=0):
+        self.databases = databases
+        self.latency = latency
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.changes = []
+        for db_name, docs in databases.items():
+            for doc in docs.values():
+                self._stamp(db_name, doc)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _stamp(self, db_name, doc):
+        generation = int(doc.get("_rev", "0-").split("-")[0]) + 1
+        doc["_rev"] = f"{generation}-{uuid4().hex}"
+        self.sequence += 1
+        self.changes.append((self.sequence, db_name, doc["_id"], doc["_rev"]))
+
+    def _public(self, doc, attachments=False):
+        """
+        Return ``doc`` as CouchDB would, with attachment stubs by default.
+        """
+        if "_attachments" not in doc:
+            return doc
+        public = dict(doc)
+        public["_attachments"] = {}
+        for name, attachment in doc["_attachments"].items():
+            if attachments:
+                public["_attachments"][name] = attachment
+            else:
+                stub = {
+                    key: value for key, value in attachment.items() if key != "data"
+                }
+                stub["stub"] = True
+                public["_attachments"][name] = stub
+        return public
+
+    def _handler(self):
+        couch = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # As CouchDB does; otherwise keep-alive requests stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def _send(
+                self, status, payload, content_type="application/json", headers=()
+            ):
+                if content_type == "application/json":
+                    payload = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _route(self, method):
+                if couch.latency:
+                    time.sleep(couch.latency)
+                parts = urlsplit(self.path)
+                query = {
+                    key: values[-1] for key, values in parse_qs(parts.query).items()
+                }
+                segments = [unquote(x) for x in parts.path.strip("/").split("/")]
+                db_name = segments[0]
+                endpoint = segments[1] if len(segments) > 1 else ""
+                with couch.lock:
+                    couch.requests[f"{method} {endpoint or db_name}"] += 1
+                docs = couch.databases.get(db_name)
+                if docs is None:
+                    return self._send(404, {"error": "not_found"})
+
+                with couch.lock:
+                    if endpoint == "_all_docs":
+                        body = self._body() if method == "POST" else {}
+                        return self._send(
+                            200,
+                            _couch_layout(self._all_docs(docs, query, body)),
+                            "application/json; charset=utf-8",
+                        )
+                    if endpoint == "_find":
+                        return self._send(200, self._find(docs, self._body()))
+                    if endpoint == "_bulk_docs":
+                        return self._send(
+                            201, self._bulk_docs(db_name, docs, self._body())
+                        )
+                    if endpoint == "_changes":
+                        return self._send(200, self._changes(db_name, query))
+                    doc = docs.get(endpoint)
+                    if method == "PUT":
+                        return self._put(db_name, docs, endpoint, self._body())
+                    if doc is None:
+                        return self._send(404, {"error": "not_found"})
+                    if len(segments) > 2:
+                        attachment = doc.get("_attachments", {}).get(segments[2])
+                        if attachment is None:
+                            return self._send(404, {"error": "not_found"})
+                        return self._send(
+                            200,
+                            base64.b64decode(attachment["data"]),
+                            attachment["content_type"],
+                        )
+                    # Documents are revalidated by revision, as in CouchDB
+                    etag = f'"{doc["_rev"]}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        return self._send(
+                            304, b"", "text/plain", headers=[("ETag", etag)]
+                        )
+                    return self._send(200, couch._public(doc), headers=[("ETag", etag)])
+
+            def _all_docs(self, docs, query, body):
+                include_docs = (
+                    body.get("include_docs") or query.get("include_docs") == "true"
+                )
+                attachments = (
+                    body.get("attachments") or query.get("attachments") == "true"
+                )
+                if "keys" in body:
+                    rows = []
+                    for key in body["keys"]:
+                        doc = docs.get(key)
+                        if doc is None:
+                            rows.append({"key": key, "error": "not_found"})
+                            continue
+                        row = {"id": key, "key": key, "value": {"rev": doc["_rev"]}}
+                        if include_docs:
+                            row["doc"] = couch._public(doc, attachments)
+                        rows.append(row)
+                    return {"total_rows": len(docs), "rows": rows}
+                keys = sorted(docs)
+                startkey = body.get("startkey", query.get("startkey"))
+                if isinstance(startkey, str) and "startkey" in query:
+                    startkey = json.loads(startkey)
+                if startkey is not None:
+                    keys = [key for key in keys if key >= startkey]
+                offset = len(docs) - len(keys)
+                endkey = body.get("endkey", query.get("endkey"))
+                if isinstance(endkey, str) and "endkey" in query:
+                    endkey = json.loads(endkey)
+                if endkey is not None:
+                    keys = [key for key in keys if key <= endkey]
+                skip = int(body.get("skip", query.get("skip", 0)))
+                keys = keys[skip:]
+                limit = body.get("limit", query.get("limit"))
+                if limit is not None:
+                    keys = keys[: int(limit)]
+                rows = []
+                for key in keys:
+                    row = {"id": key, "key": key, "value": {"rev": docs[key]["_rev"]}}
+                    if include_docs:
+                        row["doc"] = couch._public(docs[key], attachments)
+                    rows.append(row)
+                return {"total_rows": len(docs), "offset": offset, "rows": rows}
+
+            def _find(self, docs, body):
+                limit = int(body.get("limit", 25))
+                start = int(body.get("bookmark") or 0)
+                matched = [
+                    doc
+                    for key, doc in sorted(docs.items())
+                    if _matches(doc, body.get("selector", {}))
+                ]
+                page = matched[start : start + limit]
+                if body.get("fields"):
+                    page = [
+                        {field: doc[field] for field in body["fields"] if field in doc}
+                        for doc in page
+                    ]
+                else:
+                    page = [couch._public(doc) for doc in page]
+                return {"docs": page, "bookmark": str(start + len(page))}
+
+            def _bulk_docs(self, db_name, docs, body):
+                results = []
+                for doc in body.get("docs", []):
+                    doc_id = doc.setdefault("_id", uuid4().hex)
+                    existing = docs.get(doc_id)
+                    if existing is not None and existing["_rev"] != doc.get("_rev"):
+                        results.append(
+                            {
+                                "id": doc_id,
+                                "error": "conflict",
+                                "reason": "Document update conflict.",
+                            }
+                        )
+                        continue
+                    doc = dict(doc)
+                    if existing is not None:
+                        doc["_rev"] = existing["_rev"]
+                    couch._stamp(db_name, doc)
+                    docs[doc_id] = doc
+                    results.append({"ok": True, "id": doc_id, "rev": doc["_rev"]})
+                return results
+
+            def _put(self, db_name, docs, doc_id, doc):
+                existing = docs.get(doc_id)
+                if existing is not None and existing["_rev"] != doc.get("_rev"):
+                    return self._send(
+                        409,
+                        {"error": "conflict", "reason": "Document update conflict."},
+                    )
+                doc = dict(doc, _id=doc_id)
+                if existing is not None:
+                    doc["_rev"] = existing["_rev"]
+                couch._stamp(db_name, doc)
+                docs[doc_id] = doc
+                return self._send(201, {"ok": True, "id": doc_id, "rev": doc["_rev"]})
+
+            def _changes(self, db_name, query):
+                since = int(query.get("since", 0) or 0)
+                latest = {}
+                for sequence, change_db, doc_id, rev in couch.changes:
+                    if change_db == db_name and sequence > since:
+                        latest[doc_id] = (sequence, rev)
+                results = [
+                    {"seq": str(sequence), "id": doc_id, "changes": [{"rev": rev}]}
+                    for doc_id, (sequence, rev) in sorted(
+                        latest.items(), key=lambda item: item[1][0]
+                    )
+                ]
+                return {"results": results, "last_seq": str(couch.sequence)}
+
+            def do_GET(self):
+                self._route("GET")
+
+            def do_POST(self):
+                self._route("POST")
+
+            def do_PUT(self):
+                self._route("PUT")
+
+        return Handler
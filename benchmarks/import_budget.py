@@ -0,0 +1,107 @@
+"""
+Check the exporter's modules import quickly and without their heavy
+dependencies.
+
+Each module is imported in a fresh interpreter, best of ``--repeat``. The
+check fails if an import takes longer than ``--budget`` seconds, or loads
+any of HEAVY (those are imported by the code paths that need them). A module
+that can't be imported at all fails the check too, unless
+``--allow-missing`` is given for environments without every dependency
+installed, in which case it is reported and skipped. For example::
+
+    python benchmarks/import_budget.py --budget 0.5
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+MODULES = (
+    "interface",
+    "export_job",
+    "export_jobs",
+    "export_workspace",
+    "export_scheduler",
+    "export_csv",
+    "faims3couchdb",
+)
+# Slow to import, and only needed by some exports
+HEAVY = (
+    "pandas",
+    "numpy",
+    "geopandas",
+    "fiona",
+    "shapely",
+    "xlsxwriter",
+    "simplekml",
+    "github",
+    "notebook",
+)
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted(sys.modules)}}))
+"""
+
+
+def time_import(module):
+    """
+    Import ``module`` in a fresh interpreter. Returns the seconds taken and
+    the modules loaded, or raises ImportError with the child's error.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("modules", nargs="*", default=list(MODULES))
+    parser.add_argument("--budget", type=float, default=0.5, help="Seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--allow-missing",
+        action="store_true",
+        help="Skip modules that can't be imported instead of failing",
+    )
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in args.modules:
+        try:
+            runs = [time_import(module) for _ in range(args.repeat)]
+        except ImportError as e:
+            if args.allow_missing:
+                print(f"{module:<18} skipped: {e}")
+            else:
+                failed = True
+                print(f"{module:<18} failed to import: {e}")
+            continue
+        seconds = min(run["seconds"] for run in runs)
+        heavy = sorted(
+            name for name in HEAVY if any(name in run["modules"] for run in runs)
+        )
+        problems = []
+        if seconds > args.budget:
+            problems.append(f"over the {args.budget}s budget")
+        if heavy:
+            problems.append(f"imports {', '.join(heavy)}")
+        failed = failed or bool(problems)
+        print(f"{module:<18} {seconds:6.3f}s {'; '.join(problems) or 'ok'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Time the exporter against a synthetic notebook served by a local fake CouchDB.
+
+Each scenario starts a ``FakeCouchDB`` with the requested latency, then times
+``CouchDBHelper`` initialisation, ``fetch_records_for_roundtrip``,
+``flatten_records`` and ``export_csv`` (both the DataFrame and the streaming
+export), along with the number of requests each made. For example::
+
+    python benchmarks/run.py --records 2000 --latency 0 0.02 --json results.json
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import export_csv  # noqa: E402
+from faims3couchdb import CouchDBHelper  # noqa: E402
+
+from fake_couchdb import FakeCouchDB  # noqa: E402
+from synthetic import make_notebook  # noqa: E402
+
+PROJECT_KEY = "synthetic"
+STAGES = ("init", "fetch", "flatten", "export", "export_streaming")
+
+
+def _helper(couch):
+    return CouchDBHelper(
+        user=None,
+        token=None,
+        base_url=couch.url,
+        project_key=PROJECT_KEY,
+        bearer_token="benchmark",
+    )
+
+
+def _export(couch, output_dir, **kwargs):
+    export_csv.OUTPUT_DIR = Path(output_dir)
+    export_csv.export_csv(
+        user=None,
+        token=None,
+        base_url=couch.url,
+        project_key=PROJECT_KEY,
+        inline_attachments=False,
+        external_attachments=True,
+        bearer_token="benchmark",
+        **kwargs,
+    )
+
+
+def run_stage(couch, stage):
+    """
+    Run ``stage`` once against ``couch``.
+    """
+    if stage == "init":
+        _helper(couch)
+    elif stage == "fetch":
+        _helper(couch).fetch_records_for_roundtrip(disable_progress_bars=True)
+    elif stage == "flatten":
+        _helper(couch).flatten_records()
+    else:
+        with tempfile.TemporaryDirectory() as output_dir:
+            _export(couch, output_dir, streaming=stage == "export_streaming")
+
+
+def run_scenario(notebook, latency, stages=STAGES, repeat=1):
+    """
+    Time each of ``stages`` against ``notebook`` served with ``latency``.
+
+    Returns ``{stage: {"seconds": best of repeat, "requests": {endpoint: n}}}``.
+    """
+    results = {}
+    with FakeCouchDB(notebook, latency=latency) as couch:
+        for stage in stages:
+            timings = []
+            for _ in range(repeat):
+                couch.requests.clear()
+                start = time.perf_counter()
+                run_stage(couch, stage)
+                timings.append(time.perf_counter() - start)
+            results[stage] = {"seconds": min(timings), "requests": dict(couch.requests)}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--records", type=int, default=500)
+    parser.add_argument("--forms", type=int, default=2)
+    parser.add_argument("--fields-per-form", type=int, default=8)
+    parser.add_argument("--geometry-fields", type=int, default=1)
+    parser.add_argument("--conflict-rate", type=float, default=0.05)
+    parser.add_argument("--attachment-rate", type=float, default=0.2)
+    parser.add_argument("--attachment-size", type=int, default=32 * 1024)
+    parser.add_argument("--relationship-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        nargs="+",
+        default=[0.0],
+        help="Seconds added to every request; one scenario per value",
+    )
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="Also write the results here")
+    args = parser.parse_args(argv)
+
+    results = []
+    for latency in args.latency:
+        # Each scenario gets a fresh notebook, as the fake server mutates it
+        notebook = make_notebook(
+            project_key=PROJECT_KEY,
+            records=args.records,
+            forms=args.forms,
+            fields_per_form=args.fields_per_form,
+            geometry_fields=args.geometry_fields,
+            conflict_rate=args.conflict_rate,
+            attachment_rate=args.attachment_rate,
+            attachment_size=args.attachment_size,
+            relationship_rate=args.relationship_rate,
+            seed=args.seed,
+        )
+        stages = run_scenario(notebook, latency, args.stages, args.repeat)
+        results.append({"latency": latency, "stages": stages})
+        for stage, result in stages.items():
+            print(
+                f"latency={latency:<6} {stage:<17} {result['seconds']:8.2f}s"
+                f" {sum(result['requests'].values()):6d} requests"
+            )
+
+    if args.json:
+        settings = {key: value for key, value in vars(args).items() if key != "json"}
+        with open(args.json, "w") as results_file:
+            json.dump(
+                {"settings": settings, "results": results}, results_file, indent=2
+            )
+
+
+if __name__ == "__main__":
+    main()
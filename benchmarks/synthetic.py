@@ -0,0 +1,270 @@
+"""
+Generate synthetic FAIMS3 notebooks for benchmarking.
+
+A synthetic notebook is a plain dict of CouchDB databases (``projects``,
+``metadata-<key>`` and ``data-<key>``), each mapping document ids to
+documents shaped like the ones a FAIMS3 server stores, so it can be served by
+``fake_couchdb.FakeCouchDB``.
+"""
+
+import base64
+import datetime
+import random
+from uuid import UUID
+
+
+def _uuid(rng):
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def make_ui_specification(forms=2, fields_per_form=8, geometry_fields=1):
+    """
+    Build a ui-specification with ``forms`` viewsets, each with one view.
+
+    Every form has an hrid field, ``geometry_fields`` take-point fields, one
+    photo field and text fields up to ``fields_per_form``.
+    """
+    fields = {}
+    fviews = {}
+    viewsets = {}
+    for form_number in range(forms):
+        form = f"Form{form_number}"
+        view = f"{form}-view"
+        view_fields = []
+
+        hrid = f"hrid{form}"
+        fields[hrid] = {
+            "component-name": "TemplatedStringField",
+            "type-returned": "faims-core::String",
+            "component-parameters": {
+                "id": hrid,
+                "label": f"{form} ID",
+                "hrid": True,
+            },
+            "meta": {"annotation": False, "uncertainty": {"include": False}},
+        }
+        view_fields.append(hrid)
+
+        for geometry_number in range(geometry_fields):
+            name = f"{form}-point{geometry_number}"
+            fields[name] = {
+                "component-name": "TakePoint",
+                "type-returned": "faims-pos::Location",
+                "component-parameters": {"label": f"Point {geometry_number}"},
+                "meta": {
+                    "annotation": True,
+                    "annotation_label": "annotation",
+                    "uncertainty": {"include": False},
+                },
+            }
+            view_fields.append(name)
+
+        photo = f"{form}-photo"
+        fields[photo] = {
+            "component-name": "TakePhoto",
+            "type-returned": "faims-attachment::Files",
+            "component-parameters": {"label": "Photo"},
+            "meta": {"annotation": False, "uncertainty": {"include": False}},
+        }
+        view_fields.append(photo)
+
+        for field_number in range(max(fields_per_form - len(view_fields), 0)):
+            name = f"{form}-text{field_number}"
+            fields[name] = {
+                "component-name": "TextField",
+                "type-returned": "faims-core::String",
+                "component-parameters": {
+                    "InputLabelProps": {"label": f"Text {field_number}"}
+                },
+                "meta": {
+                    "annotation": field_number % 2 == 0,
+                    "annotation_label": "notes",
+                    "uncertainty": {"include": field_number % 3 == 0, "label": "sure"},
+                },
+            }
+            view_fields.append(name)
+
+        fviews[view] = {"fields": view_fields, "label": view}
+        viewsets[form] = {"views": [view], "label": f"Synthetic {form}"}
+
+    return {
+        "_id": "ui-specification",
+        "fields": fields,
+        "fviews": fviews,
+        "viewsets": viewsets,
+    }
+
+
+def make_notebook(
+    project_key="synthetic",
+    records=100,
+    forms=2,
+    fields_per_form=8,
+    geometry_fields=1,
+    conflict_rate=0.05,
+    attachment_rate=0.2,
+    attachment_size=32 * 1024,
+    relationship_rate=0.1,
+    seed=0,
+):
+    """
+    Build a synthetic notebook as ``{database name: {doc id: doc}}``.
+
+    ``conflict_rate`` is the fraction of records given a second head revision,
+    ``attachment_rate`` the fraction given a photo of ``attachment_size``
+    bytes and ``relationship_rate`` the fraction linked to an earlier record
+    as their parent.
+    """
+    rng = random.Random(seed)
+    ui_spec = make_ui_specification(forms, fields_per_form, geometry_fields)
+    metadata_db = f"metadata-{project_key}"
+    data_db = f"data-{project_key}"
+    databases = {
+        "projects": {
+            project_key: {
+                "_id": project_key,
+                "name": f"Synthetic notebook {project_key}",
+                "metadata_db": {"db_name": metadata_db},
+                "data_db": {"db_name": data_db},
+            }
+        },
+        metadata_db: {
+            "ui-specification": ui_spec,
+            "project-metadata-description": {
+                "_id": "project-metadata-description",
+                "is_attachment": False,
+                "metadata": "A synthetic notebook",
+            },
+        },
+        data_db: {},
+    }
+    data = databases[data_db]
+    form_fields = {
+        form: [
+            field
+            for view in viewset["views"]
+            for field in ui_spec["fviews"][view]["fields"]
+        ]
+        for form, viewset in ui_spec["viewsets"].items()
+    }
+    start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    record_ids = []
+
+    def new_revision(record_id, form, number, created, parents, relationship):
+        revision_id = f"frev-{_uuid(rng)}"
+        avps = {}
+        for field in form_fields[form]:
+            avp_id = f"avp-{_uuid(rng)}"
+            field_type = ui_spec["fields"][field]["type-returned"]
+            avp = {
+                "_id": avp_id,
+                "avp_format_version": 1,
+                "type": field_type,
+                "record_id": record_id,
+                "revision_id": revision_id,
+                "annotations": {"annotation": "", "uncertainty": False},
+            }
+            if field.startswith("hrid"):
+                avp["data"] = f"{form}-{number:06d}"
+            elif field_type == "faims-pos::Location":
+                avp["data"] = {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [
+                            round(rng.uniform(150, 152), 6),
+                            round(rng.uniform(-34, -33), 6),
+                        ],
+                    },
+                    "properties": {
+                        "timestamp": int(created.timestamp() * 1000),
+                        "altitude": None,
+                        "speed": None,
+                        "heading": None,
+                        "accuracy": rng.randint(3, 30),
+                    },
+                }
+            elif field_type == "faims-attachment::Files":
+                avp["data"] = None
+                if rng.random() < attachment_rate:
+                    attachment_id = f"att-{_uuid(rng)}"
+                    avp["faims_attachments"] = [
+                        {
+                            "attachment_id": attachment_id,
+                            "filename": f"photo-{number}.jpg",
+                            "file_type": "image/jpeg",
+                        }
+                    ]
+                    payload = rng.randbytes(attachment_size)
+                    data[attachment_id] = {
+                        "_id": attachment_id,
+                        "avp_id": avp_id,
+                        "_attachments": {
+                            attachment_id: {
+                                "content_type": "image/jpeg",
+                                "data": base64.b64encode(payload).decode("ascii"),
+                                "length": attachment_size,
+                            }
+                        },
+                    }
+            else:
+                avp["data"] = f"value {rng.random():.6f}"
+            data[avp_id] = avp
+            avps[field] = avp_id
+        revision = {
+            "_id": revision_id,
+            "revision_format_version": 1,
+            "avps": avps,
+            "record_id": record_id,
+            "parents": parents,
+            "created": created.isoformat(),
+            "created_by": f"user{rng.randint(0, 4)}",
+            "type": form,
+            "deleted": False,
+        }
+        if relationship:
+            revision["relationship"] = relationship
+        data[revision_id] = revision
+        return revision_id
+
+    for number in range(records):
+        form = f"Form{number % forms}"
+        record_id = f"rec-{_uuid(rng)}"
+        created = start + datetime.timedelta(minutes=number)
+        relationship = None
+        if record_ids and rng.random() < relationship_rate:
+            relationship = {
+                "parent": {
+                    "record_id": rng.choice(record_ids),
+                    "field_id": f"{form}-text0",
+                    "relation_type_vocabPair": ["is child of", "is parent of"],
+                }
+            }
+        first = new_revision(record_id, form, number, created, [], relationship)
+        revisions = [first]
+        heads = [first]
+        if rng.random() < conflict_rate:
+            heads = [
+                new_revision(
+                    record_id,
+                    form,
+                    number,
+                    created + datetime.timedelta(seconds=branch + 1),
+                    [first],
+                    relationship,
+                )
+                for branch in range(2)
+            ]
+            revisions = revisions + heads
+        data[record_id] = {
+            "_id": record_id,
+            "record_format_version": 1,
+            "type": form,
+            "created": created.isoformat(),
+            "created_by": "user0",
+            "revisions": revisions,
+            "heads": heads,
+        }
+        record_ids.append(record_id)
+
+    return databases
@@ -0,0 +1,287 @@
+"""
+Build the downloadable archive of an export.
+
+``ExportManifest`` records the files an export writes, so the archive stage
+neither walks the output tree to find them nor walks it again to size its
+progress bar. ``write_archive`` streams those files into a tar and compresses
+it across threads: ``ParallelGzipWriter`` cuts the tar stream into blocks and
+compresses each one as a separate gzip member, which any gzip reader
+(``tar xzf``, ``gunzip``, ``tarfile``) reads as a single stream. Already
+compressed media (JPEG, PNG, ...) is stored at level 0 rather than being
+compressed again. If the ``zstandard`` package is installed, ``compression``
+may also be "zstd", which uses zstd's own worker threads.
+
+``StreamingArchive`` is a manifest that archives each file as soon as it is
+recorded, so the archive can be downloaded while the export is running. If
+the export fails, ``abort`` leaves a ``.failed`` marker in place of the
+unfinished archive, so the download ends with an error.
+"""
+
+import logging
+import os
+import tarfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tqdm.auto import tqdm
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Suffixes of files that are already compressed and are stored as they are
+STORED_SUFFIXES = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".webp",
+    ".heic",
+    ".mp3",
+    ".m4a",
+    ".mp4",
+    ".mov",
+    ".zip",
+    ".gz",
+    ".tgz",
+    ".zst",
+}
+
+ARCHIVE_SUFFIXES = {"gzip": ".tgz", "zstd": ".tar.zst"}
+
+
+class ExportManifest:
+    """
+    The files written under ``root`` by an export, in the order written.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.paths = []
+        self._seen = set()
+
+    def add(self, path):
+        path = Path(path)
+        if path not in self._seen:
+            self._seen.add(path)
+            self.paths.append(path)
+
+    def extend(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class ParallelGzipWriter:
+    """
+    A write-only file object producing gzip output compressed across threads.
+
+    Data is cut into ``block_size`` blocks; each is compressed by the pool
+    as its own gzip member and written out in order. At most ``2 * workers``
+    blocks are in flight, so memory is bounded whatever the archive size.
+    """
+
+    def __init__(self, fileobj, level=6, workers=None, block_size=1 << 20):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    @staticmethod
+    def _compress(data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _drain(self, keep):
+        while len(self.pending) > keep:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(self._compress, bytes(block), self.level))
+        self._drain(2 * self.workers)
+
+    def flush(self):
+        """
+        Hand any buffered data to the pool as a block of its own.
+        """
+        if self.buffer:
+            self._submit(self.buffer)
+            self.buffer.clear()
+
+    def set_level(self, level):
+        """
+        Compress data written from now on at ``level``.
+        """
+        if level != self.level:
+            self.flush()
+            self.level = level
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def close(self):
+        self.flush()
+        self._drain(0)
+        self.pool.shutdown()
+
+
+def _stored_level(path, level):
+    name = path.name.lower()
+    return 0 if any(name.endswith(suffix) for suffix in STORED_SUFFIXES) else level
+
+
+def _open_compressor(archive_file, compression, level, workers):
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd archives need the zstandard package")
+    if compression not in ARCHIVE_SUFFIXES:
+        raise ValueError(f"Unknown archive compression: {compression}")
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(
+            level=level, threads=workers or -1
+        ).stream_writer(archive_file, closefd=False)
+    return ParallelGzipWriter(archive_file, level, workers)
+
+
+def _add_to_tar(outputtar, compressor, path, arcname, level):
+    if isinstance(compressor, ParallelGzipWriter):
+        compressor.set_level(_stored_level(path, level))
+    outputtar.add(path, arcname=arcname, recursive=False)
+
+
+def write_archive(
+    manifest, archive_path, arcroot, compression="gzip", level=6, workers=None
+):
+    """
+    Write the files in ``manifest`` to a compressed tar at ``archive_path``.
+
+    Each file is stored under ``arcroot`` at its path relative to the
+    manifest's root. Returns ``archive_path``.
+    """
+    with open(archive_path, "wb") as archive_file:
+        compressor = _open_compressor(archive_file, compression, level, workers)
+        with tarfile.open(fileobj=compressor, mode="w|") as outputtar:
+            for path in tqdm(manifest, desc="Preparing tar file", unit="files"):
+                _add_to_tar(
+                    outputtar,
+                    compressor,
+                    path,
+                    str(Path(arcroot) / path.relative_to(manifest.root)),
+                    level,
+                )
+        compressor.close()
+    log.info(f"Wrote {len(manifest)} files to {archive_path}")
+    return archive_path
+
+
+class StreamingArchive(ExportManifest):
+    """
+    A manifest that adds each file to the archive as soon as it is recorded.
+
+    The archive is written to ``<archive_path>.part`` and renamed when
+    ``close`` is called, so a reader tailing the ``.part`` file (see
+    ``export_stream``) can serve it while the export is still running. Files
+    are deleted once they are in the archive unless ``keep_files`` is set,
+    so the server never holds both the export and its archive.
+
+    An export that fails must call ``abort`` instead of ``close``.
+    """
+
+    def __init__(
+        self,
+        root,
+        archive_path,
+        arcroot,
+        compression="gzip",
+        level=6,
+        workers=None,
+        keep_files=False,
+    ):
+        super().__init__(root)
+        self.archive_path = Path(archive_path)
+        self.part_path = partial_path(self.archive_path)
+        self.arcroot = Path(arcroot)
+        self.level = level
+        self.keep_files = keep_files
+        failed_path(self.archive_path).unlink(missing_ok=True)
+        self.archive_file = open(self.part_path, "wb")
+        self.compressor = _open_compressor(
+            self.archive_file, compression, level, workers
+        )
+        self.outputtar = tarfile.open(fileobj=self.compressor, mode="w|")
+
+    def add(self, path):
+        path = Path(path)
+        if path in self._seen:
+            return
+        super().add(path)
+        _add_to_tar(
+            self.outputtar,
+            self.compressor,
+            path,
+            str(self.arcroot / path.relative_to(self.root)),
+            self.level,
+        )
+        self.compressor.flush()
+        self.archive_file.flush()
+        if not self.keep_files:
+            path.unlink()
+
+    def close(self):
+        """
+        Finish the archive and move it to ``archive_path``.
+        """
+        self.outputtar.close()
+        self.compressor.close()
+        self.archive_file.close()
+        os.replace(self.part_path, self.archive_path)
+        log.info(f"Wrote {len(self)} files to {self.archive_path}")
+        return self.archive_path
+
+    def abort(self, error=None):
+        """
+        Give up on the archive: remove the ``.part`` file, leaving a
+        ``.failed`` marker with ``error`` so readers stop waiting for it.
+        """
+        # Not closing the tar, which would end it as if it were complete
+        try:
+            # Stops the compressor's threads; what it writes is thrown away
+            self.compressor.close()
+        except Exception as e:
+            log.debug(f"Closing the compressor of an abandoned archive: {e}")
+        self.archive_file.close()
+        with open(failed_path(self.archive_path), "w") as marker:
+            marker.write(f"{error!r}\n" if error is not None else "")
+        self.part_path.unlink(missing_ok=True)
+        log.warning(f"Abandoned {self.archive_path} after {len(self)} files")
+
+
+def partial_path(archive_path):
+    """
+    The path ``StreamingArchive`` writes ``archive_path`` to until it is done.
+    """
+    return archive_path.with_name(f"{archive_path.name}.part")
+
+
+def failed_path(archive_path):
+    """
+    The marker ``StreamingArchive.abort`` leaves for an archive it gave up on.
+    """
+    return archive_path.with_name(f"{archive_path.name}.failed")
@@ -0,0 +1,204 @@
+"""
+Back up a notebook's CouchDB databases as gzipped ``_all_docs`` dumps.
+
+Each database is read a page at a time, keyed by ``startkey``, and written as
+the rows arrive. CouchDB puts every ``_all_docs`` row on its own line, so
+rows are counted and copied as bytes without decoding them; only the last
+row of a page is parsed, for the next page's ``startkey``.
+
+Every page is written as its own gzip member, and a checkpoint next to the
+dump records the file size and last key after each one. An interrupted
+backup is truncated back to its checkpoint and carries on from the next
+page. Concatenated gzip members read back as one stream, so the finished
+``.json.gz`` holds the same JSON as a single ``_all_docs?include_docs=true``
+response.
+"""
+
+import gzip
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from tqdm.auto import tqdm
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+PAGE_SIZE = 1000
+# Every _all_docs row line starts with this
+ROW_PREFIX = b'{"id":'
+
+
+def _read_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+
+def _write_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path.with_name(f"{checkpoint_path.name}.tmp")
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _fetch_page(session, url, startkey, page_size, auth=None):
+    """
+    Yield the raw row lines of the ``_all_docs`` page after ``startkey``.
+
+    The page starts at ``startkey`` itself, one row longer, and its first
+    row is dropped if it is still ``startkey``. Skipping a row instead would
+    drop a live document if ``startkey`` had been deleted since.
+    """
+    query = {"include_docs": True, "attachments": True, "limit": page_size}
+    if startkey is not None:
+        query.update(startkey=startkey, limit=page_size + 1)
+    with session.post(url, json=query, auth=auth, stream=True) as response:
+        response.raise_for_status()
+        rows = _page_rows(response)
+        for line in rows:
+            if startkey is None or json.loads(line)["id"] != startkey:
+                yield line
+            break
+        yield from rows
+
+
+def _page_rows(response):
+    for line in response.iter_lines(chunk_size=1 << 16):
+        if line.startswith(ROW_PREFIX):
+            yield line.rstrip(b",")
+        elif ROW_PREFIX in line:
+            # Not laid out a row per line, so parse the page after all
+            for row in json.loads(line)["rows"]:
+                yield json.dumps(row, separators=(",", ":")).encode()
+
+
+def backup_database(
+    base_url,
+    db_name,
+    filename,
+    auth=None,
+    page_size=PAGE_SIZE,
+    resume=True,
+    position=0,
+    metrics=None,
+    session=None,
+):
+    """
+    Dump every document of ``db_name``, with attachments, to ``filename``.
+
+    ``filename`` is written gzipped, a page per gzip member. With ``resume``
+    a dump interrupted earlier continues from its last checkpoint. Requests
+    go through ``session`` if given, and otherwise through a new session
+    whose requests are recorded in ``metrics`` (an
+    ``export_metrics.ExportMetrics``) if given. Returns the number of rows
+    written.
+    """
+    filename = Path(filename)
+    checkpoint_path = filename.with_name(f"{filename.name}.checkpoint")
+    url = f"{base_url}/{db_name}/_all_docs"
+    if session is None:
+        session = requests.Session()
+        if metrics is not None:
+            metrics.instrument(session)
+
+    checkpoint = _read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint is None:
+        with session.get(url, params={"limit": 0}, auth=auth) as response:
+            response.raise_for_status()
+            total_rows = response.json()["total_rows"]
+        with open(filename, "wb") as dump:
+            with gzip.GzipFile(fileobj=dump, mode="wb") as member:
+                member.write(
+                    f'{{"total_rows":{total_rows},"offset":0,"rows":[\n'.encode()
+                )
+            checkpoint = {
+                "size": dump.tell(),
+                "rows": 0,
+                "last_key": None,
+                "total_rows": total_rows,
+            }
+        _write_checkpoint(checkpoint_path, checkpoint)
+    else:
+        log.info(f"Resuming backup of {db_name} after {checkpoint['rows']} rows")
+
+    with open(filename, "r+b") as dump, tqdm(
+        desc=f"Writing {db_name} as json backup",
+        total=checkpoint["total_rows"],
+        initial=checkpoint["rows"],
+        unit="recs",
+        position=position,
+    ) as iterator:
+        dump.truncate(checkpoint["size"])
+        dump.seek(checkpoint["size"])
+        while True:
+            rows = 0
+            last_row = None
+            with gzip.GzipFile(fileobj=dump, mode="wb") as member:
+                for line in _fetch_page(
+                    session, url, checkpoint["last_key"], page_size, auth
+                ):
+                    if checkpoint["rows"] or rows:
+                        member.write(b",\n")
+                    member.write(line)
+                    last_row = line
+                    rows += 1
+                finished = rows < page_size
+                if finished:
+                    member.write(b"\n]}\n")
+            iterator.update(rows)
+            checkpoint["size"] = dump.tell()
+            checkpoint["rows"] += rows
+            if last_row is not None:
+                checkpoint["last_key"] = json.loads(last_row)["id"]
+            if finished:
+                break
+            _write_checkpoint(checkpoint_path, checkpoint)
+
+    checkpoint_path.unlink(missing_ok=True)
+    if metrics is not None:
+        metrics.count("backup_rows", checkpoint["rows"])
+    return checkpoint["rows"]
+
+
+def backup_notebook(
+    base_url,
+    notebook_id,
+    backup_dir,
+    auth=None,
+    resume=True,
+    metrics=None,
+    session=None,
+):
+    """
+    Back up a notebook's metadata and data databases at the same time.
+
+    Returns the paths of the two dumps.
+    """
+    dumps = [
+        (f"metadata-{notebook_id}", backup_dir / f"metadata_db-{notebook_id}.json.gz"),
+        (f"data-{notebook_id}", backup_dir / f"data_db-{notebook_id}.json.gz"),
+    ]
+    with ThreadPoolExecutor(max_workers=len(dumps)) as pool:
+        futures = [
+            pool.submit(
+                backup_database,
+                base_url,
+                db_name,
+                filename,
+                auth=auth,
+                resume=resume,
+                position=position,
+                metrics=metrics,
+                session=session,
+            )
+            for position, (db_name, filename) in enumerate(dumps)
+        ]
+        for future in futures:
+            future.result()
+    return [filename for _, filename in dumps]
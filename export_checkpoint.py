@@ -0,0 +1,173 @@
+"""
+Checkpoints that let an interrupted streaming export carry on where it stopped.
+
+The checkpoint lives in ``.checkpoint`` under the project's output directory:
+
+``records.jsonl``
+    One line per record written: its id, record type, hrid, attachment
+    paths and parent record, if any. A resumed export skips these records
+    without fetching them and restores the lookups needed to resolve
+    relationships to them.
+``state.json``
+    How far ``records.jsonl`` and each form's CSV and JSON Lines files had
+    got at the last save, the state of each form's ``StreamingFormWriter``,
+    which forms were finalised and which output files were finished, and the
+    files of forms reused from an ``export_form_cache.FormCache``.
+
+On resume, the record log and the form files are truncated to the sizes in
+``state.json``. Anything written after the last save is discarded and done
+again, so the files always match the records they claim to hold.
+"""
+
+import json
+import os
+import shutil
+import time
+
+CHECKPOINT_DIR = ".checkpoint"
+# Seconds between checkpoint saves while records are being written
+SAVE_INTERVAL = 30
+
+
+def has_checkpoint(project_path):
+    return (project_path / CHECKPOINT_DIR / "state.json").exists()
+
+
+def clear_checkpoint(project_path):
+    """
+    Forget the checkpoint once the export it belongs to has been delivered.
+    """
+    shutil.rmtree(project_path / CHECKPOINT_DIR, ignore_errors=True)
+
+
+class ExportCheckpoint:
+    """
+    Progress of a streaming export of one notebook under ``project_path``.
+
+    With ``resume`` False any earlier checkpoint is discarded.
+    """
+
+    def __init__(self, project_path, resume=True):
+        self.path = project_path / CHECKPOINT_DIR
+        self.state_path = self.path / "state.json"
+        self.records_path = self.path / "records.jsonl"
+        if not resume:
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.state = {
+            "records_size": 0,
+            "records_done": False,
+            "writers": {},
+            "finalised": {},
+            "tasks": {},
+            "complete": None,
+            "reused": {},
+        }
+        if self.state_path.exists():
+            with open(self.state_path) as state_file:
+                self.state.update(json.load(state_file))
+
+        self.records = {}
+        if self.records_path.exists():
+            os.truncate(self.records_path, self.state["records_size"])
+            with open(self.records_path) as records_file:
+                for line in records_file:
+                    entry = json.loads(line)
+                    self.records[entry["id"]] = entry
+        self.records_file = open(self.records_path, "a")
+        self.last_save = time.monotonic()
+
+    @property
+    def resumed(self):
+        return bool(self.records or self.state["finalised"])
+
+    def restore(self, faims):
+        """
+        Restore the record lookups of ``faims`` for the records already done.
+
+        Returns the paths of their attachments.
+        """
+        paths = []
+        for record_id, entry in self.records.items():
+            if entry["record_type"] is not None:
+                faims.forms_from_record_id[record_id] = entry["record_type"]
+                faims.record_count[entry["record_type"]] += 1
+            if entry["identifier"] is not None:
+                faims.identifiers[record_id] = entry["identifier"]
+            paths += entry["attachments"]
+        return paths
+
+    def record(self, record_id, record_type, identifier, attachment_paths, parent=None):
+        entry = {
+            "id": record_id,
+            "record_type": record_type,
+            "identifier": identifier,
+            "attachments": [str(path) for path in attachment_paths],
+            "parent": parent,
+        }
+        self.records[record_id] = entry
+        self.records_file.write(json.dumps(entry, default=str))
+        self.records_file.write("\n")
+
+    def save(self, writers=None):
+        """
+        Persist the checkpoint, with the state of ``writers`` if given.
+        """
+        if writers is not None:
+            self.state["writers"] = {
+                record_name: writer.checkpoint()
+                for record_name, writer in writers.items()
+            }
+        self.records_file.flush()
+        self.state["records_size"] = os.path.getsize(self.records_path)
+        tmp_path = self.state_path.with_name("state.json.tmp")
+        with open(tmp_path, "w") as state_file:
+            json.dump(self.state, state_file)
+        os.replace(tmp_path, self.state_path)
+        self.last_save = time.monotonic()
+
+    def maybe_save(self, writers):
+        if time.monotonic() - self.last_save >= SAVE_INTERVAL:
+            self.save(writers)
+
+    def save_on_error(self, items, writers):
+        """
+        Yield from ``items``, saving the checkpoint if getting the next item
+        fails (say the export was cancelled), so a resumed export doesn't
+        repeat the records written since the last save.
+
+        Errors while writing a record are left alone, as the writers may be
+        part way through it.
+        """
+        try:
+            yield from items
+        except GeneratorExit:
+            raise
+        except BaseException:
+            self.save(writers)
+            raise
+
+    def records_done(self, writers):
+        self.state["records_done"] = True
+        self.save(writers)
+
+    def finalised(self, record_name, info):
+        self.state["finalised"][record_name] = info
+        self.save()
+
+    def task_key(self, task):
+        output_format, _, args = task
+        return f"{output_format} {args[0]}"
+
+    def task_done(self, task, paths):
+        self.state["tasks"][self.task_key(task)] = [str(path) for path in paths]
+        self.save()
+
+    def finish(self, timings):
+        self.state["complete"] = timings
+        self.save()
+        self.records_file.close()
+
+    def close(self):
+        self.records_file.close()
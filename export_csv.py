@@ -44,31 +44,50 @@ new_revision = create_new_revision( avps={"email": new_avp["_id"],
 
 Finally, we setup the couchdb helper (lets call it `helper`), and use
 `helper.update_existing_record(new_revision,[new_avp])`
+
+When importing many records, collect the `(new_revision, new_avps)` of each
+and use `helper.bulk_update_records(updates)` instead: it uploads them in
+batches with a few `_bulk_docs` requests, rather than several requests per
+record, and returns whether each update succeeded instead of raising.
 """
 
 from faims3couchdb import CouchDBHelper, create_new_avp, create_new_revision
-from faims3records import FAIMS3Record
+from export_writers import (
+    GEO_FORMATS,
+    StreamingFormWriter,
+    write_attachments,
+    write_spool_geometries,
+    write_spool_xlsx,
+)
+from export_parallel import run_output_tasks, write_geometries_task, write_table_task
+from export_pipeline import DEFAULT_MEMORY_BUDGET, iter_pipeline
+from export_checkpoint import ExportCheckpoint, has_checkpoint
+from export_form_cache import FormCache, restore_records, reuse_forms, store_forms
+from export_metrics import ExportMetrics
+from export_profiling import ExportProfiler
+from tqdm.auto import tqdm
 from pprint import pformat
-import jsonlines
 import logging
 from pprint import pprint
 import json
 from uuid import uuid4
 import shutil
 import os
+import sys
 from pathlib import Path
 import re
 from mimetypes import guess_extension, guess_type
 from collections import defaultdict
 import base64
 from slugify import slugify
-from geojson import FeatureCollection
-import geojson
-from pandas.api.types import is_datetime64_ns_dtype
-import numpy as np
-import simplekml
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
 
 OUTPUT_DIR = Path("output")
+# Per-form output formats; "json" is JSON Lines when streaming. Geometry fields
+# can also be written as newline-delimited GeoJSON with "geojsonseq".
+FORMATS = ("csv", "json", "xlsx", "geojson", "kml")
 
 
 def export_csv(
@@ -79,176 +98,500 @@ def export_csv(
     inline_attachments,
     external_attachments,
     bearer_token=None,
+    streaming=False,
+    formats=FORMATS,
+    workers=1,
+    manifest=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    resume=False,
+    metrics=None,
+    profile=None,
+    slow_record_seconds=None,
+    output_dir=None,
+    session=None,
+    schema_cache=None,
+    form_cache=None,
 ):
+    """
+    Export a notebook's forms, attachments and geometries under
+    ``output_dir`` (OUTPUT_DIR by default).
+
+    With ``streaming`` each record is written to its form's CSV and JSON Lines
+    files as soon as it has been merged, instead of flattening the whole
+    notebook into DataFrames first, and no more than ``memory_budget`` bytes
+    of records are queued between the fetch, merge, flatten and write stages
+    (see ``export_pipeline``). Streaming exports are checkpointed, and with
+    ``resume`` an interrupted one carries on from its last checkpoint
+    instead of starting again, streaming even without ``streaming``. Other
+    exports are not affected by ``resume``. ``formats`` picks
+    which of FORMATS are written for each form; leave out "xlsx" to skip
+    building spreadsheets.
+    With ``workers`` above 1 the output files are written in parallel by a
+    pool of that many processes (see ``export_parallel``). Files are added to
+    ``manifest`` (an ``export_archive.ExportManifest``) as they are finished.
+    Phase timings and request statistics are added to ``metrics`` (an
+    ``export_metrics.ExportMetrics``) if given. ``profile`` runs the export
+    under one of ``export_profiling.PROFILERS``; with it or
+    ``slow_record_seconds``, records taking longer than that (default 1s)
+    are flagged, and the artefacts are written to a ``-profile`` directory
+    next to the export. ``session`` and ``schema_cache`` are handed to
+    ``CouchDBHelper``, so several exports can share connections and
+    ui-specifications. With ``form_cache``, a directory, forms unchanged
+    since an earlier export cached there have their files linked from it
+    instead of being written again (see ``export_form_cache``).
+
+    Returns the timings of the output stage, including every path written
+    under ``output_dir``, or None if nothing was exported.
+    """
     # shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
     clean_url = slugify(base_url)
-    project_path = OUTPUT_DIR / f"{clean_url}+{project_key}"
+    project_path = Path(output_dir or OUTPUT_DIR) / f"{clean_url}+{project_key}"
     # print(base_url)
-    faims = CouchDBHelper(
-        user=user,
-        token=token,
-        base_url=base_url,
-        project_key=project_key,
-        bearer_token=bearer_token,
-    )
-
-    records, attachments, shapes = faims.flatten_records(iterator="notebook")
-    if records:
-        project_path.mkdir(parents=True)
-        for key, dataframe in records.items():
-            # dataframe.set_index("metadata.identifier")
-            if dataframe["metadata.identifier"].is_unique:
-                dataframe.set_index("metadata.identifier", inplace=True)
-            form_path = project_path / slugify(key, lowercase=False)
-            form_path.mkdir(parents=True, exist_ok=True)
-            dataframe.to_csv(form_path / f"{slugify(key, lowercase=False)}.csv")
-            dataframe.to_json(form_path / f"{slugify(key, lowercase=False)}.json")
-            # Excel doesn't do timezones
-            # for col in dataframe.dtypes:
-            #     if is_datetime64_ns_dtype(col):
-            #         logging.debug(col)
-            #         dataframe[col.index] = dataframe[col].dt.tz_localize(None)
-            # https://stackoverflow.com/a/66699516
-            date_columns = dataframe.select_dtypes(
-                include=["datetime64[ns, UTC]"]
-            ).columns
-            for date_column in date_columns:
-                dataframe[date_column] = dataframe[date_column].dt.date
-            dataframe.to_excel(
-                form_path / f"{slugify(key, lowercase=False)}.xlsx",
-                engine="xlsxwriter",
+    if metrics is None:
+        metrics = ExportMetrics()
+    # Only streaming exports leave a checkpoint to resume
+    streaming = streaming or (resume and has_checkpoint(project_path))
+    profiler = None
+    if profile is not None or slow_record_seconds is not None:
+        profiler = ExportProfiler(profile, slow_record_seconds or 1.0)
+    # Opened before the helper, which starts the profiler, so a failed
+    # connection or count still stops it
+    try:
+        with metrics.phase("couchdb_init"):
+            faims = CouchDBHelper(
+                user=user,
+                token=token,
+                base_url=base_url,
+                project_key=project_key,
+                bearer_token=bearer_token,
+                metrics=metrics,
+                profiler=profiler,
+                session=session,
+                schema_cache=schema_cache,
             )
-        for attachment in attachments:
-            filename = attachment["filename"]
-            data = attachment["data"]
-            attachment_path = project_path / attachment["path"]
-            if data:
-                attachment_path.mkdir(parents=True, exist_ok=True)
-            with open(attachment_path / filename, "wb") as attach:
-                attach.write(data)
-        for form, shape in shapes.items():
-            form_df = records[form]
-            form_df.set_index("metadata.record_id", inplace=True)
-            form_dict = json.loads(form_df.to_json(orient="index"))
-            # logging.debug(pformat(form_dict))
-            for item_name, item in shape.items():
-                for entry in item:
-                    entry["record_data"] = form_dict[entry["record_id"]]
-                shape_path = project_path / slugify(form, lowercase=False)
-                shape_path.mkdir(parents=True, exist_ok=True)
-                item_FeatureCollection = FeatureCollection(item)
-                with open(
-                    shape_path / f"{slugify(item_name, lowercase=False)}.geojson", "w"
-                ) as geojson_file:
-                    geojson.dump(
-                        item_FeatureCollection, geojson_file, allow_nan=True, indent=2
-                    )
-                # https://stackoverflow.com/a/71116608
-                kml = simplekml.Kml()
-                for feature in item_FeatureCollection["features"]:
-                    geom = feature["geometry"]
-                    geom_type = geom["type"]
-                    if geom_type == "Polygon":
-                        kml.newpolygon(
-                            name=feature["id"],
-                            description=json.dumps(
-                                form_dict[feature["record_id"]], indent=2
-                            ),
-                            outerboundaryis=geom["coordinates"][0],
-                        )
-                    elif geom_type == "LineString":
-                        kml.newlinestring(
-                            name=feature["id"],
-                            description=json.dumps(
-                                form_dict[feature["record_id"]], indent=2
+        with metrics.phase("count_records"):
+            if form_cache is None:
+                metrics.expect("records", faims.count_records())
+            else:
+                # Counts the records while fetching what the fingerprints need
+                form_cache = FormCache(
+                    form_cache,
+                    base_url,
+                    project_key,
+                    faims.record_heads(),
+                    context={
+                        "ui_specification": faims.ui_specification,
+                        "formats": sorted(formats),
+                        "streaming": streaming,
+                        "include_deleted": faims.include_deleted,
+                    },
+                )
+                metrics.expect("records", len(form_cache.record_types))
+
+        if streaming:
+            return export_streaming(
+                faims,
+                project_path,
+                formats=formats,
+                workers=workers,
+                manifest=manifest,
+                memory_budget=memory_budget,
+                resume=resume,
+                form_cache=form_cache,
+            )
+
+        reused = {}
+        if form_cache is not None:
+            with metrics.phase("form_cache"):
+                reused = reuse_forms(faims, form_cache, project_path)
+            restore_records(faims, reused)
+            metrics.expect(
+                "records",
+                metrics.expected["records"]
+                - sum(len(entry["records"]) for entry in reused.values()),
+            )
+        reused_paths = [path for entry in reused.values() for path in entry["paths"]]
+        with metrics.phase("flatten_records"):
+            records, attachments, shapes = faims.flatten_records(iterator="notebook")
+        geo_formats = [
+            geo_format for geo_format in formats if geo_format in GEO_FORMATS
+        ]
+        if records or reused_paths:
+            project_path.mkdir(parents=True, exist_ok=bool(reused_paths))
+            tasks = []
+            for key, dataframe in records.items():
+                # dataframe.set_index("metadata.identifier")
+                if dataframe["metadata.identifier"].is_unique:
+                    dataframe.set_index("metadata.identifier", inplace=True)
+                form_path = project_path / slugify(key, lowercase=False)
+                form_path.mkdir(parents=True, exist_ok=True)
+                for table_format in formats:
+                    if table_format in GEO_FORMATS:
+                        continue
+                    tasks.append(
+                        (
+                            table_format,
+                            write_table_task,
+                            (
+                                key,
+                                form_path,
+                                slugify(key, lowercase=False),
+                                table_format,
                             ),
-                            coords=geom["coordinates"],
                         )
-                    elif geom_type == "Point":
-                        kml.newpoint(
-                            name=feature["id"],
-                            description=json.dumps(
-                                form_dict[feature["record_id"]], indent=2
-                            ),
-                            coords=[geom["coordinates"]],
+                    )
+                if key in shapes and geo_formats:
+                    tasks.append(
+                        (
+                            "+".join(geo_formats),
+                            write_geometries_task,
+                            (key, form_path, geo_formats),
                         )
-                    else:
-                        logging.error(f"ERROR: unknown type: {geom_type}")
-                kml.save(shape_path / f"{slugify(item_name, lowercase=False)}.kml")
-                # logging.debug(item)
-
-    # print("records")
-    # for form in records:
-    #     # pprint(form)
-    #     for record_key in records[form]:
-    #         record = records[form][record_key]
-    #         jsonl_record = {"metadata": {}}
-    #         identifier = "unknown"
-    #         for key in record:
-    #             if key == "metadata":
-    #                 for item in record[key]:
-    #                     # pprint(record[key][item])
-    #                     jsonl_record["metadata"][item] = record[key][item]
-    #             else:
-    #                 # form = record[key]['form']
-    #                 # view = record[key]['view']
-    #                 # if form not in jsonl_record:
-    #                 #     jsonl_record[form] = {view:{}}
-    #                 # if view not in jsonl_record[form]:
-    #                 #     jsonl_record[form][view] = {}
-
-    #                 if "hrid" in record[key]["element"]:
-    #                     # pprint(record[key]['data'])
-    #                     identifier = re.sub(
-    #                         r"[^A-Za-z0-9.+-]+",
-    #                         "_",
-    #                         f"{record[key]['data']['value']}+{record[key]['metadata']['created_at']}+{record[key]['metadata']['created_by']}",
-    #                     )
-
-    #                 # print(key, record[key]['element'], record[key]['data'])
-    #                 # pprint(record)
-    #                 jsonl_record[record[key]["element"]] = record[key]["data"]
-    #                 jsonl_record[record[key]["element"]].update(record[key]["metadata"])
-    #                 jsonl_record[record[key]["element"]]["conflict_history"] = record[
-    #                     key
-    #                 ]["conflict_history"]
-    #                 jsonl_record[record[key]["element"]]["attachments"] = []
-    #                 jsonl_record[record[key]["element"]]["label"] = record[key]["label"]
-    #                 if inline_attachments and record[key]["attachments"]:
-    #                     jsonl_record[record[key]["element"]] = {
-    #                         "data": record[key]["data"],
-    #                         "attachments": [record[key]["attachments"]],
-    #                     }
-
-    #                     jsonl_record[record[key]["element"]]["data"].update(
-    #                         record[key]["metadata"]
-    #                     )
-    #                 if external_attachments and record[key]["attachments"]:
-    #                     # pprint(record[key])
-    #                     counter = defaultdict(int)
-    #                     for attachment in record[key]["attachments"]:
-    #                         header, file = attachment.split(",")
-    #                         header = re.sub(
-    #                             r"data:", r"", re.sub(";base64", "", header)
-    #                         )
-    #                         extension = guess_extension(header)
-    #                         counter[key] += 1
-    #                         # print(key, identifier, counter[key], extension)
-    #                         attachment_path = project_path / key
-    #                         attachment_path.mkdir(parents=True, exist_ok=True)
-    #                         filename = f"{identifier}.{counter[key]}{extension}"
-    #                         jsonl_record[record[key]["element"]]["attachments"].append(
-    #                             str(f"{key}/{filename}")
-    #                         )
-    #                         with open(attachment_path / filename, "wb") as attach:
-    #                             attach.write(base64.standard_b64decode(file))
-
-    #         with jsonlines.open(project_path / "output.jsonl", mode="a") as writer:
-    #             writer.write(jsonl_record)
-    # for record_type in records:
-    #     with open(project_path / f"{record_type}.json","w") as sample:
-    #         json.dump(records[record_type], sample, indent=2)
+                    )
+            with metrics.phase("attachments"):
+                attachment_paths = write_attachments(project_path, attachments)
+            if manifest is not None:
+                manifest.extend(attachment_paths)
+            with metrics.phase("output"):
+                timings = run_output_tasks(tasks, records, workers=workers)
+            add_output_timings(metrics, timings)
+            if manifest is not None:
+                manifest.extend(reused_paths + timings["paths"])
+            timings["paths"] = attachment_paths + reused_paths + timings["paths"]
+            if form_cache is not None:
+                with metrics.phase("form_cache"):
+                    store_forms(
+                        faims,
+                        form_cache,
+                        project_path,
+                        _dataframe_records(faims, records),
+                        skip=reused,
+                    )
+            return timings
+
+        # print("records")
+        # for form in records:
+        #     # pprint(form)
+        #     for record_key in records[form]:
+        #         record = records[form][record_key]
+        #         jsonl_record = {"metadata": {}}
+        #         identifier = "unknown"
+        #         for key in record:
+        #             if key == "metadata":
+        #                 for item in record[key]:
+        #                     # pprint(record[key][item])
+        #                     jsonl_record["metadata"][item] = record[key][item]
+        #             else:
+        #                 # form = record[key]['form']
+        #                 # view = record[key]['view']
+        #                 # if form not in jsonl_record:
+        #                 #     jsonl_record[form] = {view:{}}
+        #                 # if view not in jsonl_record[form]:
+        #                 #     jsonl_record[form][view] = {}
+
+        #                 if "hrid" in record[key]["element"]:
+        #                     # pprint(record[key]['data'])
+        #                     identifier = re.sub(
+        #                         r"[^A-Za-z0-9.+-]+",
+        #                         "_",
+        #                         f"{record[key]['data']['value']}+{record[key]['metadata']['created_at']}+{record[key]['metadata']['created_by']}",
+        #                     )
+
+        #                 # print(key, record[key]['element'], record[key]['data'])
+        #                 # pprint(record)
+        #                 jsonl_record[record[key]["element"]] = record[key]["data"]
+        #                 jsonl_record[record[key]["element"]].update(record[key]["metadata"])
+        #                 jsonl_record[record[key]["element"]]["conflict_history"] = record[
+        #                     key
+        #                 ]["conflict_history"]
+        #                 jsonl_record[record[key]["element"]]["attachments"] = []
+        #                 jsonl_record[record[key]["element"]]["label"] = record[key]["label"]
+        #                 if inline_attachments and record[key]["attachments"]:
+        #                     jsonl_record[record[key]["element"]] = {
+        #                         "data": record[key]["data"],
+        #                         "attachments": [record[key]["attachments"]],
+        #                     }
+
+        #                     jsonl_record[record[key]["element"]]["data"].update(
+        #                         record[key]["metadata"]
+        #                     )
+        #                 if external_attachments and record[key]["attachments"]:
+        #                     # pprint(record[key])
+        #                     counter = defaultdict(int)
+        #                     for attachment in record[key]["attachments"]:
+        #                         header, file = attachment.split(",")
+        #                         header = re.sub(
+        #                             r"data:", r"", re.sub(";base64", "", header)
+        #                         )
+        #                         extension = guess_extension(header)
+        #                         counter[key] += 1
+        #                         # print(key, identifier, counter[key], extension)
+        #                         attachment_path = project_path / key
+        #                         attachment_path.mkdir(parents=True, exist_ok=True)
+        #                         filename = f"{identifier}.{counter[key]}{extension}"
+        #                         jsonl_record[record[key]["element"]]["attachments"].append(
+        #                             str(f"{key}/{filename}")
+        #                         )
+        #                         with open(attachment_path / filename, "wb") as attach:
+        #                             attach.write(base64.standard_b64decode(file))
+
+        #         with jsonlines.open(project_path / "output.jsonl", mode="a") as writer:
+        #             writer.write(jsonl_record)
+        # for record_type in records:
+        #     with open(project_path / f"{record_type}.json","w") as sample:
+        #         json.dump(records[record_type], sample, indent=2)
+
+    finally:
+        if profiler is not None:
+            profiler.stop(project_path.with_name(f"{project_path.name}-profile"))
+
+
+def _dataframe_records(faims, records):
+    """
+    The id, record type, hrid and parent of each record in the DataFrames
+    of ``flatten_records``, as ``store_forms`` takes them.
+    """
+    parent_column = "metadata.relationship_parent_record_id"
+    for dataframe in records.values():
+        parents = (
+            dataframe[parent_column]
+            if parent_column in dataframe
+            else [None] * len(dataframe)
+        )
+        for record_id, parent in zip(dataframe["metadata.record_id"], parents):
+            yield {
+                "id": record_id,
+                "record_type": faims.forms_from_record_id.get(record_id),
+                "identifier": faims.identifiers.get(record_id),
+                # Missing values are NaN
+                "parent": parent if isinstance(parent, str) else None,
+            }
+
+
+def add_output_timings(metrics, timings):
+    """
+    Add the time spent writing each output format to ``metrics``.
+
+    The writing may have been done by worker processes, so only wall time
+    is known.
+    """
+    for output_format, seconds in timings["formats"].items():
+        metrics.add_phase(f"output:{output_format}", seconds)
+
+
+def export_streaming(
+    faims,
+    project_path,
+    hide_empty=True,
+    formats=FORMATS,
+    workers=1,
+    manifest=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    resume=False,
+    form_cache=None,
+):
+    """
+    Stream every record to its form's CSV and JSON Lines files as it is merged.
+
+    Attachments are written straight away too, so memory stays bounded by
+    ``memory_budget`` and the records in flight in each stage. Spreadsheets
+    and geometries are written from the finished JSON Lines files, which
+    double as the spool. The CSV and JSON Lines files are deleted once the
+    other formats are written unless "csv" and "json" are in ``formats``.
+
+    Progress is checkpointed (see ``export_checkpoint``); with ``resume`` an
+    export that was interrupted skips the records, forms and files it had
+    already finished.
+
+    Forms reused from ``form_cache`` (an ``export_form_cache.FormCache``)
+    are noted in the checkpoint, so a resumed export never writes over
+    their linked files.
+    """
+    checkpoint = ExportCheckpoint(project_path, resume=resume)
+    if checkpoint.state["complete"]:
+        checkpoint.close()
+        if manifest is not None:
+            manifest.extend(
+                Path(path) for path in checkpoint.state["complete"]["paths"]
+            )
+        return checkpoint.state["complete"]
+    if checkpoint.resumed:
+        log.info(f"Resuming export after {len(checkpoint.records)} records")
+        faims.metrics.count("records_resumed", len(checkpoint.records))
+    elif form_cache is not None:
+        with faims.metrics.phase("form_cache"):
+            reused = reuse_forms(faims, form_cache, project_path)
+        for record_type, entry in reused.items():
+            for record in entry["records"]:
+                checkpoint.record(
+                    record["id"],
+                    record_type,
+                    record["identifier"],
+                    [],
+                    parent=record["parent"],
+                )
+            checkpoint.state["reused"][record_type] = [
+                str(path) for path in entry["paths"]
+            ]
+        checkpoint.save()
+        faims.metrics.expect(
+            "records",
+            faims.metrics.expected["records"] - len(checkpoint.records),
+        )
+    faims.skip_record_types.update(checkpoint.state["reused"])
+
+    header_plan = faims.get_header_plan()
+    geo_formats = [geo_format for geo_format in formats if geo_format in GEO_FORMATS]
+    paths = [Path(path) for path in checkpoint.restore(faims)]
+    paths += [
+        Path(path)
+        for reused_paths in checkpoint.state["reused"].values()
+        for path in reused_paths
+    ]
+    if manifest is not None:
+        manifest.extend(paths)
+    writers = {}
+    for record_name, state in checkpoint.state["writers"].items():
+        if record_name in checkpoint.state["finalised"]:
+            continue
+        form_name = slugify(record_name, lowercase=False)
+        writers[record_name] = StreamingFormWriter(
+            project_path / form_name,
+            form_name,
+            state["header"],
+            hide_empty=hide_empty,
+            state=state,
+            truncate=not checkpoint.state["records_done"],
+        )
+
+    if not checkpoint.state["records_done"]:
+        with faims.metrics.phase("records"):
+            for record_name, row, attachments, resolved in tqdm(
+                checkpoint.save_on_error(
+                    iter_pipeline(
+                        faims, memory_budget=memory_budget, skip=checkpoint.records
+                    ),
+                    writers,
+                ),
+                desc="JSON records",
+                unit="records",
+            ):
+                if record_name not in writers:
+                    form_name = slugify(record_name, lowercase=False)
+                    writers[record_name] = StreamingFormWriter(
+                        project_path / form_name,
+                        form_name,
+                        header_plan.get(record_name, []),
+                        hide_empty=hide_empty,
+                    )
+                writers[record_name].write(row, pending=not resolved)
+                attachment_paths = write_attachments(project_path, attachments)
+                if manifest is not None:
+                    manifest.extend(attachment_paths)
+                paths += attachment_paths
+                record_id = row["metadata.record_id"]
+                checkpoint.record(
+                    record_id,
+                    faims.forms_from_record_id.get(record_id),
+                    faims.identifiers.get(record_id),
+                    attachment_paths,
+                    parent=row.get("metadata.relationship_parent_record_id"),
+                )
+                checkpoint.maybe_save(writers)
+        checkpoint.records_done(writers)
+
+    with faims.metrics.phase("finalise"):
+        for record_name, writer in writers.items():
+            checkpoint.finalised(
+                record_name,
+                {
+                    "paths": [
+                        str(path)
+                        for path in writer.finalise(patch=faims.resolve_relationships)
+                    ],
+                    "header": writer.header,
+                    "datetime_columns": sorted(writer.datetime_columns),
+                },
+            )
+
+    tasks = []
+    # Spools of formats that weren't asked for
+    unwanted = []
+    for record_name, finalised in checkpoint.state["finalised"].items():
+        csv_path, jsonl_path = (Path(path) for path in finalised["paths"])
+        for path, table_format in ((csv_path, "csv"), (jsonl_path, "json")):
+            if table_format in formats:
+                paths.append(path)
+            else:
+                unwanted.append(path)
+        if "xlsx" in formats:
+            tasks.append(
+                (
+                    "xlsx",
+                    write_spool_xlsx,
+                    (
+                        jsonl_path,
+                        csv_path.with_suffix(".xlsx"),
+                        finalised["header"],
+                        finalised["datetime_columns"],
+                    ),
+                )
+            )
+        if geo_formats and any(
+            column.endswith(".geojson") for column in finalised["header"]
+        ):
+            tasks.append(
+                (
+                    "+".join(geo_formats),
+                    write_spool_geometries,
+                    (
+                        jsonl_path,
+                        project_path / slugify(record_name, lowercase=False),
+                        geo_formats,
+                    ),
+                )
+            )
+    if not checkpoint.state["finalised"] and not checkpoint.state["reused"]:
+        checkpoint.close()
+        return None
+
+    finished = []
+    for task in tasks:
+        if checkpoint.task_key(task) in checkpoint.state["tasks"]:
+            finished += [
+                Path(path)
+                for path in checkpoint.state["tasks"][checkpoint.task_key(task)]
+            ]
+    with faims.metrics.phase("output"):
+        timings = run_output_tasks(
+            [
+                task
+                for task in tasks
+                if checkpoint.task_key(task) not in checkpoint.state["tasks"]
+            ],
+            workers=workers,
+            on_done=checkpoint.task_done,
+        )
+    add_output_timings(faims.metrics, timings)
+    for path in unwanted:
+        path.unlink(missing_ok=True)
+    timings["paths"] = paths + finished + timings["paths"]
+    if manifest is not None:
+        manifest.extend(timings["paths"])
+    checkpoint.finish(dict(timings, paths=[str(path) for path in timings["paths"]]))
+    if form_cache is not None:
+        with faims.metrics.phase("form_cache"):
+            store_forms(
+                faims,
+                form_cache,
+                project_path,
+                checkpoint.records.values(),
+                skip=checkpoint.state["reused"],
+            )
+    return timings
 
 
 if __name__ == "__main__":
-    export_csv()
+    from export_job import main
+
+    sys.exit(main())
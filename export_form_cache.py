@@ -0,0 +1,308 @@
+"""
+Reuse the output files of forms that haven't changed since the last export.
+
+Each form of a notebook gets a fingerprint: a hash of the head revision ids
+of its records, which change whenever a record of the form is created,
+edited or deleted, together with everything else that shapes its files (the
+ui-specification, the formats and the kind of export). Once an export
+finishes, ``store_forms`` hardlinks every form's files into the cache under
+``<root>/<server>+<notebook>/<form>/<fingerprint>``, with an ``entry.json``
+listing the files and the form's records.
+
+The next export of the notebook fetches only the records' heads, and
+``reuse_forms`` hardlinks the files of every form whose fingerprint is
+unchanged back into the export instead of merging its records and writing
+them again. A notebook with one busy form then only pays for that form.
+
+A form's rows name the hrid and form of their parent records, so an entry
+also notes the fingerprints of the forms its records' parents belong to,
+and is only reused while those are unchanged too. The size and mtime of
+every file are checked before it is reused, as a writer truncating a linked
+file would change the cached copy. Where hardlinks aren't possible the
+files are copied. The newest KEEP_ENTRIES entries of each form are kept.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+from slugify import slugify
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+FORM_CACHE_DIR = ".form-cache"
+ENTRY_FILE = "entry.json"
+# Bump when the files a form's records are written to change
+FORM_CACHE_VERSION = 1
+# Entries kept per form
+KEEP_ENTRIES = 2
+
+
+def form_dirs(record_name):
+    """
+    The directories under the export a form's files and attachments are
+    written to, which are usually one and the same.
+    """
+    return {
+        slugify(record_name, lowercase=False),
+        slugify(record_name, max_length=128, allow_unicode=True, lowercase=False),
+    }
+
+
+def form_files(project_path, record_name):
+    """
+    Every file written under ``project_path`` for the form ``record_name``.
+    """
+    return sorted(
+        path
+        for form_dir in form_dirs(record_name)
+        for path in (project_path / form_dir).rglob("*")
+        if path.is_file()
+    )
+
+
+def link_or_copy(source, target):
+    """
+    Hardlink ``source`` to ``target``, replacing it, or copy it where
+    hardlinks aren't possible.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists():
+        target.unlink()
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class FormCache:
+    """
+    The cached form files of one notebook under ``root``.
+
+    ``record_heads`` are ``CouchDBHelper.record_heads()``, and ``context``
+    anything else the files depend on, as a JSON-able dict.
+    """
+
+    def __init__(self, root, base_url, project_key, record_heads, context=None):
+        self.path = Path(root) / f"{slugify(base_url)}+{project_key}"
+        self.record_types = {
+            record_id: record_type
+            for record_type, heads in record_heads.items()
+            for record_id in heads
+        }
+        context = json.dumps(
+            {"version": FORM_CACHE_VERSION, "context": context},
+            sort_keys=True,
+            default=str,
+        )
+        self.fingerprints = {}
+        for record_type, heads in record_heads.items():
+            digest = hashlib.sha256(context.encode())
+            for record_id in sorted(heads):
+                digest.update(f"\n{record_id}:{','.join(heads[record_id])}".encode())
+            self.fingerprints[record_type] = digest.hexdigest()
+
+    def _form_path(self, record_type):
+        return self.path / slugify(str(record_type))
+
+    def lookup(self, record_type):
+        """
+        The cached entry of ``record_type`` if it is up to date, else None.
+        """
+        entry_path = (
+            self._form_path(record_type) / self.fingerprints[record_type] / ENTRY_FILE
+        )
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if any(
+            self.fingerprints.get(parent_type) != fingerprint
+            for parent_type, fingerprint in entry["depends"].items()
+        ) or any(parent_id in self.record_types for parent_id in entry["missing"]):
+            return None
+        for file in entry["files"]:
+            try:
+                if _stat(entry_path.parent / file["path"]) != file["stat"]:
+                    return None
+            except OSError:
+                return None
+        # Counts as recently used when pruning
+        os.utime(entry_path)
+        return entry
+
+    def reuse(self, record_type, project_path):
+        """
+        Link the cached files of ``record_type`` into ``project_path``.
+
+        Returns the entry, with the ``paths`` linked, or None if there is no
+        up to date entry or its files couldn't all be linked.
+        """
+        entry = self.lookup(record_type)
+        if entry is None:
+            return None
+        entry_path = self._form_path(record_type) / self.fingerprints[record_type]
+        paths = []
+        try:
+            for file in entry["files"]:
+                paths.append(project_path / file["path"])
+                link_or_copy(entry_path / file["path"], paths[-1])
+        except OSError as e:
+            log.warning(f"Unable to reuse the files of {record_type}: {e}")
+            for path in paths:
+                path.unlink(missing_ok=True)
+            return None
+        return dict(entry, paths=paths)
+
+    def store(self, record_type, project_path, paths, records):
+        """
+        Cache ``paths`` (under ``project_path``) as the files of
+        ``record_type``, whose ``records`` are dicts of ``id``,
+        ``identifier`` and ``parent`` (the parent record's id or None).
+
+        An entry of the same fingerprint which is no longer up to date, as
+        a parent's form changed, is replaced.
+        """
+        fingerprint = self.fingerprints[record_type]
+        form_path = self._form_path(record_type)
+        if self.lookup(record_type) is not None:
+            return
+        depends = {}
+        missing = set()
+        for record in records:
+            parent_id = record.get("parent")
+            if not parent_id:
+                continue
+            if parent_id in self.record_types:
+                parent_type = self.record_types[parent_id]
+                depends[parent_type] = self.fingerprints[parent_type]
+            else:
+                missing.add(parent_id)
+
+        # Built aside and renamed, so concurrent exports never see half an entry
+        tmp_path = form_path / f".tmp-{uuid.uuid4()}"
+        try:
+            files = []
+            for path in paths:
+                relative = Path(path).relative_to(project_path).as_posix()
+                link_or_copy(path, tmp_path / relative)
+                files.append({"path": relative, "stat": _stat(tmp_path / relative)})
+            tmp_path.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path / ENTRY_FILE, "w") as entry_file:
+                json.dump(
+                    {
+                        "fingerprint": fingerprint,
+                        "files": files,
+                        "records": [
+                            {
+                                "id": record["id"],
+                                "identifier": record.get("identifier"),
+                                "parent": record.get("parent"),
+                            }
+                            for record in records
+                        ],
+                        "depends": depends,
+                        "missing": sorted(missing),
+                    },
+                    entry_file,
+                )
+            if (form_path / fingerprint).exists():
+                stale_path = form_path / f".tmp-{uuid.uuid4()}"
+                os.rename(form_path / fingerprint, stale_path)
+                shutil.rmtree(stale_path, ignore_errors=True)
+            os.rename(tmp_path, form_path / fingerprint)
+        except OSError as e:
+            # Most likely another export stored the same entry first
+            log.debug(f"Not caching the files of {record_type}: {e}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        self.prune(record_type)
+
+    def prune(self, record_type, keep=KEEP_ENTRIES):
+        """
+        Remove all but the ``keep`` most recently used entries of
+        ``record_type``.
+        """
+        entries = []
+        for path in self._form_path(record_type).iterdir():
+            try:
+                entries.append(((path / ENTRY_FILE).stat().st_mtime, path))
+            except OSError:
+                continue
+        for _, path in sorted(entries, reverse=True)[keep:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def reuse_forms(faims, form_cache, project_path):
+    """
+    Link the files of every form of ``faims`` that ``form_cache`` has an up
+    to date entry for into ``project_path``, and leave their records out of
+    merging (see ``CouchDBHelper.skip_record_types``).
+
+    Returns the entries reused by record type.
+    """
+    reused = {}
+    for record_type in form_cache.fingerprints:
+        if record_type not in faims.record_type_names:
+            continue
+        entry = form_cache.reuse(record_type, project_path)
+        if entry is None:
+            continue
+        reused[record_type] = entry
+        faims.skip_record_types.add(record_type)
+        faims.metrics.count("records_reused", len(entry["records"]))
+    if reused:
+        log.info(
+            f"Reused the files of {len(reused)} unchanged forms: "
+            + ", ".join(faims.record_type_names[record_type] for record_type in reused)
+        )
+    faims.metrics.count("forms_reused", len(reused))
+    return reused
+
+
+def restore_records(faims, reused):
+    """
+    Restore the record lookups of ``faims`` for the records of the forms
+    ``reused``, so relationships to them resolve.
+    """
+    for record_type, entry in reused.items():
+        for record in entry["records"]:
+            faims.forms_from_record_id[record["id"]] = record_type
+            faims.record_count[record_type] += 1
+            if record["identifier"] is not None:
+                faims.identifiers[record["id"]] = record["identifier"]
+
+
+def store_forms(faims, form_cache, project_path, records, skip=()):
+    """
+    Cache the files of every form of ``faims`` but those in ``skip``.
+
+    ``records`` are the records written, as dicts of ``id``, ``record_type``,
+    ``identifier`` and ``parent``.
+    """
+    by_type = {}
+    for record in records:
+        by_type.setdefault(record["record_type"], []).append(record)
+    for record_type, record_name in faims.record_type_names.items():
+        if record_type in skip or record_type not in form_cache.fingerprints:
+            continue
+        try:
+            form_cache.store(
+                record_type,
+                project_path,
+                form_files(project_path, record_name),
+                by_type.get(record_type, []),
+            )
+        except OSError as e:
+            log.warning(f"Unable to cache the files of {record_name}: {e}")
@@ -0,0 +1,54 @@
+"""
+Write ``FAIMS3Record`` geodataframes to several OGR formats from one encoding.
+
+Every driver is handed the same frame, so ``encode_features`` prepares it
+once per layer: datetimes and anything that isn't a number or a boolean,
+such as the lists of a flattened record, are written as text, as
+Shapefiles have no datetime fields. ``write_features`` then writes it with
+``GeoDataFrame.to_file``; ``FAIMS3Record`` runs one driver per task through
+``export_parallel.run_output_tasks``.
+"""
+
+import pandas
+
+# Layer creation options per driver: GeoPackage layers get a spatial index.
+DRIVER_OPTIONS = {"GPKG": {"SPATIAL_INDEX": "YES"}}
+
+
+def _is_text(dtype):
+    return not (
+        pandas.api.types.is_bool_dtype(dtype)
+        or pandas.api.types.is_integer_dtype(dtype)
+        or pandas.api.types.is_float_dtype(dtype)
+    )
+
+
+def _text(value):
+    if isinstance(value, (list, dict, tuple)):
+        return str(value)
+    if pandas.isna(value):
+        return None
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_features(gdf):
+    """
+    Prepare ``gdf`` once for ``write_features``, with its text columns encoded.
+    """
+    encoded = gdf.copy()
+    for column, dtype in gdf.dtypes.items():
+        if column != gdf.geometry.name and _is_text(dtype):
+            encoded[column] = gdf[column].map(_text).astype(object)
+    return encoded
+
+
+def write_features(path, driver, encoded, layer=None):
+    """
+    Write a layer prepared by ``encode_features`` to ``path`` with ``driver``.
+
+    Returns ``[path]``.
+    """
+    encoded.to_file(path, driver=driver, layer=layer, **DRIVER_OPTIONS.get(driver, {}))
+    return [path]
@@ -0,0 +1,449 @@
+"""
+Run the whole export of a notebook without the notebook interface.
+
+``run_export`` does what the "Export notebook" button does: export the
+forms, attachments and geometries (``export_csv``), fetch the notebook's
+README, CITATION.cff and repository, back up its databases, write the
+metrics report and archive the lot. ``main`` wraps it in a command line, so
+exports can be scheduled on worker nodes, e.g. from cron::
+
+    python export_csv.py --token "$FAIMS_TOKEN" --all --concurrency 2
+
+Credentials are a bearer token (the token pasted into the interface, or the
+JWT inside it) or a CouchDB user and password. Passwords and tokens can also
+come from the FAIMS_PASSWORD and FAIMS_TOKEN environment variables, so they
+stay out of the process list.
+"""
+
+import argparse
+import base64
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import requests
+from slugify import slugify
+
+from export_archive import ExportManifest, StreamingArchive, write_archive
+from export_backup import backup_notebook
+from export_checkpoint import clear_checkpoint, has_checkpoint
+from export_csv import FORMATS, OUTPUT_DIR, export_csv
+from export_form_cache import FORM_CACHE_DIR
+from export_metrics import REPORT_NAME, ExportMetrics
+from export_pipeline import DEFAULT_MEMORY_BUDGET
+from export_preflight import describe_settings, run_preflight
+from export_profiling import PROFILERS
+from faims3couchdb import BearerAuth
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def parse_bearer_token(value):
+    """
+    Return ``(base_url, jwt)`` from the token pasted into the interface.
+
+    A bare JWT is returned as ``(None, value)``. The JWT isn't verified;
+    the server does that.
+    """
+    try:
+        token = json.loads(base64.b64decode(value))
+    except ValueError:
+        return None, value
+    return token["userdb"].replace("/people", ""), token["jwt_token"]
+
+
+def make_auth(bearer_token=None, user=None, password=None):
+    if bearer_token:
+        return BearerAuth(bearer_token)
+    if user:
+        return (user, password)
+    return None
+
+
+def list_notebooks(base_url, auth, session=requests):
+    """
+    The ``_id`` and ``name`` of every notebook on the server visible to ``auth``.
+    """
+    r = session.post(
+        f"{base_url}/projects/_find",
+        auth=auth,
+        json={"selector": {"$not": {"metadata_db": None}}, "fields": ["_id", "name"]},
+    )
+    r.raise_for_status()
+    return r.json()["docs"]
+
+
+def get_exporter_metadata(base_url, notebook_id, auth, session=requests):
+    r = session.get(f"{base_url}/metadata-{notebook_id}/exporter-metadata", auth=auth)
+    return r.json()
+
+
+def export_path_for(output_dir, base_url, notebook_id):
+    """
+    The directory ``export_csv`` writes a notebook's export to.
+    """
+    return Path(output_dir) / f"{slugify(base_url)}+{notebook_id}"
+
+
+def archive_filename(base_url, notebook_id):
+    timestamp = slugify(datetime.datetime.now().isoformat(timespec="minutes"))
+    server = slugify(base_url.replace("https", ""))
+    return f"{timestamp}+{notebook_id}+{server}.tgz"
+
+
+def fetch_repository(metadata_doc, export_path, backup_dir):
+    """
+    Save the README.md, CITATION.cff and an archive of the notebook's GitHub
+    repository named in its exporter metadata. Returns the paths saved.
+    """
+    # Imported here as only notebooks with a repository need PyGithub
+    from github import Github
+
+    paths = []
+    repo = Github().get_repo(
+        f"{metadata_doc['organisation']}/{metadata_doc['repo_name']}"
+    )
+    for name in ("README.md", "CITATION.cff"):
+        try:
+            contents = repo.get_contents(name)
+            with open(export_path / name, "wb") as repo_file:
+                repo_file.write(base64.b64decode(contents.content))
+            paths.append(export_path / name)
+        except Exception as e:
+            log.warning(f"Unable to save {name}. Reason: {e}")
+
+    archive_url = repo.get_archive_link("tarball")
+    log.info(f"Downloading: {archive_url}")
+    repository_archive = (
+        backup_dir / f"{metadata_doc['organisation']}-{metadata_doc['repo_name']}.zip"
+    )
+    try:
+        with requests.get(archive_url, stream=True) as archive_download:
+            archive_download.raise_for_status()
+            with open(repository_archive, "wb") as archive_file:
+                for chunk in archive_download.iter_content(chunk_size=1 << 20):
+                    archive_file.write(chunk)
+        paths.append(repository_archive)
+    except Exception as e:
+        log.warning(f"Unable to download repository. Reason: {e}")
+    return paths
+
+
+def run_export(
+    base_url,
+    notebook_id,
+    bearer_token=None,
+    user=None,
+    password=None,
+    output_dir=OUTPUT_DIR,
+    formats=FORMATS,
+    streaming=False,
+    stream_archive=False,
+    resume=True,
+    overwrite=False,
+    archive=True,
+    backup=True,
+    workers=1,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    archive_name=None,
+    profile=None,
+    prometheus_file=None,
+    metrics=None,
+    session=None,
+    schema_cache=None,
+    form_cache=None,
+):
+    """
+    Export, back up and archive one notebook under ``output_dir``.
+
+    An earlier export of the notebook is resumed if it left a checkpoint and
+    ``resume`` is set, replaced if ``overwrite`` is set, and otherwise makes
+    this raise ``FileExistsError``. With ``stream_archive`` the archive is
+    written while exporting (see ``export_archive.StreamingArchive``), which
+    rules out resuming. ``metrics``, ``session`` and ``schema_cache`` let
+    the caller collect the metrics and share connections and
+    ui-specifications between exports. ``form_cache`` is the directory of
+    forms' files reused between exports (see ``export_form_cache``).
+    Returns the path of the archive, or None without ``archive``.
+    """
+    output_dir = Path(output_dir)
+    export_path = export_path_for(output_dir, base_url, notebook_id)
+    backup_dir = export_path / "database_backup"
+    archive_path = output_dir / (
+        archive_name or archive_filename(base_url, notebook_id)
+    )
+    arcroot = f"{datetime.date.today().isoformat()}+{notebook_id}"
+    auth = make_auth(bearer_token, user, password)
+    resume = resume and not stream_archive
+    # The streamed archive deletes each file once it holds it, leaving none to cache
+    form_cache = None if stream_archive else form_cache
+
+    if export_path.exists():
+        if resume and has_checkpoint(export_path):
+            log.info(f"Resuming the previous export of {notebook_id}")
+        elif overwrite:
+            shutil.rmtree(export_path)
+        else:
+            raise FileExistsError(
+                f"{export_path} exists; resume or overwrite the earlier export"
+            )
+    log.info(f"Exporting notebook with id: {notebook_id} on {base_url}")
+
+    metrics = metrics or ExportMetrics()
+    session = session or requests.Session()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if stream_archive:
+        manifest = StreamingArchive(export_path, archive_path, arcroot)
+    else:
+        manifest = ExportManifest(export_path)
+    try:
+        timings = export_csv(
+            user=user,
+            token=password,
+            bearer_token=bearer_token,
+            base_url=base_url,
+            project_key=notebook_id,
+            inline_attachments=False,
+            external_attachments=True,
+            formats=formats,
+            streaming=streaming or stream_archive,
+            workers=workers,
+            manifest=manifest,
+            memory_budget=memory_budget,
+            resume=resume,
+            metrics=metrics,
+            profile=profile,
+            output_dir=output_dir,
+            session=session,
+            schema_cache=schema_cache,
+            form_cache=form_cache,
+        )
+        if timings is None:
+            log.warning(f"No records exported from {notebook_id}")
+
+        backup_dir.mkdir(parents=True, exist_ok=True)
+        # Get readme, citation.cff, zipped repository, and replication streams
+        # for data and metadata
+        metadata_doc = get_exporter_metadata(base_url, notebook_id, auth, session)
+        if "repository" in metadata_doc:
+            manifest.extend(fetch_repository(metadata_doc, export_path, backup_dir))
+        if backup:
+            with metrics.phase("backup"):
+                manifest.extend(
+                    backup_notebook(
+                        base_url,
+                        notebook_id,
+                        backup_dir,
+                        auth=auth,
+                        metrics=metrics,
+                        session=session,
+                    )
+                )
+        # Everything but the archive itself, which the report is part of
+        manifest.add(metrics.write_report(export_path / REPORT_NAME))
+
+        if stream_archive:
+            with metrics.phase("archive"):
+                manifest.close()
+    except BaseException as e:
+        # Cancelled or failed: end the download of the streamed archive too
+        if stream_archive:
+            manifest.abort(e)
+        raise
+    if not stream_archive:
+        if archive:
+            with metrics.phase("archive"):
+                write_archive(manifest, archive_path, arcroot)
+        else:
+            archive_path = None
+    if archive_path is not None:
+        clear_checkpoint(export_path)
+    if prometheus_file:
+        metrics.write_prometheus(
+            prometheus_file, labels={"notebook": notebook_id, "server": base_url}
+        )
+    return archive_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export FAIMS3 notebooks without the notebook interface."
+    )
+    parser.add_argument(
+        "--server", help="CouchDB url, if not given by the bearer token"
+    )
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("FAIMS_TOKEN"),
+        help="Bearer token from the interface, or a JWT (default: $FAIMS_TOKEN)",
+    )
+    parser.add_argument("--user", help="CouchDB user, instead of a bearer token")
+    parser.add_argument(
+        "--password",
+        default=os.environ.get("FAIMS_PASSWORD"),
+        help="Password for --user (default: $FAIMS_PASSWORD)",
+    )
+    notebooks = parser.add_mutually_exclusive_group(required=True)
+    notebooks.add_argument(
+        "--project", nargs="+", metavar="KEY", help="Notebooks to export"
+    )
+    notebooks.add_argument(
+        "--all", action="store_true", help="Export every notebook visible"
+    )
+    notebooks.add_argument(
+        "--list", action="store_true", help="List the notebooks visible and exit"
+    )
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Estimate each export and the settings it needs, and exit",
+    )
+    parser.add_argument("--output", type=Path, default=OUTPUT_DIR)
+    parser.add_argument(
+        "--formats", nargs="+", choices=FORMATS + ("geojsonseq",), default=FORMATS
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Notebooks exported at once (more than one implies --streaming)",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=8,
+        help="Requests in flight at once across all exports",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes writing each export's files, if --concurrency is 1",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+        metavar="MB",
+        help="Records queued in memory while streaming, per notebook",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Write records as they arrive instead of building tables in memory,"
+        " checkpointing them so an interrupted export can resume",
+    )
+    parser.add_argument(
+        "--stream-archive",
+        action="store_true",
+        help="Archive files as they are written and delete them (implies --streaming)",
+    )
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="Start again instead of resuming an interrupted streaming export",
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="Replace earlier exports"
+    )
+    parser.add_argument(
+        "--form-cache",
+        type=Path,
+        help="Reuse the files of forms unchanged since earlier exports cached here"
+        f" (default: OUTPUT/{FORM_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--no-form-cache",
+        dest="use_form_cache",
+        action="store_false",
+        help="Write every form's files afresh, and cache none",
+    )
+    parser.add_argument("--no-backup", dest="backup", action="store_false")
+    parser.add_argument("--no-archive", dest="archive", action="store_false")
+    parser.add_argument("--profile", choices=PROFILERS)
+    parser.add_argument(
+        "--prometheus-dir",
+        type=Path,
+        help="Write <notebook>.prom metrics files here for the textfile collector",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        format="[%(asctime)s %(name)s]%(levelname)s: %(message)s", level=logging.INFO
+    )
+    base_url, bearer_token = args.server, None
+    if args.token:
+        token_url, bearer_token = parse_bearer_token(args.token)
+        base_url = base_url or token_url
+    if base_url is None:
+        parser.error("--server is needed unless the bearer token names the server")
+    base_url = base_url.rstrip("/")
+    if args.list or args.all:
+        visible = list_notebooks(
+            base_url, make_auth(bearer_token, args.user, args.password)
+        )
+        if args.list:
+            for notebook in visible:
+                print(f"{notebook['_id']}\t{notebook.get('name', '')}")
+            return 0
+        project_keys = [notebook["_id"] for notebook in visible]
+    else:
+        project_keys = args.project
+    if args.preflight:
+        for project_key in project_keys:
+            settings = run_preflight(
+                base_url,
+                project_key,
+                bearer_token=bearer_token,
+                user=args.user,
+                password=args.password,
+            )
+            print(f"{project_key}: {describe_settings(settings)}")
+        return 0
+
+    # Imported here as export_scheduler itself imports this module
+    from export_scheduler import ExportScheduler
+
+    scheduler = ExportScheduler(
+        max_exports=max(args.concurrency, 1),
+        max_connections=max(args.connections, 1),
+        output_dir=args.output,
+        formats=tuple(args.formats),
+        streaming=args.streaming,
+        stream_archive=args.stream_archive,
+        resume=args.resume,
+        overwrite=args.overwrite,
+        archive=args.archive,
+        backup=args.backup,
+        workers=args.workers,
+        memory_budget=args.memory_budget * 1024 * 1024,
+        profile=args.profile,
+        prometheus_dir=args.prometheus_dir,
+        form_cache=(
+            (args.form_cache or args.output / FORM_CACHE_DIR)
+            if args.use_form_cache
+            else None
+        ),
+    )
+    for project_key in project_keys:
+        scheduler.add(base_url, project_key, bearer_token, args.user, args.password)
+    failed = []
+    for result in scheduler.run():
+        if result["error"] is None:
+            log.info(f"Exported {result['notebook_id']}: {result['archive']}")
+        else:
+            failed.append(result["notebook_id"])
+    if failed:
+        log.error(f"{len(failed)} of {len(project_keys)} exports failed: {failed}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
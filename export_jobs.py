@@ -0,0 +1,191 @@
+"""
+Run exports in the background, so the kernel stays responsive.
+
+An ``ExportJob`` is a thread running ``export_job.run_export``. The button
+callback in ``interface`` starts one and returns straight away, leaving the
+kernel free to handle widget messages, and the interface polls
+``ExportJob.progress`` for the records done, throughput and ETA.
+
+A job can start with a preflight (see ``export_preflight``), which picks
+whether to stream and the memory budget on the job's thread rather than
+holding up the callback. Output files are always written by the job's
+thread itself, as forking a pool of writer processes from a thread of the
+kernel isn't safe.
+
+Cancelling is cooperative: once ``cancel`` is called, the next response
+the export gets from CouchDB raises ``ExportCancelled``. Streaming exports
+are checkpointed, so a cancelled export resumes where it stopped.
+
+Each Voila user has a kernel of their own, so their exports don't block each
+other.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+
+from export_job import run_export
+from export_metrics import ExportMetrics
+from export_preflight import describe_settings, run_preflight
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class ExportCancelled(BaseException):
+    """
+    Raised in the export's thread when its job is cancelled.
+
+    Like KeyboardInterrupt it isn't an Exception, so the handlers that skip
+    records which can't be fetched don't mistake it for one.
+    """
+
+
+class ExportJob(threading.Thread):
+    """
+    Export one notebook on a background thread; ``export_options`` are
+    passed to ``run_export``.
+
+    ``state`` goes from "pending" through "running" to "done", "failed" or
+    "cancelled". Once finished, ``archive`` is the path of the archive and
+    ``error`` the exception that stopped the export, if any.
+
+    With a ``workspace`` (see ``export_workspace``) the export is written to
+    it, and it is closed with the outcome once the job finishes.
+
+    With ``preflight`` the export is estimated first, and streams and gets
+    the memory budget recommended; ``settings`` is then the recommendation,
+    with the estimate, or None if the preflight failed (``preflight_error``).
+    """
+
+    def __init__(
+        self, base_url, notebook_id, workspace=None, preflight=False, **export_options
+    ):
+        super().__init__(name=f"export-{notebook_id}", daemon=True)
+        self.base_url = base_url
+        self.notebook_id = notebook_id
+        self.workspace = workspace
+        if workspace is not None:
+            export_options["output_dir"] = workspace.path
+        # Like export_scheduler, as a thread mustn't fork the writers' pool
+        export_options["workers"] = 1
+        self.export_options = export_options
+        self.preflight = preflight
+        self.settings = None
+        self.preflight_error = None
+        self.metrics = ExportMetrics()
+        self.session = requests.Session()
+        self.session.hooks["response"].append(self._check_cancelled)
+        self.cancelled = threading.Event()
+        self.state = "pending"
+        self.archive = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def _check_cancelled(self, response, *args, **kwargs):
+        if self.cancelled.is_set():
+            raise ExportCancelled(f"Export of {self.notebook_id} was cancelled")
+        return response
+
+    def cancel(self):
+        """
+        Stop the export at its next request to CouchDB.
+        """
+        self.cancelled.set()
+
+    def _run_preflight(self):
+        # A session of its own, as the preflight's helper records its
+        # requests in metrics of its own
+        session = requests.Session()
+        session.hooks["response"].append(self._check_cancelled)
+        try:
+            with self.metrics.phase("preflight"):
+                self.settings = run_preflight(
+                    self.base_url,
+                    self.notebook_id,
+                    bearer_token=self.export_options.get("bearer_token"),
+                    user=self.export_options.get("user"),
+                    password=self.export_options.get("password"),
+                    session=session,
+                    schema_cache=self.export_options.get("schema_cache"),
+                )
+        except Exception as e:
+            self.preflight_error = e
+            log.warning(
+                f"Unable to estimate the export of {self.notebook_id}, "
+                f"using the default settings: {e}"
+            )
+            return
+        log.info(describe_settings(self.settings))
+        self.export_options["streaming"] = (
+            self.export_options.get("streaming") or self.settings["streaming"]
+        )
+        self.export_options["memory_budget"] = self.settings["memory_budget"]
+
+    def run(self):
+        self.started = time.perf_counter()
+        self.state = "running"
+        try:
+            if self.preflight:
+                self._run_preflight()
+            self.archive = run_export(
+                self.base_url,
+                self.notebook_id,
+                metrics=self.metrics,
+                session=self.session,
+                **self.export_options,
+            )
+            self.state = "done"
+        except (Exception, ExportCancelled) as e:
+            self.error = e
+            if self.cancelled.is_set():
+                self.state = "cancelled"
+                log.info(f"Export of {self.notebook_id} cancelled")
+            else:
+                self.state = "failed"
+                log.exception(f"Export of {self.notebook_id} failed")
+        finally:
+            self.finished = time.perf_counter()
+            if self.workspace is not None:
+                self.workspace.close(self.state, self.archive)
+
+    def progress(self):
+        """
+        A snapshot of the export: its state and active phases, records done
+        and expected, the fraction done, records and megabytes fetched per
+        second, and the seconds elapsed and (while merging records) left.
+        Unknown values are None.
+        """
+        report = self.metrics.report()
+        counts = report["counts"]
+        merged = counts.get("records", 0)
+        done = merged + counts.get("records_resumed", 0)
+        expected = report["expected"].get("records")
+        if self.started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+        bytes_in = sum(endpoint["bytes_in"] for endpoint in report["http"].values())
+        records_per_second = merged / elapsed if elapsed else None
+        fraction = None
+        eta = None
+        if self.state == "done":
+            fraction = 1.0
+        elif expected:
+            fraction = min(done / expected, 1.0)
+            if records_per_second and done < expected:
+                eta = (expected - done) / records_per_second
+        return {
+            "state": self.state,
+            "phases": report["active_phases"],
+            "records": done,
+            "expected": expected,
+            "fraction": fraction,
+            "records_per_second": records_per_second,
+            "megabytes_per_second": bytes_in / elapsed / 1e6 if elapsed else None,
+            "elapsed": elapsed,
+            "eta": eta,
+        }
@@ -0,0 +1,296 @@
+"""
+Measure where the time of an export goes.
+
+An ``ExportMetrics`` is handed down from ``interface.export_notebook``
+through ``export_csv`` to ``CouchDBHelper``, and collects:
+
+- wall and CPU time per phase (``with metrics.phase("flatten"): ...``);
+- per endpoint (``_find``, ``_all_docs``, attachments, ...), the number of
+  HTTP requests, errors, a latency histogram and bytes sent and received,
+  from hooks on the ``requests.Session`` the helper uses;
+- counts of things processed, such as records, and their rates, along
+  with how many are expected, where that is known;
+- the peak resident memory of the process.
+
+``write_report`` saves it as JSON, which ``export_notebook`` puts inside the
+export, and ``write_prometheus`` as a Prometheus text file for the node
+exporter's textfile collector.
+
+Phases may nest, and CPU time is for the whole process, so it includes the
+background threads of a streaming export.
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Name of the report written inside each export
+REPORT_NAME = "export-metrics.json"
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def endpoint_name(url):
+    """
+    Group a CouchDB url by what it asks for, leaving out database and ids.
+    """
+    segments = [segment for segment in urlsplit(url).path.split("/") if segment]
+    if not segments:
+        return "root"
+    if segments[0] == "projects":
+        return "projects"
+    if segments[-1].startswith("_"):
+        return segments[-1]
+    if len(segments) == 2 and segments[1] == "ui-specification":
+        return "ui-specification"
+    return "attachment" if len(segments) > 2 else "document"
+
+
+def _escape(label):
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def peak_memory():
+    """
+    The peak resident memory of this process in bytes, or None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+class _Endpoint:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds, status, bytes_in, bytes_out):
+        self.count += 1
+        self.errors += status >= 400
+        self.seconds += seconds
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        bucket = next(
+            (index for index, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+            len(LATENCY_BUCKETS),
+        )
+        self.buckets[bucket] += 1
+
+    def report(self):
+        histogram = {}
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.buckets):
+            total += count
+            histogram[str(bound)] = total
+        return {
+            "requests": self.count,
+            "errors": self.errors,
+            "seconds": self.seconds,
+            "mean_seconds": self.seconds / self.count if self.count else None,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "latency_histogram": histogram,
+        }
+
+
+class ExportMetrics:
+    """
+    Timings, HTTP statistics and counts collected over one export.
+
+    Safe to update from several threads.
+    """
+
+    def __init__(self):
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.active = []
+        self.endpoints = {}
+        self.counts = Counter()
+        self.expected = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the wall and CPU time spent in the ``with`` block to ``name``.
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        with self.lock:
+            self.active.append(name)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active.remove(name)
+            self.add_phase(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_phase(self, name, wall, cpu=None):
+        with self.lock:
+            phase = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+            phase["wall"] += wall
+            if cpu is not None:
+                phase["cpu"] += cpu
+            phase["calls"] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def expect(self, name, amount):
+        """
+        Note that ``amount`` of ``name`` are expected to be counted, so
+        progress can be reported against it.
+        """
+        with self.lock:
+            self.expected[name] = amount
+
+    def _on_response(self, response, *args, **kwargs):
+        if kwargs.get("stream"):
+            # Reading the body here would defeat streaming
+            bytes_in = int(response.headers.get("Content-Length") or 0)
+        else:
+            bytes_in = len(response.content)
+        body = response.request.body
+        bytes_out = len(body) if isinstance(body, (bytes, str)) else 0
+        with self.lock:
+            self.endpoints.setdefault(
+                endpoint_name(response.request.url), _Endpoint()
+            ).observe(
+                response.elapsed.total_seconds(),
+                response.status_code,
+                bytes_in,
+                bytes_out,
+            )
+        return response
+
+    def instrument(self, session):
+        """
+        Record every request made through the ``requests.Session`` given.
+
+        Latency is the time to the response headers. The body of a
+        streamed response is counted from its Content-Length, if any.
+        """
+        session.hooks["response"].append(self._on_response)
+        return session
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            return {
+                "started": self.started.isoformat(),
+                "elapsed": elapsed,
+                "phases": {name: dict(phase) for name, phase in self.phases.items()},
+                "active_phases": list(self.active),
+                "http": {
+                    name: endpoint.report()
+                    for name, endpoint in sorted(self.endpoints.items())
+                },
+                "counts": dict(self.counts),
+                "expected": dict(self.expected),
+                "rates": {
+                    f"{name}_per_second": amount / elapsed
+                    for name, amount in self.counts.items()
+                },
+                "peak_memory_bytes": peak_memory(),
+            }
+
+    def write_report(self, path):
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        return path
+
+    def write_prometheus(self, path, labels=None):
+        """
+        Write the metrics in the Prometheus text format, with ``labels``
+        (e.g. the notebook) added to every sample.
+
+        The file is replaced atomically, as the textfile collector expects.
+        """
+        report = self.report()
+        lines = []
+
+        def sample(name, value, **sample_labels):
+            if value is None:
+                return
+            sample_labels = {**(labels or {}), **sample_labels}
+            label_text = ",".join(
+                f'{key}="{_escape(label)}"' for key, label in sample_labels.items()
+            )
+            lines.append(f"faims_export_{name}{{{label_text}}} {value}")
+
+        def family(name, metric_type, help_text):
+            lines.append(f"# HELP faims_export_{name} {help_text}")
+            lines.append(f"# TYPE faims_export_{name} {metric_type}")
+
+        family("elapsed_seconds", "gauge", "Wall time of the export so far.")
+        sample("elapsed_seconds", report["elapsed"])
+        family("phase_seconds", "gauge", "Time spent in each phase of the export.")
+        for name, phase in report["phases"].items():
+            sample("phase_seconds", phase["wall"], phase=name, clock="wall")
+            sample("phase_seconds", phase["cpu"], phase=name, clock="cpu")
+        family(
+            "http_request_duration_seconds",
+            "histogram",
+            "Latency of requests to CouchDB by endpoint.",
+        )
+        for name, endpoint in report["http"].items():
+            for bound, count in endpoint["latency_histogram"].items():
+                sample(
+                    "http_request_duration_seconds_bucket",
+                    count,
+                    endpoint=name,
+                    le=bound,
+                )
+            sample(
+                "http_request_duration_seconds_sum", endpoint["seconds"], endpoint=name
+            )
+            sample(
+                "http_request_duration_seconds_count",
+                endpoint["requests"],
+                endpoint=name,
+            )
+        family("http_errors_total", "counter", "Requests answered with an error.")
+        for name, endpoint in report["http"].items():
+            sample("http_errors_total", endpoint["errors"], endpoint=name)
+        family(
+            "http_bytes_total", "counter", "Bytes sent to and received from CouchDB."
+        )
+        for name, endpoint in report["http"].items():
+            sample(
+                "http_bytes_total", endpoint["bytes_in"], endpoint=name, direction="in"
+            )
+            sample(
+                "http_bytes_total",
+                endpoint["bytes_out"],
+                endpoint=name,
+                direction="out",
+            )
+        family("items_total", "counter", "Things processed, such as records.")
+        for name, amount in report["counts"].items():
+            sample("items_total", amount, item=name)
+        family("peak_memory_bytes", "gauge", "Peak resident memory of the exporter.")
+        sample("peak_memory_bytes", report["peak_memory_bytes"])
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+        return path
@@ -0,0 +1,131 @@
+"""
+Run the per-form output writing of ``export_csv`` across a process pool.
+
+Every (form, format) pair is a separate task, so the write phase takes about
+as long as the slowest file rather than the sum of all of them. Form tables
+are never pickled to the workers: each run forks a pool of its own after the
+DataFrames have been built, handing it the tables through the pool's
+initializer, so workers read them from memory shared copy-on-write with the
+parent. Streaming exports hand workers the path of the form's JSON Lines
+spool instead.
+
+The tables are passed to each run rather than kept in a module global, so
+exports running at once on different threads never see each other's.
+"""
+
+import logging
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from export_writers import iter_dataframe_rows, write_form_table, write_geometries
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# The tables of the run that forked this worker process, set by _init_worker
+_worker_tables = {}
+
+
+def write_table_task(tables, form, form_path, name, table_format):
+    return write_form_table(tables[form], form_path, name, table_format)
+
+
+def write_geometries_task(tables, form, shape_path, geo_formats):
+    return write_geometries(iter_dataframe_rows(tables[form]), shape_path, geo_formats)
+
+
+def write_layers_task(tables, driver, outputs):
+    """
+    Write ``(layer key, path, layer name)`` outputs with one OGR driver.
+
+    The layers are ones encoded by ``export_geospatial.encode_features``.
+    Layers sharing a file, as in a GeoPackage, are written one after another.
+    """
+    # Imported here as geopandas is slow to import and only the
+    # DataFrame export writes layers
+    from export_geospatial import write_features
+
+    paths = []
+    for key, path, layer in outputs:
+        if path not in paths:
+            paths += write_features(path, driver, tables[key], layer)
+        else:
+            write_features(path, driver, tables[key], layer)
+    return paths
+
+
+# Tasks which are called with the run's tables before their own arguments
+_TABLE_TASKS = (write_table_task, write_geometries_task, write_layers_task)
+
+
+def _init_worker(tables):
+    # With "fork" the initargs aren't pickled, so this is the parent's dict
+    _worker_tables.update(tables)
+
+
+def _run_task(task, tables):
+    output_format, function, args = task
+    if function in _TABLE_TASKS:
+        args = (tables, *args)
+    start = time.perf_counter()
+    paths = function(*args)
+    return output_format, time.perf_counter() - start, paths
+
+
+def _run_worker_task(task):
+    return _run_task(task, _worker_tables)
+
+
+def _done(task, result, on_done):
+    if on_done is not None:
+        on_done(task, result[2])
+    return result
+
+
+def run_output_tasks(tasks, tables=None, workers=1, on_done=None):
+    """
+    Run ``(output_format, function, args)`` tasks, in parallel if ``workers`` > 1.
+
+    ``tables`` are handed to the ``write_table_task``,
+    ``write_geometries_task`` and ``write_layers_task`` tasks of this run
+    only. Parallel runs need
+    the "fork" start method; where it isn't available the tasks run one after
+    another. ``on_done(task, paths)`` is called as each task finishes.
+
+    Returns a dict with the wall time of the stage, the summed time spent on
+    each format and the paths written.
+    """
+    tables = tables or {}
+    start = time.perf_counter()
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(tasks)) or 1,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(tables,),
+        ) as pool:
+            results = pool.map(_run_worker_task, tasks)
+            results = [
+                _done(task, result, on_done) for task, result in zip(tasks, results)
+            ]
+    else:
+        results = [_done(task, _run_task(task, tables), on_done) for task in tasks]
+
+    timings = {"wall": time.perf_counter() - start, "formats": defaultdict(float)}
+    paths = []
+    for output_format, seconds, task_paths in results:
+        timings["formats"][output_format] += seconds
+        paths += task_paths
+    timings["formats"] = dict(timings["formats"])
+    timings["paths"] = paths
+    log.info(
+        f"Wrote {len(paths)} files in {timings['wall']:.1f}s ("
+        + ", ".join(
+            f"{output_format}: {seconds:.1f}s"
+            for output_format, seconds in timings["formats"].items()
+        )
+        + f") with {workers} worker(s)"
+    )
+    return timings
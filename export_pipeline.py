@@ -0,0 +1,198 @@
+"""
+Run a streaming export as fetch -> merge -> flatten stages on their own threads.
+
+Each stage hands its output to the next through a ``BudgetQueue``, which
+blocks the producer once the items waiting in it add up to its share of the
+memory budget. A slow writer therefore holds back flattening, which holds
+back merging, which holds back fetching, and memory stays bounded by the
+budget (plus the records each stage is working on) rather than by the size
+of the notebook. The network-bound fetch and merge stages also overlap with
+the disk-bound writing done by the caller.
+
+Records come out in the order ``_find`` returns them, as with
+``CouchDBHelper.iter_flattened_records``.
+"""
+
+import logging
+import threading
+from collections import deque
+
+from faims3couchdb import flatten_row
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Bytes of queued records allowed across all stages
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+_DONE = object()
+
+
+class PipelineClosed(Exception):
+    pass
+
+
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+def estimate_size(value):
+    """
+    Roughly how many bytes ``value`` holds, counting strings and bytes by
+    length and containers by their contents.
+    """
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value) + 50
+    if isinstance(value, dict):
+        return sum(
+            estimate_size(key) + estimate_size(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(item) for item in value) + 50
+    return 30
+
+
+class BudgetQueue:
+    """
+    A queue bounded by the estimated size of its items instead of their count.
+
+    An item bigger than the whole budget is still accepted when the queue is
+    empty, so one large record can't stall the pipeline.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = deque()
+        self.used = 0
+        self.peak = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item, size=0, force=False):
+        with self.condition:
+            while (
+                not force
+                and not self.closed
+                and self.items
+                and self.used + size > self.max_bytes
+            ):
+                self.condition.wait()
+            if self.closed:
+                raise PipelineClosed()
+            self.items.append((item, size))
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.items:
+                if self.closed:
+                    raise PipelineClosed()
+                self.condition.wait()
+            item, size = self.items.popleft()
+            self.used -= size
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        """
+        Make ``put`` and reads of an empty queue raise ``PipelineClosed``.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+
+
+def _run_stage(items, target):
+    try:
+        for item in items:
+            target.put(item, estimate_size(item))
+        target.put(_DONE, force=True)
+    except PipelineClosed:
+        pass
+    except BaseException as error:
+        try:
+            target.put(_Failed(error), force=True)
+        except PipelineClosed:
+            pass
+
+
+def _merge(faims, docs, include_attachments, skip):
+    for doc in docs:
+        if doc["_id"] in skip or doc.get("type") in faims.skip_record_types:
+            continue
+        merged = faims.merge_record(doc, include_attachments=include_attachments)
+        if merged is not None:
+            yield merged
+
+
+def _flatten(faims, merged, per_field_users, external_attachments):
+    for record_type, record_id, record in merged:
+        record_name = faims.record_type_names[record_type]
+        resolved = faims.resolve_relationships(record["metadata"], strict=False)
+        record, attachments, _ = faims.flatten_record(
+            record_name,
+            record_id,
+            record,
+            per_field_users=per_field_users,
+            external_attachments=external_attachments,
+        )
+        yield record_name, flatten_row(record), attachments, resolved
+
+
+def iter_pipeline(
+    faims,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    per_field_users=False,
+    external_attachments=True,
+    skip=(),
+):
+    """
+    Yield ``(record_name, row, attachments, resolved)`` like
+    ``CouchDBHelper.iter_flattened_records``, with fetching, merging and
+    flattening running ahead of the caller on background threads.
+
+    Records whose ids are in ``skip``, or of the helper's
+    ``skip_record_types``, are left out before they are merged.
+    ``memory_budget`` is split evenly between the three queues. If a stage
+    fails its exception is raised here; if the caller stops early the stages
+    are shut down.
+    """
+    queues = [BudgetQueue(memory_budget // 3) for _ in range(3)]
+    docs, merged, rows = queues
+    stages = [
+        (faims.iter_record_docs(), docs),
+        (_merge(faims, docs, include_attachments=True, skip=skip), merged),
+        (_flatten(faims, merged, per_field_users, external_attachments), rows),
+    ]
+    threads = [
+        threading.Thread(target=_run_stage, args=stage, daemon=True) for stage in stages
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        yield from rows
+    finally:
+        # Stops any stage still running, whether it is waiting to read or write
+        for queue in queues:
+            queue.close()
+        for thread in threads:
+            thread.join()
+        log.info(
+            "Peak queued bytes: "
+            + ", ".join(
+                f"{name} {queue.peak / 1e6:.1f} MB"
+                for name, queue in zip(("fetch", "merge", "flatten"), queues)
+            )
+        )
@@ -0,0 +1,203 @@
+"""
+Estimate an export before running it, and pick its settings.
+
+``CouchDBHelper.preflight`` reads cheap summaries of a notebook: how many
+documents it has, its records per form, its attachments from their stubs,
+and what merging a small sample of records took. ``estimate_export`` turns
+them into the records, attachment bytes, requests, seconds and peak memory
+an export would take, and ``recommend_settings`` picks ``streaming``,
+``workers`` and ``memory_budget`` for ``export_csv`` to fit the memory
+available:
+
+- DataFrame exports hold every record and attachment in memory at once, so
+  a notebook that wouldn't fit in MEMORY_HEADROOM of the memory available
+  streams instead, as does one taking over LONG_EXPORT seconds, since
+  streaming exports are checkpointed and can resume;
+- notebooks of PARALLEL_RECORDS records or more write their forms with a
+  worker process each, up to the CPUs available.
+
+The memory model was fitted to the synthetic notebooks in ``benchmarks``:
+a DataFrame export peaks at about DATAFRAME_MEMORY_FACTOR times the bytes of
+records fetched, plus ATTACHMENT_MEMORY_FACTOR times the attachments. The
+time is the requests at the latency of the sample, plus the attachments at
+ATTACHMENT_BANDWIDTH. Both are rough, and meant to tell seconds from hours.
+"""
+
+import math
+import os
+from pathlib import Path
+
+from export_metrics import peak_memory
+from export_pipeline import DEFAULT_MEMORY_BUDGET
+from faims3couchdb import CouchDBHelper
+
+# Requests made per record: its revisions, head revisions and AVPs
+REQUESTS_PER_RECORD = 3
+# Records per page of _find, as CouchDBHelper.iter_record_docs fetches them
+RECORDS_PER_PAGE = 25
+# Bytes per second attachments are assumed to download at
+ATTACHMENT_BANDWIDTH = 10 * 1024 * 1024
+# Memory the export needs besides its records (pandas, buffers, ...)
+EXPORT_OVERHEAD = 40 * 1024 * 1024
+DATAFRAME_MEMORY_FACTOR = 3
+ATTACHMENT_MEMORY_FACTOR = 1.25
+# Fraction of the memory available an export should stay within
+MEMORY_HEADROOM = 0.5
+# Seconds beyond which an export should be resumable
+LONG_EXPORT = 600
+PARALLEL_RECORDS = 10000
+MAX_WORKERS = 4
+
+
+def available_memory():
+    """
+    The memory limit of this container (cgroup v2 or v1), or else the
+    physical memory of the machine, in bytes; None if unknown.
+    """
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            limit = Path(path).read_text().strip()
+        except OSError:
+            continue
+        # "max", or a huge number on cgroup v1, means no limit
+        if limit.isdigit() and int(limit) < 1 << 60:
+            return int(limit)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_export(summary, streaming=False, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    The records, attachments, attachment bytes, requests, seconds and peak
+    memory (in bytes) an export of the notebook ``summary`` describes
+    (see ``CouchDBHelper.preflight``) would take.
+    """
+    records = summary["records"]
+    sampled = summary["sampled_records"]
+    bytes_per_record = summary["sample_bytes"] / sampled if sampled else 0
+    latency = (
+        summary["sample_seconds"] / summary["sample_requests"]
+        if summary["sample_requests"]
+        else 0
+    )
+    requests = (
+        math.ceil(records / RECORDS_PER_PAGE)
+        + REQUESTS_PER_RECORD * records
+        + summary["attachments"]
+    )
+    record_bytes = records * bytes_per_record
+    if streaming:
+        # The queues between the stages never hold more than the budget
+        memory = EXPORT_OVERHEAD + min(memory_budget, record_bytes)
+    else:
+        memory = (
+            EXPORT_OVERHEAD
+            + DATAFRAME_MEMORY_FACTOR * record_bytes
+            + ATTACHMENT_MEMORY_FACTOR * summary["attachment_bytes"]
+        )
+    return {
+        "records": records,
+        "attachments": summary["attachments"],
+        "attachment_bytes": summary["attachment_bytes"],
+        "requests": requests,
+        "seconds": requests * latency
+        + summary["attachment_bytes"] / ATTACHMENT_BANDWIDTH,
+        # Including what the process already uses
+        "memory_bytes": int(memory + (peak_memory() or 0)),
+    }
+
+
+def recommend_settings(summary, available=None):
+    """
+    Pick ``streaming``, ``workers`` and ``memory_budget`` for exporting the
+    notebook ``summary`` describes, with ``available`` bytes of memory
+    (by default ``available_memory()``).
+
+    Returns them with the ``estimate`` of the export with those settings,
+    the ``available`` memory and the ``reasons`` for streaming, if any.
+    """
+    available = available or available_memory()
+    dataframe = estimate_export(summary)
+    reasons = []
+    if available and dataframe["memory_bytes"] > MEMORY_HEADROOM * available:
+        reasons.append("it would not fit in memory")
+    if dataframe["seconds"] > LONG_EXPORT:
+        reasons.append("it can then resume if interrupted")
+    memory_budget = DEFAULT_MEMORY_BUDGET
+    if available:
+        memory_budget = max(
+            min(memory_budget, int(MEMORY_HEADROOM * available / 2)), 16 * 1024**2
+        )
+    workers = 1
+    if summary["records"] >= PARALLEL_RECORDS:
+        workers = max(min(os.cpu_count() or 1, len(summary["forms"]), MAX_WORKERS), 1)
+    streaming = bool(reasons)
+    return {
+        "streaming": streaming,
+        "workers": workers,
+        "memory_budget": memory_budget,
+        "estimate": estimate_export(summary, streaming, memory_budget),
+        "available": available,
+        "reasons": reasons,
+    }
+
+
+def run_preflight(
+    base_url,
+    notebook_id,
+    bearer_token=None,
+    user=None,
+    password=None,
+    session=None,
+    schema_cache=None,
+):
+    """
+    Summarise the notebook and ``recommend_settings`` for exporting it,
+    with the ``summary`` added.
+    """
+    helper = CouchDBHelper(
+        user=user,
+        token=password,
+        base_url=base_url,
+        project_key=notebook_id,
+        bearer_token=bearer_token,
+        session=session,
+        schema_cache=schema_cache,
+    )
+    summary = helper.preflight()
+    return dict(recommend_settings(summary), summary=summary)
+
+
+def _duration(seconds):
+    if seconds < 90:
+        return f"{seconds:.0f} seconds"
+    if seconds < 90 * 60:
+        return f"{seconds / 60:.0f} minutes"
+    return f"{seconds / 3600:.1f} hours"
+
+
+def describe_settings(settings):
+    """
+    A line of text describing ``recommend_settings``' estimate and choice.
+    """
+    estimate = settings["estimate"]
+    text = (
+        f"About {estimate['records']} records and {estimate['attachments']} "
+        f"attachments ({estimate['attachment_bytes'] / 1e6:.0f} MB): "
+        f"roughly {_duration(estimate['seconds'])}, "
+        f"{estimate['requests']} requests and "
+        f"{estimate['memory_bytes'] / 1e6:.0f} MB of memory"
+    )
+    if settings["available"]:
+        text += f" of {settings['available'] / 1e6:.0f} MB available"
+    text += "."
+    if settings["streaming"]:
+        text += f" Streaming the export, as {' and '.join(settings['reasons'])}."
+    if settings["workers"] > 1:
+        text += f" Writing files with {settings['workers']} processes."
+    return text
@@ -0,0 +1,264 @@
+"""
+Opt-in profiling of an export, for diagnosing slow notebooks.
+
+``ExportProfiler`` runs the export under one of PROFILERS:
+
+``cprofile``
+    Deterministic profile of the thread that started it, saved as
+    ``export.prof`` (for ``snakeviz`` or ``pstats``) and summarised in
+    ``export-profile.txt``. It doesn't see the background threads of a
+    streaming export; use ``sampling`` for those.
+``sampling``
+    Samples the stacks of every thread every ``interval`` seconds, with
+    little overhead, and saves them as ``export-profile.folded``
+    (collapsed stacks, for ``flamegraph.pl`` or speedscope) and a summary.
+``tracemalloc``
+    Traces allocations, saving the largest allocation sites and the peak
+    in ``export-tracemalloc.txt`` and the snapshot as ``export.tracemalloc``.
+    Both cover the whole process, so they include whatever else is running,
+    such as other exports, and if something else was already tracing, the
+    peak goes back to when it started.
+
+Whatever the profiler, every record merged by ``CouchDBHelper`` is timed
+along with its revisions, heads, attachments and conflict history. Records
+taking longer than ``slow_record_seconds`` are logged as they happen, and
+the SLOW_RECORDS_KEPT slowest are listed in ``slow-records.json``, along
+with the totals of every record.
+"""
+
+import cProfile
+import heapq
+import io
+import itertools
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+PROFILERS = ("cprofile", "sampling", "tracemalloc")
+# Number of slowest records listed in slow-records.json
+SLOW_RECORDS_KEPT = 50
+
+
+def record_stats(faims_record, merged):
+    """
+    The things that make a record slow to merge: its revisions and heads,
+    and the attachments and conflict history of the merged record.
+    """
+    stats = {
+        "revisions": len(faims_record.get("revisions", [])),
+        "heads": len(faims_record.get("heads", [])),
+        "attachments": 0,
+        "conflict_history": 0,
+    }
+    if merged is not None:
+        for value in merged[2].values():
+            if isinstance(value, dict):
+                stats["attachments"] += len(value.get("attachments", []))
+                stats["conflict_history"] += len(value.get("conflict_history", {}))
+    return stats
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name="export-profiler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, profile_dir):
+        with open(profile_dir / "export-profile.folded", "w") as folded:
+            for stack, count in self.stacks.most_common():
+                folded.write(f"{stack} {count}\n")
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames[1:]):
+                total[frame] += count
+        samples = sum(self.stacks.values()) or 1
+        with open(profile_dir / "export-profile.txt", "w") as summary:
+            summary.write(f"{samples} samples every {self.interval}s\n\n")
+            for title, counts in (("Own time", own), ("Total time", total)):
+                summary.write(f"{title}:\n")
+                for frame, count in counts.most_common(40):
+                    summary.write(f"{100 * count / samples:6.1f}%  {frame}\n")
+                summary.write("\n")
+
+
+class ExportProfiler:
+    """
+    Profile an export with one of PROFILERS, or only time its records if
+    ``profiler`` is None.
+
+    ``start`` may be called more than once; ``stop`` writes the artefacts to
+    a directory and returns their paths.
+    """
+
+    def __init__(self, profiler=None, slow_record_seconds=1.0, interval=0.005):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(
+                f"Unknown profiler {profiler!r}, expected one of {PROFILERS}"
+            )
+        self.profiler = profiler
+        self.slow_record_seconds = slow_record_seconds
+        self.interval = interval
+        self.running = False
+        self.lock = threading.Lock()
+        # The slowest records, as a heap of (seconds, order, entry)
+        self.slowest = []
+        self._order = itertools.count()
+        self.record_count = 0
+        self.slow_count = 0
+        self.record_seconds = 0.0
+        self._started_tracemalloc = False
+        self._profile = None
+        self._sampler = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if self.profiler == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.profiler == "sampling":
+            self._sampler = _Sampler(self.interval)
+            self._sampler.start()
+        elif self.profiler == "tracemalloc" and not tracemalloc.is_tracing():
+            # Left alone if something else started it, and so is stopping it
+            tracemalloc.start(25)
+            self._started_tracemalloc = True
+
+    @contextmanager
+    def time_record(self, faims_record):
+        """
+        Time merging ``faims_record``; the block sets ``result`` on the
+        dict it is given to the merged record.
+        """
+        outcome = {"result": None}
+        start = time.perf_counter()
+        try:
+            yield outcome
+        finally:
+            seconds = time.perf_counter() - start
+            entry = {
+                "record_id": faims_record.get("_id"),
+                "type": faims_record.get("type"),
+                "seconds": seconds,
+                **record_stats(faims_record, outcome["result"]),
+            }
+            with self.lock:
+                self.record_count += 1
+                self.record_seconds += seconds
+                if seconds >= self.slow_record_seconds:
+                    self.slow_count += 1
+                item = (seconds, next(self._order), entry)
+                if len(self.slowest) < SLOW_RECORDS_KEPT:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heappushpop(self.slowest, item)
+            if seconds >= self.slow_record_seconds:
+                log.warning(
+                    f"Slow record {entry['record_id']} took {seconds:.1f}s: "
+                    f"{entry['revisions']} revisions, {entry['heads']} heads, "
+                    f"{entry['attachments']} attachments, "
+                    f"{entry['conflict_history']} conflict history entries"
+                )
+
+    def _write_slow_records(self, profile_dir):
+        with self.lock:
+            slowest = [entry for _, _, entry in sorted(self.slowest, reverse=True)]
+            record_count = self.record_count
+            slow_count = self.slow_count
+            record_seconds = self.record_seconds
+        with open(profile_dir / "slow-records.json", "w") as slow_file:
+            json.dump(
+                {
+                    "records": record_count,
+                    "seconds": record_seconds,
+                    "slow_record_seconds": self.slow_record_seconds,
+                    "slow": slow_count,
+                    "slowest": [
+                        dict(entry, share=entry["seconds"] / (record_seconds or 1))
+                        for entry in slowest
+                    ],
+                },
+                slow_file,
+                indent=2,
+            )
+        return profile_dir / "slow-records.json"
+
+    def stop(self, profile_dir):
+        """
+        Stop profiling and write what was collected to ``profile_dir``.
+        """
+        profile_dir = Path(profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        paths = [self._write_slow_records(profile_dir)]
+        if not self.running:
+            return paths
+        self.running = False
+
+        if self.profiler == "cprofile":
+            self._profile.disable()
+            self._profile.dump_stats(profile_dir / "export.prof")
+            summary = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=summary)
+            stats.sort_stats("cumulative").print_stats(60)
+            stats.sort_stats("tottime").print_stats(40)
+            (profile_dir / "export-profile.txt").write_text(summary.getvalue())
+            paths += [profile_dir / "export.prof", profile_dir / "export-profile.txt"]
+        elif self.profiler == "sampling":
+            self._sampler.stopped.set()
+            self._sampler.join()
+            self._sampler.write(profile_dir)
+            paths += [
+                profile_dir / "export-profile.folded",
+                profile_dir / "export-profile.txt",
+            ]
+        elif self.profiler == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+            snapshot.dump(str(profile_dir / "export.tracemalloc"))
+            with open(profile_dir / "export-tracemalloc.txt", "w") as summary:
+                summary.write(
+                    f"Peak traced memory {peak / 1e6:.1f} MB, "
+                    f"{current / 1e6:.1f} MB still allocated, "
+                    "for the whole process\n\n"
+                )
+                for statistic in snapshot.statistics("lineno")[:50]:
+                    summary.write(f"{statistic}\n")
+            paths += [
+                profile_dir / "export.tracemalloc",
+                profile_dir / "export-tracemalloc.txt",
+            ]
+        log.info(f"Wrote profile to {profile_dir}")
+        return paths
@@ -0,0 +1,215 @@
+"""
+Export many notebooks at once under a shared budget.
+
+``ExportScheduler`` runs ``export_job.run_export`` for each notebook queued,
+at most ``max_exports`` at a time on threads of one process, so the exports
+share:
+
+- one connection pool, with at most ``max_connections`` requests in flight
+  across all servers (each export still gets its own ``requests.Session``,
+  so its metrics only count its own requests);
+- one cache of ui-specifications.
+
+Notebooks are queued per server. Whenever an export finishes, the next one
+comes from the server with the fewest exports running, taking servers in
+turn on a tie, so one server with hundreds of notebooks doesn't hold up the
+others. No server runs more than ``max_per_server`` exports at once.
+
+Concurrent exports always stream (see ``export_csv.export_streaming``), so
+each holds a page of records at a time rather than its notebook's tables, and
+write their files in-process, as forking a pool of writers while other
+exports' threads are running is unsafe.
+"""
+
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from slugify import slugify
+
+from export_job import list_notebooks, make_auth, run_export
+from export_metrics import ExportMetrics
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class _BudgetAdapter(HTTPAdapter):
+    """
+    An adapter allowing ``max_connections`` requests in flight at once.
+
+    The budget is taken while a request is sent and its headers read; a
+    streamed body is read outside it, but the pool itself still blocks at
+    ``max_connections`` connections per server.
+    """
+
+    def __init__(self, max_connections, servers=10):
+        super().__init__(
+            pool_connections=servers, pool_maxsize=max_connections, pool_block=True
+        )
+        self.budget = threading.BoundedSemaphore(max_connections)
+
+    def send(self, request, **kwargs):
+        with self.budget:
+            return super().send(request, **kwargs)
+
+
+class ExportScheduler:
+    """
+    Queue notebooks with ``add`` or ``add_server`` and export them with ``run``.
+
+    ``export_options`` are passed to every ``run_export``. With
+    ``prometheus_dir``, each export also writes its metrics to
+    ``<notebook>.prom`` there.
+    """
+
+    def __init__(
+        self,
+        max_exports=2,
+        max_connections=8,
+        max_per_server=None,
+        prometheus_dir=None,
+        **export_options,
+    ):
+        self.max_exports = max_exports
+        self.max_per_server = max_per_server or max_exports
+        self.prometheus_dir = prometheus_dir and Path(prometheus_dir)
+        if self.prometheus_dir:
+            self.prometheus_dir.mkdir(parents=True, exist_ok=True)
+        self.adapter = _BudgetAdapter(max_connections)
+        self.schema_cache = {}
+        self.export_options = export_options
+        if max_exports > 1:
+            self.export_options.update(streaming=True, workers=1)
+        self.queues = OrderedDict()
+        self.results = []
+
+    def add(self, base_url, notebook_id, bearer_token=None, user=None, password=None):
+        self.queues.setdefault(base_url, deque()).append(
+            {
+                "base_url": base_url,
+                "notebook_id": notebook_id,
+                "bearer_token": bearer_token,
+                "user": user,
+                "password": password,
+            }
+        )
+
+    def add_server(self, base_url, bearer_token=None, user=None, password=None):
+        """
+        Queue every notebook on ``base_url`` visible to the credentials given.
+        """
+        notebooks = list_notebooks(
+            base_url,
+            make_auth(bearer_token, user, password),
+            session=self._session(),
+        )
+        for notebook in notebooks:
+            self.add(base_url, notebook["_id"], bearer_token, user, password)
+        return [notebook["_id"] for notebook in notebooks]
+
+    def _session(self):
+        session = requests.Session()
+        session.mount("http://", self.adapter)
+        session.mount("https://", self.adapter)
+        return session
+
+    def _next(self, active):
+        """
+        Take the next export from the least busy server with any queued.
+        """
+        ready = [
+            base_url
+            for base_url, queue in self.queues.items()
+            if queue and active[base_url] < self.max_per_server
+        ]
+        if not ready:
+            return None
+        base_url = min(ready, key=lambda base_url: active[base_url])
+        # Rotate the server to the back so ties go to the others next time
+        self.queues.move_to_end(base_url)
+        return self.queues[base_url].popleft()
+
+    def _export(self, job):
+        metrics = ExportMetrics()
+        start = time.perf_counter()
+        result = dict(job, archive=None, error=None)
+        del result["bearer_token"], result["password"]
+        if self.prometheus_dir:
+            job = dict(
+                job,
+                prometheus_file=self.prometheus_dir
+                / f"{slugify(job['notebook_id'])}.prom",
+            )
+        try:
+            result["archive"] = run_export(
+                **job,
+                metrics=metrics,
+                session=self._session(),
+                schema_cache=self.schema_cache,
+                **self.export_options,
+            )
+        except Exception as e:
+            log.exception(f"Export of {job['notebook_id']} failed")
+            result["error"] = repr(e)
+        report = metrics.report()
+        result.update(
+            seconds=time.perf_counter() - start,
+            records=report["counts"].get("records", 0),
+            bytes_in=sum(endpoint["bytes_in"] for endpoint in report["http"].values()),
+            requests=sum(endpoint["requests"] for endpoint in report["http"].values()),
+        )
+        return result
+
+    def run(self):
+        """
+        Export everything queued. Returns a result per notebook, with its
+        archive (or error), time taken, records, requests and bytes fetched.
+        """
+        start = time.perf_counter()
+        active = Counter()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_exports) as pool:
+            while True:
+                while len(running) < self.max_exports:
+                    job = self._next(active)
+                    if job is None:
+                        break
+                    active[job["base_url"]] += 1
+                    running[pool.submit(self._export, job)] = job
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    active[job["base_url"]] -= 1
+                    self.results.append(future.result())
+        self.log_throughput(time.perf_counter() - start)
+        return self.results
+
+    def log_throughput(self, wall):
+        totals = Counter()
+        per_server = {}
+        for result in self.results:
+            server = per_server.setdefault(result["base_url"], Counter())
+            for counts in (totals, server):
+                counts.update(
+                    exports=1,
+                    failed=result["error"] is not None,
+                    records=result["records"],
+                    bytes_in=result["bytes_in"],
+                    requests=result["requests"],
+                )
+        for name, counts in [("all servers", totals)] + sorted(per_server.items()):
+            log.info(
+                f"{name}: {counts['exports']} exports ({counts['failed']} failed), "
+                f"{counts['records']} records in {wall:.1f}s "
+                f"({counts['records'] / wall:.1f} records/s, "
+                f"{counts['requests'] / wall:.1f} requests/s, "
+                f"{counts['bytes_in'] / wall / 1e6:.2f} MB/s)"
+            )
@@ -0,0 +1,142 @@
+"""
+Jupyter server extension serving export archives while they are written.
+
+``GET <base_url>export-stream/<path>`` sends the archive at ``output/<path>``,
+in the exporting user's workspace (see ``export_workspace``), chunked. While
+``export_archive.StreamingArchive`` is still writing it, the handler tails
+the ``.part`` file and sends each block as it lands, so the download starts
+straight away and finishes when the export does. If the export fails, or
+the archive stops growing for STALL_TIMEOUT seconds (say the kernel was shut
+down), the connection is dropped so the download ends with an error instead
+of a truncated archive.
+
+Under Jupyter Server it is enabled through ``ServerApp.jpserver_extensions``
+in ``jupyter_config.json``. Standalone Voila doesn't load server extensions,
+so ``runExporter.sh`` starts Voila through ``python export_stream.py``,
+which adds the handler itself.
+"""
+
+import asyncio
+import logging
+import sys
+import time
+from pathlib import Path
+
+import tornado.web
+from jupyter_server.base.handlers import JupyterHandler
+from jupyter_server.utils import url_path_join
+
+from export_archive import ARCHIVE_SUFFIXES, failed_path, partial_path
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+CHUNK_SIZE = 1 << 20
+# Seconds to wait for the archive to grow before reading again
+POLL_INTERVAL = 0.5
+# Seconds without the archive growing before the export is taken for dead
+STALL_TIMEOUT = 30 * 60
+
+CONTENT_TYPES = {".tgz": "application/gzip", ".tar.zst": "application/zstd"}
+
+
+class ExportStreamHandler(JupyterHandler):
+    def initialize(self, output_dir):
+        self.output_dir = output_dir
+
+    def _open(self, archive):
+        # The .part file is renamed once finished, so fall back to the archive
+        for path in (partial_path(archive), archive):
+            try:
+                return open(path, "rb")
+            except FileNotFoundError:
+                continue
+        if failed_path(archive).exists():
+            raise tornado.web.HTTPError(500, reason="The export failed")
+        raise tornado.web.HTTPError(404)
+
+    def _abort(self, archive, why):
+        log.warning(f"Ending the download of {archive.name}: {why}")
+        # Closing the connection mid-response, as finishing it would pass
+        # the truncated archive off as complete
+        self.request.connection.stream.close()
+
+    @tornado.web.authenticated
+    async def get(self, name):
+        suffix = next(
+            (suffix for suffix in ARCHIVE_SUFFIXES.values() if name.endswith(suffix)),
+            None,
+        )
+        archive = (self.output_dir / name).resolve()
+        if suffix is None or not archive.is_relative_to(self.output_dir.resolve()):
+            raise tornado.web.HTTPError(404)
+
+        with self._open(archive) as archive_file:
+            self.set_header("Content-Type", CONTENT_TYPES[suffix])
+            self.set_header(
+                "Content-Disposition", f'attachment; filename="{archive.name}"'
+            )
+            # Send the headers now so the browser starts the download
+            await self.flush()
+            grew = time.monotonic()
+            while True:
+                chunk = archive_file.read(CHUNK_SIZE)
+                if chunk:
+                    self.write(chunk)
+                    await self.flush()
+                    grew = time.monotonic()
+                elif partial_path(archive).exists():
+                    if time.monotonic() - grew > STALL_TIMEOUT:
+                        return self._abort(archive, "the export stopped")
+                    await asyncio.sleep(POLL_INTERVAL)
+                elif failed_path(archive).exists():
+                    return self._abort(archive, "the export failed")
+                else:
+                    # Finished: anything written since the last read is final
+                    while chunk := archive_file.read(CHUNK_SIZE):
+                        self.write(chunk)
+                        await self.flush()
+                    break
+
+
+def _jupyter_server_extension_points():
+    return [{"module": "export_stream"}]
+
+
+def add_handlers(web_app, root_dir):
+    """
+    Serve ``<root_dir>/output`` under ``export-stream/`` on ``web_app``.
+    """
+    route = url_path_join(web_app.settings["base_url"], "export-stream", "(.+)")
+    web_app.add_handlers(
+        ".*$",
+        [(route, ExportStreamHandler, {"output_dir": Path(root_dir) / "output"})],
+    )
+
+
+def _load_jupyter_server_extension(serverapp):
+    add_handlers(serverapp.web_app, serverapp.root_dir)
+
+
+def main(argv=None):
+    """
+    Run standalone Voila, as the ``voila`` command does, with the handler.
+    """
+    # Voila's config file, voila.py, sits next to this module and would be
+    # imported in place of the voila package
+    here = Path(__file__).resolve().parent
+    sys.path[:] = [path for path in sys.path if Path(path or ".").resolve() != here]
+    from voila.app import Voila
+
+    class ExporterVoila(Voila):
+        def listen(self):
+            # The app and its handlers are set up by now, but not yet served
+            add_handlers(self.app, self.root_dir)
+            super().listen()
+
+    ExporterVoila.launch_instance(argv)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
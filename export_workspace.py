@@ -0,0 +1,340 @@
+"""
+Per-job workspaces under the shared output directory.
+
+Every export gets a directory of its own, ``<root>/users/<user>/<job id>``,
+for the export, its backup and its archive, so users (and one user's
+concurrent exports) never touch each other's files:
+
+- ``job.json`` describes the job: notebook, server, state, times, archive;
+- a lock on ``.lock`` is held while the job runs, so garbage collection and
+  other jobs, in this process or another, leave the workspace alone;
+- finished archives are listed in the user's ``index.json``, so listing a
+  user's downloads reads one small file instead of globbing everyone's.
+
+With ``resume``, a new job adopts the newest interrupted workspace of the
+same user and notebook, so checkpointed exports carry on where they stopped.
+
+Workspaces untouched for ``ttl`` seconds are garbage collected, at most
+every GC_INTERVAL seconds, when a job is created. A user whose finished
+exports take more than ``quota`` bytes loses the oldest of them when
+starting another.
+"""
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from slugify import slugify
+
+from export_checkpoint import has_checkpoint
+from export_job import export_path_for
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+WORKSPACE_DIR = "users"
+JOB_FILE = "job.json"
+INDEX_FILE = "index.json"
+LOCK_FILE = ".lock"
+# Seconds a workspace is kept after it was last touched
+DEFAULT_TTL = 7 * 24 * 3600
+# Minimum seconds between garbage collections
+GC_INTERVAL = 3600
+
+
+def _read_json(path, default):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def _write_json(path, value):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+    with open(tmp_path, "w") as json_file:
+        json.dump(value, json_file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def directory_size(path):
+    return sum(
+        entry.lstat().st_size for entry in Path(path).rglob("*") if entry.is_file()
+    )
+
+
+class _Lock:
+    """
+    An exclusive ``flock`` on ``path``, which also excludes other threads of
+    this process as each lock opens the file afresh. A no-op without fcntl.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=True):
+        self.file = open(self.path, "a")
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Workspace:
+    """
+    The directory of one job, locked until ``close``. Use ``path`` as the
+    ``output_dir`` of the export.
+    """
+
+    def __init__(self, manager, user, path, info, lock):
+        self.manager = manager
+        self.user = user
+        self.path = path
+        self.info = info
+        self.lock = lock
+
+    @property
+    def job_id(self):
+        return self.path.name
+
+    @property
+    def resumed(self):
+        return self.info["runs"] > 1
+
+    def save(self):
+        self.info["updated"] = _now()
+        _write_json(self.path / JOB_FILE, self.info)
+
+    def close(self, state, archive=None):
+        """
+        Record how the job ended and unlock the workspace. A finished
+        archive is added to the user's index and the export files it holds
+        are removed.
+        """
+        self.info["state"] = state
+        if state == "done" and archive is not None and Path(archive).exists():
+            shutil.rmtree(
+                export_path_for(
+                    self.path, self.info["base_url"], self.info["notebook_id"]
+                ),
+                ignore_errors=True,
+            )
+            self.info["archive"] = str(Path(archive).relative_to(self.manager.root))
+            self.info["finished"] = _now()
+            self.info["bytes"] = directory_size(self.path)
+        self.save()
+        if "archive" in self.info:
+            self.manager.update_index(
+                self.manager.user_dir(self.user), {self.job_id: self.info}
+            )
+        self.lock.release()
+
+
+class WorkspaceManager:
+    """
+    Hands out workspaces under ``root``, and keeps each user's index of
+    finished archives.
+    """
+
+    def __init__(self, root, ttl=DEFAULT_TTL, quota=None):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.quota = quota
+
+    def user_dir(self, user):
+        return self.root / WORKSPACE_DIR / slugify(user)
+
+    def _try_lock(self, path):
+        lock = _Lock(path / LOCK_FILE)
+        return lock if lock.acquire(blocking=False) else None
+
+    def create(self, user, base_url, notebook_id, resume=True):
+        """
+        Make and lock a workspace for exporting ``notebook_id``, or with
+        ``resume`` adopt an interrupted one.
+        """
+        self.maybe_collect_garbage()
+        user_dir = self.user_dir(user)
+        if resume:
+            workspace = self._adopt(user, base_url, notebook_id)
+            if workspace is not None:
+                return workspace
+        if self.quota is not None:
+            self._enforce_quota(user)
+        timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        path = user_dir / f"{timestamp}-{uuid.uuid4().hex[:8]}"
+        path.mkdir(parents=True)
+        workspace = Workspace(
+            self,
+            user,
+            path,
+            {
+                "user": user,
+                "base_url": base_url,
+                "notebook_id": notebook_id,
+                "state": "running",
+                "created": _now(),
+                "runs": 1,
+            },
+            self._try_lock(path),
+        )
+        workspace.save()
+        return workspace
+
+    def _jobs(self, user):
+        """
+        The user's workspaces with their job.json, newest first.
+        """
+        user_dir = self.user_dir(user)
+        if not user_dir.exists():
+            return []
+        jobs = []
+        for path in sorted(user_dir.iterdir(), reverse=True):
+            if path.is_dir():
+                jobs.append((path, _read_json(path / JOB_FILE, {})))
+        return jobs
+
+    def _adopt(self, user, base_url, notebook_id):
+        for path, info in self._jobs(user):
+            if (
+                info.get("base_url") != base_url
+                or info.get("notebook_id") != notebook_id
+                or info.get("state") == "done"
+                or not has_checkpoint(export_path_for(path, base_url, notebook_id))
+            ):
+                continue
+            lock = self._try_lock(path)
+            if lock is None:
+                # Another job is running in it
+                continue
+            info.update(state="running", runs=info.get("runs", 1) + 1)
+            workspace = Workspace(self, user, path, info, lock)
+            workspace.save()
+            log.info(f"Resuming the export in {path}")
+            return workspace
+        return None
+
+    def update_index(self, user_dir, entries=None, remove=()):
+        """
+        Add ``entries`` to the index in ``user_dir`` and drop the jobs in
+        ``remove``.
+        """
+        user_dir.mkdir(parents=True, exist_ok=True)
+        with _Lock(user_dir / f"{INDEX_FILE}.lock"):
+            index = _read_json(user_dir / INDEX_FILE, {})
+            index.update(entries or {})
+            for job_id in remove:
+                index.pop(job_id, None)
+            _write_json(user_dir / INDEX_FILE, index)
+        return index
+
+    def downloads(self, user):
+        """
+        The user's finished exports, newest first, with the path of each
+        archive under ``root`` as ``archive``.
+        """
+        index = _read_json(self.user_dir(user) / INDEX_FILE, {})
+        return sorted(
+            (
+                dict(info, job_id=job_id)
+                for job_id, info in index.items()
+                if (self.root / info["archive"]).exists()
+            ),
+            key=lambda info: info["finished"],
+            reverse=True,
+        )
+
+    def _enforce_quota(self, user):
+        downloads = self.downloads(user)
+        usage = sum(info.get("bytes", 0) for info in downloads)
+        evicted = []
+        while usage > self.quota and downloads:
+            oldest = downloads.pop()
+            if self._remove(self.user_dir(user) / oldest["job_id"]):
+                usage -= oldest.get("bytes", 0)
+                evicted.append(oldest["job_id"])
+        if evicted:
+            log.info(f"Removed {len(evicted)} old exports of {user} over quota")
+            self.update_index(self.user_dir(user), remove=evicted)
+
+    def _remove(self, path):
+        lock = self._try_lock(path)
+        if lock is None:
+            return False
+        try:
+            shutil.rmtree(path)
+        finally:
+            lock.release()
+        return True
+
+    def maybe_collect_garbage(self):
+        stamp = self.root / WORKSPACE_DIR / ".gc"
+        try:
+            if time.time() - stamp.stat().st_mtime < GC_INTERVAL:
+                return
+        except FileNotFoundError:
+            pass
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        stamp.touch()
+        self.collect_garbage()
+
+    def collect_garbage(self, now=None):
+        """
+        Remove the workspaces not touched for ``ttl`` seconds, unless a job
+        is running in them. Returns the paths removed.
+        """
+        now = time.time() if now is None else now
+        workspace_dir = self.root / WORKSPACE_DIR
+        if not workspace_dir.exists():
+            return []
+        removed = []
+        for user_dir in workspace_dir.iterdir():
+            if not user_dir.is_dir():
+                continue
+            expired = []
+            for path in user_dir.iterdir():
+                if not path.is_dir():
+                    continue
+                job_file = path / JOB_FILE
+                touched = (job_file if job_file.exists() else path).stat().st_mtime
+                if now - touched > self.ttl and self._remove(path):
+                    expired.append(path.name)
+                    removed.append(path)
+            if expired:
+                self.update_index(user_dir, remove=expired)
+        if removed:
+            log.info(f"Removed {len(removed)} expired export workspaces")
+        return removed
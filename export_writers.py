@@ -0,0 +1,510 @@
+"""
+Writers for the files ``export_csv`` produces for each form.
+
+``StreamingFormWriter`` and ``XLSXFormWriter`` write flattened records as they
+come off the merge, one row at a time, instead of building a DataFrame per
+form first. The ``write_*`` functions write a whole form, either from its
+DataFrame or from a streaming export's JSON Lines spool.
+"""
+
+import csv
+import datetime
+import json
+import logging
+import os
+from xml.sax.saxutils import escape
+
+from slugify import slugify
+
+# Rows per worksheet, including the header row
+EXCEL_MAX_ROWS = 1048576
+
+
+def iter_spool_rows(jsonl_path, datetime_columns=()):
+    """
+    Read rows back from a JSON Lines spool written by ``StreamingFormWriter``.
+
+    ``datetime_columns`` are turned back into datetimes instead of their
+    string form.
+    """
+    with open(jsonl_path) as jsonl_file:
+        for line in jsonl_file:
+            row = json.loads(line)
+            for column in datetime_columns:
+                if row.get(column):
+                    row[column] = datetime.datetime.fromisoformat(row[column])
+            yield row
+
+
+def _is_blank(value):
+    """
+    None, NaN and NaT are written as empty cells.
+    """
+    if isinstance(value, (float, datetime.datetime)):
+        return value != value
+    return value is None
+
+
+def _is_hidden(column, annotated, certain, rows):
+    """
+    Mirror the ``hide_empty`` rules of ``CouchDBHelper.flatten_records``.
+    """
+    if column.endswith("annotation"):
+        return column not in annotated
+    if column.endswith("certainty"):
+        return certain.get(column, 0) == rows
+    return False
+
+
+class StreamingFormWriter:
+    """
+    Stream the rows of one form to ``<name>.csv`` and ``<name>.jsonl``.
+
+    The CSV header is the form's planned columns (see
+    ``CouchDBHelper.get_header_plan``) and rows hit disk as soon as they are
+    written. Columns first seen later, empty annotation/certainty columns and
+    rows needing a patch (unresolved relationships) are dealt with by
+    ``finalise``, which regenerates the CSV from the JSON Lines spool one row
+    at a time, so memory never depends on the size of the form.
+    """
+
+    def __init__(
+        self,
+        form_path,
+        name,
+        planned_columns,
+        hide_empty=True,
+        state=None,
+        truncate=True,
+    ):
+        form_path.mkdir(parents=True, exist_ok=True)
+        self.csv_path = form_path / f"{name}.csv"
+        self.jsonl_path = form_path / f"{name}.jsonl"
+        self.hide_empty = hide_empty
+        self.header = list(planned_columns)
+        self.columns = list(planned_columns)
+        self.seen = set()
+        self.annotated = set()
+        self.certain = {}
+        self.datetime_columns = set()
+        self.rows = 0
+        self.pending = 0
+
+        if state is not None:
+            # Carry on from a checkpoint, dropping rows written after it
+            self.header = state["header"]
+            self.columns = state["columns"]
+            self.seen = set(state["seen"])
+            self.annotated = set(state["annotated"])
+            self.certain = state["certain"]
+            self.datetime_columns = set(state["datetime_columns"])
+            self.rows = state["rows"]
+            self.pending = state["pending"]
+            if truncate:
+                os.truncate(self.csv_path, state["csv_size"])
+                os.truncate(self.jsonl_path, state["jsonl_size"])
+
+        self.csv_file = open(self.csv_path, "w" if state is None else "a", newline="")
+        self.csv_writer = csv.DictWriter(
+            self.csv_file,
+            fieldnames=self.header,
+            extrasaction="ignore",
+            lineterminator="\n",
+        )
+        if state is None:
+            self.csv_writer.writeheader()
+        self.jsonl_file = open(self.jsonl_path, "w" if state is None else "a")
+
+    def write(self, row, pending=False):
+        """
+        Write a flattened row. ``pending`` rows are passed to the ``patch``
+        given to ``finalise`` before the final files are produced.
+        """
+        for column, value in row.items():
+            if column not in self.seen:
+                self.seen.add(column)
+                if column not in self.header:
+                    self.columns.append(column)
+            if value is not None and column.endswith("annotation"):
+                self.annotated.add(column)
+            if value is False and column.endswith("certainty"):
+                self.certain[column] = self.certain.get(column, 0) + 1
+            if isinstance(value, datetime.datetime):
+                self.datetime_columns.add(column)
+        self.rows += 1
+        self.pending += pending
+        self.csv_writer.writerow(row)
+        self.jsonl_file.write(json.dumps(row, default=str))
+        self.jsonl_file.write("\n")
+
+    def checkpoint(self):
+        """
+        Flush the files and return the state needed to carry on writing them.
+        """
+        self.csv_file.flush()
+        self.jsonl_file.flush()
+        return {
+            "header": self.header,
+            "columns": self.columns,
+            "seen": sorted(self.seen),
+            "annotated": sorted(self.annotated),
+            "certain": self.certain,
+            "datetime_columns": sorted(self.datetime_columns),
+            "rows": self.rows,
+            "pending": self.pending,
+            "csv_size": os.path.getsize(self.csv_path),
+            "jsonl_size": os.path.getsize(self.jsonl_path),
+        }
+
+    def iter_rows(self, parse_dates=False):
+        """
+        Read the rows back from the JSON Lines spool.
+        """
+        return iter_spool_rows(
+            self.jsonl_path, self.datetime_columns if parse_dates else ()
+        )
+
+    @property
+    def final_columns(self):
+        return [
+            column
+            for column in self.columns
+            if column in self.seen
+            and not (
+                self.hide_empty
+                and _is_hidden(column, self.annotated, self.certain, self.rows)
+            )
+        ]
+
+    def finalise(self, patch=None):
+        """
+        Close the files, regenerating them if the header or any row changed.
+
+        Returns the paths written.
+        """
+        self.csv_file.close()
+        self.jsonl_file.close()
+
+        columns = self.final_columns
+        if columns == self.header and not (self.pending and patch):
+            return [self.csv_path, self.jsonl_path]
+
+        csv_tmp = self.csv_path.with_suffix(".csv.tmp")
+        jsonl_tmp = self.jsonl_path.with_suffix(".jsonl.tmp")
+        with open(csv_tmp, "w", newline="") as csv_file, open(
+            jsonl_tmp, "w"
+        ) as jsonl_file:
+            csv_writer = csv.DictWriter(
+                csv_file,
+                fieldnames=columns,
+                extrasaction="ignore",
+                lineterminator="\n",
+            )
+            csv_writer.writeheader()
+            for row in self.iter_rows():
+                if patch and self.pending:
+                    patch(row)
+                csv_writer.writerow(row)
+                jsonl_file.write(json.dumps(row, default=str))
+                jsonl_file.write("\n")
+        os.replace(csv_tmp, self.csv_path)
+        os.replace(jsonl_tmp, self.jsonl_path)
+        self.header = columns
+        return [self.csv_path, self.jsonl_path]
+
+
+class XLSXFormWriter:
+    """
+    Write rows to an .xlsx workbook using xlsxwriter's ``constant_memory`` mode.
+
+    Each row is flushed to disk as soon as the next one starts, so the
+    workbook is never held in memory. Forms with more rows than a worksheet
+    can hold carry on in further worksheets, each starting with the header.
+    Datetimes are written as native Excel dates with their timezone removed.
+    """
+
+    def __init__(self, path, columns):
+        # Imported here as exports without spreadsheets don't need it
+        import xlsxwriter
+
+        self.path = path
+        self.columns = list(columns)
+        self.workbook = xlsxwriter.Workbook(
+            path,
+            {
+                "constant_memory": True,
+                "remove_timezone": True,
+                "default_date_format": "yyyy-mm-dd hh:mm:ss",
+                "strings_to_urls": False,
+                "nan_inf_to_errors": True,
+            },
+        )
+        self.worksheet = None
+        self.sheets = 0
+        self.row = EXCEL_MAX_ROWS
+
+    def _new_worksheet(self):
+        self.sheets += 1
+        self.worksheet = self.workbook.add_worksheet(f"Sheet{self.sheets}")
+        self.worksheet.write_row(0, 0, self.columns)
+        self.row = 1
+
+    def write(self, values):
+        """
+        Write one row of values, in the same order as ``columns``.
+        """
+        if self.row >= EXCEL_MAX_ROWS:
+            self._new_worksheet()
+        for column, value in enumerate(values):
+            if _is_blank(value):
+                continue
+            if isinstance(value, (list, dict)):
+                value = str(value)
+            self.worksheet.write(self.row, column, value)
+        self.row += 1
+
+    def write_dict(self, row):
+        self.write([row.get(column) for column in self.columns])
+
+    def close(self):
+        if self.worksheet is None:
+            self._new_worksheet()
+        self.workbook.close()
+        return self.path
+
+
+def write_dataframe_xlsx(dataframe, path):
+    """
+    Write a DataFrame, index included, with ``XLSXFormWriter``.
+    """
+    index_name = dataframe.index.name or ""
+    writer = XLSXFormWriter(path, [index_name] + list(dataframe.columns))
+    for values in dataframe.itertuples(index=True, name=None):
+        writer.write(values)
+    return writer.close()
+
+
+def write_attachments(project_path, attachments):
+    """
+    Write decoded attachments from ``flatten_record`` under ``project_path``.
+
+    Returns the paths written.
+    """
+    paths = []
+    for attachment in attachments:
+        filename = attachment["filename"]
+        data = attachment["data"]
+        attachment_path = project_path / attachment["path"]
+        if data:
+            attachment_path.mkdir(parents=True, exist_ok=True)
+        with open(attachment_path / filename, "wb") as attach:
+            attach.write(data)
+        paths.append(attachment_path / filename)
+    return paths
+
+
+# File extension of each geometry format
+GEO_FORMATS = {"geojson": "geojson", "geojsonseq": "geojsonl", "kml": "kml"}
+
+
+class GeoJSONStreamWriter:
+    """
+    Write features one at a time as a FeatureCollection or, with ``sequence``,
+    as newline-delimited GeoJSON (GeoJSONSeq) with one feature per line.
+
+    Features are passed in already serialised, so nothing is held in memory.
+    """
+
+    def __init__(self, path, sequence=False):
+        self.path = path
+        self.sequence = sequence
+        self.count = 0
+        self.file = open(path, "w")
+        if not sequence:
+            self.file.write('{"type": "FeatureCollection", "features": [\n')
+
+    def write(self, feature_json):
+        if self.sequence:
+            self.file.write(feature_json)
+            self.file.write("\n")
+        else:
+            if self.count:
+                self.file.write(",\n")
+            self.file.write(feature_json)
+        self.count += 1
+
+    def close(self):
+        if not self.sequence:
+            self.file.write("\n]}\n")
+        self.file.close()
+        return self.path
+
+
+def _kml_coordinates(positions):
+    return " ".join(",".join(str(x) for x in position) for position in positions)
+
+
+class KMLStreamWriter:
+    """
+    Write features one at a time as KML Placemarks.
+
+    Points, LineStrings and Polygons (with their holes) are supported, other
+    geometry types are logged and skipped.
+    """
+
+    def __init__(self, path, name):
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+            f"<Document><name>{escape(name)}</name>\n"
+        )
+
+    def write(self, feature, description):
+        geom = feature["geometry"]
+        geom_type = geom["type"]
+        if geom_type == "Point":
+            body = (
+                "<Point><coordinates>"
+                f"{_kml_coordinates([geom['coordinates']])}"
+                "</coordinates></Point>"
+            )
+        elif geom_type == "LineString":
+            body = (
+                "<LineString><coordinates>"
+                f"{_kml_coordinates(geom['coordinates'])}"
+                "</coordinates></LineString>"
+            )
+        elif geom_type == "Polygon":
+            outer, *inner = geom["coordinates"]
+            body = (
+                "<Polygon><outerBoundaryIs><LinearRing><coordinates>"
+                f"{_kml_coordinates(outer)}"
+                "</coordinates></LinearRing></outerBoundaryIs>"
+            )
+            for ring in inner:
+                body += (
+                    "<innerBoundaryIs><LinearRing><coordinates>"
+                    f"{_kml_coordinates(ring)}"
+                    "</coordinates></LinearRing></innerBoundaryIs>"
+                )
+            body += "</Polygon>"
+        else:
+            logging.error(f"ERROR: unknown type: {geom_type}")
+            return
+        self.file.write(
+            f"<Placemark><name>{escape(str(feature.get('id')))}</name>"
+            f"<description>{escape(description)}</description>{body}</Placemark>\n"
+        )
+
+    def close(self):
+        self.file.write("</Document>\n</kml>\n")
+        self.file.close()
+        return self.path
+
+
+def write_geometries(rows, shape_path, geo_formats):
+    """
+    Write every geometry field found in ``rows`` in each of ``geo_formats``.
+
+    Each geometry column (``<field>.geojson``) gets one file per format, named
+    after the field. Features are streamed out as the rows go past, with the
+    row attached as ``record_data``; each feature is serialised once and
+    reused for every GeoJSON format.
+
+    Returns the paths written.
+    """
+    writers = {}
+    for row in rows:
+        properties_json = None
+        for column, value in row.items():
+            if not column.endswith(".geojson") or not isinstance(value, str):
+                continue
+            if properties_json is None and "kml" in geo_formats:
+                properties_json = json.dumps(row, default=str)
+            item_name = slugify(column[: -len(".geojson")], lowercase=False)
+            if item_name not in writers:
+                shape_path.mkdir(parents=True, exist_ok=True)
+                writers[item_name] = {}
+                for geo_format in geo_formats:
+                    path = shape_path / f"{item_name}.{GEO_FORMATS[geo_format]}"
+                    if geo_format == "kml":
+                        writers[item_name][geo_format] = KMLStreamWriter(
+                            path, item_name
+                        )
+                    else:
+                        writers[item_name][geo_format] = GeoJSONStreamWriter(
+                            path, sequence=geo_format == "geojsonseq"
+                        )
+            feature = json.loads(value)
+            feature_json = None
+            for geo_format, writer in writers[item_name].items():
+                if geo_format == "kml":
+                    writer.write(feature, properties_json)
+                    continue
+                if feature_json is None:
+                    feature_json = json.dumps(
+                        dict(feature, record_data=row), default=str
+                    )
+                writer.write(feature_json)
+    return [
+        writer.close()
+        for item_writers in writers.values()
+        for writer in item_writers.values()
+    ]
+
+
+def iter_dataframe_rows(dataframe):
+    """
+    Yield a DataFrame's rows as dicts, with NaN and NaT as None.
+
+    A named index (``metadata.identifier``) is included as a column.
+    """
+    columns = list(dataframe.columns)
+    if dataframe.index.name:
+        columns.insert(0, dataframe.index.name)
+    for values in dataframe.itertuples(index=bool(dataframe.index.name), name=None):
+        yield {
+            column: None if _is_blank(value) else value
+            for column, value in zip(columns, values)
+        }
+
+
+def write_form_table(dataframe, form_path, name, table_format):
+    """
+    Write a form's DataFrame as one of ``export_csv.FORMATS``.
+
+    Returns the paths written.
+    """
+    path = form_path / f"{name}.{table_format}"
+    if table_format == "csv":
+        dataframe.to_csv(path)
+    elif table_format == "json":
+        dataframe.to_json(path)
+    elif table_format == "xlsx":
+        write_dataframe_xlsx(dataframe, path)
+    else:
+        raise ValueError(f"Unknown format: {table_format}")
+    return [path]
+
+
+def write_spool_xlsx(jsonl_path, xlsx_path, columns, datetime_columns=()):
+    """
+    Build a form's spreadsheet from its JSON Lines spool.
+
+    Returns the paths written.
+    """
+    xlsx_writer = XLSXFormWriter(xlsx_path, columns)
+    for row in iter_spool_rows(jsonl_path, datetime_columns):
+        xlsx_writer.write_dict(row)
+    return [xlsx_writer.close()]
+
+
+def write_spool_geometries(jsonl_path, shape_path, geo_formats):
+    """
+    Write every geometry field of a form from its JSON Lines spool.
+
+    Returns the paths written.
+    """
+    return write_geometries(iter_spool_rows(jsonl_path), shape_path, geo_formats)
@@ -7,11 +7,14 @@ from uuid import uuid4
 import base64
 import traceback
 from slugify import slugify
-from collections import OrderedDict, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 import datetime
+from itertools import islice
 import geojson
 import json
-from shapely.geometry import shape
+import random
+import time
+from export_metrics import ExportMetrics
 from pprint import pprint
 
 # from flatten_json import flatten
@@ -19,12 +22,40 @@ from pprint import pprint
 from pprint import pformat
 import logging
 import tempfile
-import pandas
 
 from mimetypes import guess_extension, guess_type
 
 LOCAL_TIMEZONE = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
 
+# Flattened column order of record metadata and geometry values, see flatten_record
+METADATA_COLUMNS = [
+    "identifier",
+    "record_type",
+    "updated_at",
+    "updated_by",
+    "in_conflict",
+    "deleted",
+    "record_id",
+    "updates",
+    "record_name",
+]
+GEOMETRY_COLUMNS = [
+    "geojson",
+    "wkt",
+    "y_latitude",
+    "x_longitude",
+    "accuracy",
+    "timestamp",
+]
+# Updates sent per batch by CouchDBHelper.bulk_update_records
+BULK_UPDATE_BATCH = 200
+# Retries of records in conflict, and seconds before the first, in
+# CouchDBHelper.update_record_heads
+RECORD_HEAD_RETRIES = 5
+RECORD_HEAD_BACKOFF = 0.1
+# Prefix of the ids of attachment documents
+ATTACHMENT_PREFIX = "att-"
+
 
 class TqdmLoggingHandler(logging.Handler):
     # https://stackoverflow.com/a/38739634
@@ -89,6 +120,30 @@ def create_new_avp(
     return avp
 
 
+def add_revision_to_record(record, base_revision_ids, new_revision_id):
+    """
+    Point a record document at a new revision, a child of the
+    ``base_revision_ids``, in place. Returns whether the record changed: it
+    doesn't if it already has the new revision.
+    """
+    revisions = record["revisions"]
+    logging.debug(pformat(revisions))
+    logging.debug(pformat(base_revision_ids))
+    if new_revision_id in revisions:
+        return False
+    if not set(revisions) >= set(base_revision_ids):
+        # checking if base revision ids is a strict subset. This seems... wrong?
+        # @aragilar double check your logic. I've added a >= so this doesn't fail,
+        #   but I'm not quite sure what you're cehcking here. I also had to cast
+        #   base_revision_ids because set > list fails.
+        raise ValueError("The base revisions are not all existing revisions")
+    record["revisions"] = revisions + [new_revision_id]
+    record["heads"] = [
+        head for head in record["heads"] if head not in base_revision_ids
+    ] + [new_revision_id]
+    return True
+
+
 class BearerAuth(requests.auth.AuthBase):
     # https://stackoverflow.com/a/58055668
     def __init__(self, token):
@@ -99,7 +154,29 @@ class BearerAuth(requests.auth.AuthBase):
         return r
 
 
+def flatten_row(record):
+    """
+    Flatten a record from ``flatten_record`` into a single row.
+
+    Nested dicts are joined with "." exactly as ``pandas.json_normalize`` does
+    in ``flatten_records``, so streamed rows and DataFrames share column names.
+    """
+    row = {}
+
+    def flatten(prefix, value):
+        for key, item in value.items():
+            column = f"{prefix}.{key}" if prefix else key
+            if isinstance(item, dict):
+                flatten(column, item)
+            else:
+                row[re.sub(".data.value", "", column)] = item
+
+    flatten("", record)
+    return row
+
+
 class CouchDBHelper:
+
     def __init__(
         self,
         *,
@@ -110,7 +187,20 @@ class CouchDBHelper:
         include_deleted=False,
         for_export=True,
         bearer_token=None,
+        session=None,
+        metrics=None,
+        profiler=None,
+        schema_cache=None,
     ):
+        """
+        ``session`` is the ``requests.Session`` to make requests through, and
+        ``metrics`` an ``export_metrics.ExportMetrics`` that records them.
+        ``profiler`` is an ``export_profiling.ExportProfiler``, started here
+        and timing every record merged; stopping it is up to the caller.
+        ``schema_cache`` is a dict of ui-specifications by url, which may be
+        shared between helpers, and outlive them: a cached specification is
+        revalidated by its ETag before it is used.
+        """
         self.user = user
         self.token = token
         self.bearer_token = bearer_token
@@ -128,6 +218,16 @@ class CouchDBHelper:
         self.include_deleted = include_deleted
         self.identifiers = {}
         self.forms_from_record_id = {}
+        # Record types left out of merging, as their output was reused
+        self.skip_record_types = set()
+        self.session = session or requests.Session()
+        self.metrics = metrics or ExportMetrics()
+        self.metrics.instrument(self.session)
+        self.profiler = profiler
+        self.schema_cache = {} if schema_cache is None else schema_cache
+        self.ui_specification = None
+        if profiler is not None:
+            profiler.start()
         project_url = f"{self.base_url}/projects/{project_key}"
         """
         Initialise by getting project data, and project metadata keys and project id
@@ -138,7 +238,7 @@ class CouchDBHelper:
             self.auth_token = BearerAuth(bearer_token)
 
         # logging.debug(f"Initialising with {project_url}")
-        r = requests.get(project_url, auth=self.auth_token)
+        r = self.session.get(project_url, auth=self.auth_token)
         r.raise_for_status()
 
         project_data = r.json()
@@ -178,11 +278,37 @@ class CouchDBHelper:
         #     r = requests.get(url, headers= {"Authorization": f"Bearer {self.bearer_token}"})
         #     r.raise_for_status()
         #     return r
-        r = requests.get(url, auth=self.auth_token)
+        r = self.session.get(url, auth=self.auth_token)
         r.raise_for_status()
         return r
         raise ValueError("Unable to authenticate with credentials provided")
 
+    def get_ui_specification(self):
+        """
+        Fetch the project's ui-specification, once per helper.
+
+        A copy in ``schema_cache`` with an ETag is only fetched again if
+        CouchDB says it changed, so the request costs no body or parsing.
+        """
+        if self.ui_specification is not None:
+            return self.ui_specification
+        url = f"{self.base_url}/{self.metadata}/ui-specification"
+        cached = self.schema_cache.get(url)
+        headers = {}
+        if cached is not None and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        r = self.session.get(url, auth=self.auth_token, headers=headers)
+        if r.status_code == 304:
+            self.ui_specification = cached["specification"]
+        else:
+            r.raise_for_status()
+            self.ui_specification = r.json()
+            self.schema_cache[url] = {
+                "etag": r.headers.get("ETag"),
+                "specification": self.ui_specification,
+            }
+        return self.ui_specification
+
     def get_multivalued_fields(self):
         """
         Get field names of fields which support multiple stored values.
@@ -191,14 +317,10 @@ class CouchDBHelper:
         fields and their possible values.
         """
         multivalued_fields = {}
-        url = f"{self.base_url}/{self.metadata}/ui-specification"
+        ui_specification = self.get_ui_specification()
 
-        # r = requests.get(url, auth=(self.user, self.token))
-        # r.raise_for_status()
-        r = self.make_request_get(url)
-
-        for element in r.json()["fields"]:
-            data = r.json()["fields"][element]
+        for element in ui_specification["fields"]:
+            data = ui_specification["fields"][element]
             if data["component-parameters"].get("SelectProps", {}).get("multiple"):
                 # print("multi", data)
 
@@ -221,25 +343,28 @@ class CouchDBHelper:
 
         human_dict_name_map = {}
         record_type_names = {}
+        form_fields = {}
         field_types = {}
         field_metadata = {}
         views = {}
         record_types = defaultdict(OrderedDict)
         element_hierarchy = defaultdict(defaultdict)
         dupe_check = defaultdict(list)
-        url = f"{self.base_url}/{self.metadata}/ui-specification"
-
-        # r = requests.get(url, auth=(self.user, self.token))
-        # r.raise_for_status()
-        r = self.make_request_get(url)
+        ui_specification = self.get_ui_specification()
 
-        for record in r.json()["viewsets"]:
-            label = r.json()["viewsets"][record]["label"]
+        for record in ui_specification["viewsets"]:
+            label = ui_specification["viewsets"][record]["label"]
             record_type_names[record] = label
             logging.debug(f"{record=}{label=}")
+            form_fields[record] = []
+            for view in ui_specification["viewsets"][record].get("views", []):
+                view_fields = (
+                    ui_specification.get("fviews", {}).get(view, {}).get("fields")
+                )
+                form_fields[record] += view_fields or []
 
-        for element in r.json()["fields"]:
-            data = r.json()["fields"][element]
+        for element in ui_specification["fields"]:
+            data = ui_specification["fields"][element]
             human_element = (
                 data["component-parameters"]
                 .get("InputLabelProps", {})
@@ -304,6 +429,36 @@ class CouchDBHelper:
         self.field_metadata = field_metadata
         self.element_hierarchy = element_hierarchy
         self.record_type_names = record_type_names
+        self.form_fields = form_fields
+
+    def get_header_plan(self):
+        """
+        Plan the flattened columns of every form from the ui-specification.
+
+        Returns a dict of record names to column lists, in the order
+        ``flatten_row`` produces them. Columns that only appear in the data
+        (conflicts, relationships, per-field users) are not planned.
+        """
+        header_plan = {}
+        for record_type, elements in self.form_fields.items():
+            columns = [f"metadata.{column}" for column in METADATA_COLUMNS]
+            for element in elements:
+                data = self.field_metadata.get(element)
+                if not data:
+                    continue
+                label = self.field_mapping.get(element, element)
+                if data["type-returned"] == "faims-pos::Location":
+                    columns += [f"{label}.{column}" for column in GEOMETRY_COLUMNS]
+                else:
+                    columns.append(label)
+                if data.get("meta", {}).get("annotation"):
+                    columns.append(f"{label}.data.annotation")
+                if data.get("meta", {}).get("uncertainty", {}).get("include"):
+                    columns.append(f"{label}.data.uncertainty")
+                if data["type-returned"] == "faims-attachment::Files":
+                    columns.append(f"{label}.attached_files")
+            header_plan[self.record_type_names[record_type]] = columns
+        return header_plan
 
     def get_records(self):
         """
@@ -315,43 +470,155 @@ class CouchDBHelper:
         be ``created`` and ``created_by`` to find out who created the record
         initially.
         """
+        return list(self.iter_record_docs())
+
+    def _find_fields(self, selector, fields=None, limit=25):
+        """
+        Yield the documents matching ``selector`` a ``_find`` page at a time,
+        with only ``fields`` of them if given.
+        """
         url = f"{self.base_url}/{self.project}/_find"
-        limit = 25
-        result = []
+        query = {"selector": selector, "limit": limit}
+        if fields is not None:
+            query["fields"] = fields
+        bookmark = None
+        while True:
+            r = self.session.post(
+                url, auth=self.auth_token, json=dict(query, bookmark=bookmark)
+            )
+            r.raise_for_status()
+            page = r.json()
+            yield from page["docs"]
+            # A bookmark is returned even on the last page, which is the
+            # first one with fewer than ``limit`` results
+            # https://docs.couchdb.org/en/stable/api/database/find.html#pagination
+            if len(page["docs"]) < limit:
+                return
+            bookmark = page["bookmark"]
+
+    def iter_record_docs(self, limit=25):
+        """
+        Yield the project's record documents a ``_find`` page at a time.
 
-        def page_results(url, bookmark=None, limit=25):
-            r = requests.post(
+        Only one page is held at once, unlike ``get_records``.
+        """
+        yield from self._find_fields({"record_format_version": 1}, limit=limit)
+
+    def count_records(self, limit=1000):
+        """
+        Count the project's record documents, fetching only their ids.
+        """
+        docs = self._find_fields({"record_format_version": 1}, ["_id"], limit)
+        return sum(1 for _ in docs)
+
+    def count_records_by_type(self, limit=1000):
+        """
+        Count the project's record documents of each type, fetching only
+        their types.
+        """
+        docs = self._find_fields({"record_format_version": 1}, ["type"], limit)
+        return Counter(doc.get("type") for doc in docs)
+
+    def record_heads(self, limit=1000):
+        """
+        The head revision ids of the project's records, as
+        ``{record_type: {record_id: heads}}``, fetching only those fields.
+        """
+        heads = defaultdict(dict)
+        fields = ["_id", "type", "heads"]
+        for doc in self._find_fields({"record_format_version": 1}, fields, limit):
+            heads[doc.get("type")][doc["_id"]] = sorted(doc.get("heads", []))
+        return dict(heads)
+
+    def summarise_attachments(self, limit=1000):
+        """
+        Count the project's attachments and their bytes, from the stubs
+        ``_all_docs`` gives instead of the data. Attachments of revisions
+        that are no longer heads are included.
+        """
+        url = f"{self.base_url}/{self.project}/_all_docs"
+        count = 0
+        total_bytes = 0
+        startkey = ATTACHMENT_PREFIX
+        last_key = None
+        while True:
+            r = self.session.post(
                 url,
                 auth=self.auth_token,
                 json={
-                    "selector": {
-                        "record_format_version": 1,
-                    },
-                    "bookmark": bookmark,
-                    # we're going to get everything, we could do filtering as per
-                    # https://docs.couchdb.org/en/stable/api/database/find.html
+                    "startkey": startkey,
+                    "endkey": f"{ATTACHMENT_PREFIX}\ufff0",
+                    "include_docs": True,
+                    # One more, for the last row of the previous page
+                    "limit": limit if last_key is None else limit + 1,
                 },
             )
             r.raise_for_status()
+            rows = r.json()["rows"]
+            # Dropped only if it is still there: skipping a row instead
+            # would skip the next attachment if this one had been deleted
+            if rows and rows[0]["key"] == last_key:
+                rows = rows[1:]
+            for row in rows:
+                for stub in (row.get("doc") or {}).get("_attachments", {}).values():
+                    count += 1
+                    total_bytes += stub.get("length", 0)
+            if len(rows) < limit:
+                return count, total_bytes
+            # Carry on from the last row rather than skipping everything before it
+            startkey = last_key = rows[-1]["key"]
+
+    def preflight(self, sample=20):
+        """
+        Cheap summaries of the project to estimate an export from (see
+        ``export_preflight``): the number of documents, records of each form
+        and attachments with their bytes, and the requests, bytes and
+        seconds it took to merge a ``sample`` of records, without their
+        attachments, as the export does.
+
+        The sample is counted in ``metrics`` like an export's records, so use
+        a helper of its own for the preflight.
+        """
+        with self.metrics.phase("preflight"):
+            r = self.session.get(
+                f"{self.base_url}/{self.project}/_all_docs",
+                params={"limit": 0},
+                auth=self.auth_token,
+            )
+            r.raise_for_status()
+            documents = r.json()["total_rows"]
+            forms = self.count_records_by_type()
+            attachments, attachment_bytes = self.summarise_attachments()
+
+            def http_totals():
+                endpoints = self.metrics.report()["http"].values()
+                return (
+                    sum(endpoint["requests"] for endpoint in endpoints),
+                    sum(endpoint["bytes_in"] for endpoint in endpoints),
+                )
 
-            # print("get_records")
-            # pprint(r.json())
-            return r.json()
-
-        req = page_results(url, None, limit)
-        current_docs = req["docs"]
-        bookmark = req["bookmark"]
-        result = result + current_docs
-
-        while len(current_docs) >= limit:
-            # Note that the presence of a bookmark doesn’t guarantee that there are more results. You can to test whether you have reached the end of the result set by comparing the number of results returned with the page size requested - if results returned < limit, there are no more.
-            # https://docs.couchdb.org/en/stable/api/database/find.html#pagination
-            req = page_results(url, bookmark, limit)
-            current_docs = req["docs"]
-            bookmark = req["bookmark"]
-            result = result + current_docs
-            # print(bookmark, len(current_docs))
-        return result
+            requests_before, bytes_before = http_totals()
+            start = time.perf_counter()
+            sampled = 0
+            for record in islice(self.iter_record_docs(limit=sample), sample):
+                self.merge_record(record, include_attachments=False)
+                sampled += 1
+            sample_seconds = time.perf_counter() - start
+            requests_after, bytes_after = http_totals()
+        return {
+            "documents": documents,
+            "records": sum(forms.values()),
+            "forms": {
+                self.record_type_names.get(record_type, record_type): count
+                for record_type, count in forms.items()
+            },
+            "attachments": attachments,
+            "attachment_bytes": attachment_bytes,
+            "sampled_records": sampled,
+            "sample_requests": requests_after - requests_before,
+            "sample_bytes": bytes_after - bytes_before,
+            "sample_seconds": sample_seconds,
+        }
 
     def get_head_revisions_for_record(self, record):
         """
@@ -363,7 +630,7 @@ class CouchDBHelper:
         interface in the datamodel.
         """
         url = f"{self.base_url}/{self.project}/_all_docs"
-        r = requests.post(
+        r = self.session.post(
             url,
             auth=self.auth_token,
             json={
@@ -391,7 +658,7 @@ class CouchDBHelper:
         interface in the datamodel.
         """
         url = f"{self.base_url}/{self.project}/_all_docs"
-        r = requests.post(
+        r = self.session.post(
             url,
             auth=self.auth_token,
             json={
@@ -414,7 +681,7 @@ class CouchDBHelper:
 
         # print(revision)
         url = f"{self.base_url}/{self.project}/_all_docs"
-        r = requests.post(
+        r = self.session.post(
             url,
             auth=self.auth_token,
             json={
@@ -434,7 +701,7 @@ class CouchDBHelper:
         is a non-success status given back by couchdb, this raises it.
         """
         url = f"{self.base_url}/{self.project}/_bulk_docs"
-        r = requests.post(
+        r = self.session.post(
             url,
             auth=self.auth_token,
             json={
@@ -462,10 +729,28 @@ class CouchDBHelper:
         # pprint(doc)
         logging.debug(pformat(doc))
         url = f'{self.base_url}/{self.project}/{doc["_id"]}'
-        r = requests.put(url, auth=self.auth_token, json=doc)
+        r = self.session.put(url, auth=self.auth_token, json=doc)
         r.raise_for_status()
         return r.json()
 
+    def get_documents(self, document_ids):
+        """
+        Get many documents from couchdb by their ids, in one request.
+
+        Returns a dictionary of the documents found, by id.
+        """
+        url = f"{self.base_url}/{self.project}/_all_docs"
+        r = self.session.post(
+            url,
+            auth=self.auth_token,
+            json={
+                "keys": list(document_ids),
+                "include_docs": True,
+            },
+        )
+        r.raise_for_status()
+        return {row["key"]: row["doc"] for row in r.json()["rows"] if row.get("doc")}
+
     def update_record_reference(self, record_id, base_revision_ids, new_revision_id):
         """
         Update record details to reference new revision
@@ -475,48 +760,365 @@ class CouchDBHelper:
         #    handle deletion, revisions do).
         # 2. There are no intermediate revisions, that is `new_revision_id` is a
         #    child
-        record = self._get_document_from_couchdb(record_id)
-        revisions = set(record["revisions"])
-        heads = set(record["heads"])
-        logging.debug(pformat(revisions))
-        logging.debug(pformat(base_revision_ids))
-        if not revisions >= set(base_revision_ids):
-            # checking if base revision ids is a strict subset. This seems... wrong?
-            # @aragilar double check your logic. I've added a >= so this doesn't fail,
-            #   but I'm not quite sure what you're cehcking here. I also had to cast
-            #   base_revision_ids because set > list fails.
-            raise ValueError("The base revisions are not all existing revisions")
-        revisions.add(new_revision_id)
-        for rev_id in base_revision_ids:
-            heads.discard(rev_id)
-        heads.add(new_revision_id)
-        record["revisions"] = sorted(list(revisions))
-        record["heads"] = sorted(list(heads))
-
-        self._upload_document_to_couchdb(record)
+        result = self.update_record_heads(
+            [(record_id, base_revision_ids, new_revision_id)]
+        )[record_id]
+        if result.get("error") == "invalid":
+            raise ValueError(result["reason"])
+        if "error" in result:
+            raise RuntimeError(f"Unable to update record {record_id}: {result}")
+
+    def update_record_heads(
+        self, head_changes, retries=RECORD_HEAD_RETRIES, backoff=RECORD_HEAD_BACKOFF
+    ):
+        """
+        Point records at their new revisions. ``head_changes`` is a list of
+        ``(record_id, base_revision_ids, new_revision_id)``; the changes of
+        one record are applied in order and saved in one write.
+
+        The records are fetched with one request and saved with another.
+        CouchDB refuses to save a record changed since it was fetched, e.g.
+        by a device syncing, so those conflicting records are fetched again
+        and retried together, after waiting ``backoff`` seconds (doubling
+        each time, with jitter so concurrent imports spread out), up to
+        ``retries`` times. Changes already in a record are not applied
+        again, so a retry never adds a revision twice.
+
+        Returns a dict of results by record id: CouchDB's result for the
+        save, with ``error`` if it failed ("invalid" if a change's base
+        revisions aren't in the record). The conflicts, retries and time
+        spent waiting are counted in ``metrics``.
+        """
+        changes = defaultdict(list)
+        for record_id, base_revision_ids, new_revision_id in head_changes:
+            changes[record_id].append((base_revision_ids, new_revision_id))
+        results = {}
+        pending = list(changes)
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                self.metrics.count("record_head_retries")
+                self.metrics.add_phase("record_head_backoff", delay)
+                time.sleep(delay)
+            records = self.get_documents(pending)
+            docs = []
+            for record_id in pending:
+                record = records.get(record_id)
+                if record is None:
+                    results[record_id] = {"id": record_id, "error": "not_found"}
+                    continue
+                changed = False
+                try:
+                    for base_revision_ids, new_revision_id in changes[record_id]:
+                        changed |= add_revision_to_record(
+                            record, base_revision_ids, new_revision_id
+                        )
+                except ValueError as e:
+                    results[record_id] = {
+                        "id": record_id,
+                        "error": "invalid",
+                        "reason": str(e),
+                    }
+                    continue
+                if changed:
+                    docs.append(record)
+                else:
+                    results[record_id] = {
+                        "ok": True,
+                        "id": record_id,
+                        "rev": record["_rev"],
+                    }
+            pending = []
+            if docs:
+                for doc, result in zip(docs, self._upload_docs_to_couchdb(docs)):
+                    results[doc["_id"]] = result
+                    if result.get("error") == "conflict":
+                        pending.append(doc["_id"])
+            self.metrics.count("record_head_conflicts", len(pending))
+            if not pending:
+                break
+        if pending:
+            logging.warning(
+                f"Gave up updating {len(pending)} records still in conflict "
+                f"after {retries} retries"
+            )
+        self.metrics.count(
+            "record_heads_updated",
+            sum("error" not in result for result in results.values()),
+        )
+        return results
 
     def update_existing_record(self, new_revision, new_avps):
         """
         Update a record with new data. This assumes that the revision has
         already been set up with new ids
         """
-        failures = []
         logging.debug(new_avps)
-        for result in self._upload_docs_to_couchdb(new_avps):
-            # BBS
-            logging.debug(f"uploaded avp {result}")
-            if "error" in result:
-                failures.append(result)
-        if failures:
-            raise RuntimeError("Some AVPs failed to upload", failures=failures)
-
-        self._upload_document_to_couchdb(new_revision)
+        (result,) = self.bulk_update_records([(new_revision, new_avps)])
+        if not result["ok"]:
+            raise RuntimeError(
+                f"Unable to update record {result['record_id']}: {result['error']}"
+            )
         logging.info("uploaded revision")
-        self.update_record_reference(
-            new_revision["record_id"],
-            new_revision["parents"],
-            new_revision["_id"],
+
+    def bulk_update_records(
+        self, updates, batch_size=BULK_UPDATE_BATCH, retries=RECORD_HEAD_RETRIES
+    ):
+        """
+        Update many records with new data, as ``update_existing_record`` does
+        for one. ``updates`` is a list of ``(new_revision, new_avps)``.
+
+        Each batch of ``batch_size`` updates takes four requests, rather than
+        four per record: the AVPs are uploaded, then the revisions whose AVPs
+        were all saved, then the records are fetched, and uploaded pointing
+        at their new revisions. Several updates of one record in a batch are
+        applied in order.
+
+        CouchDB saves each document on its own, so a failure only fails its
+        own update, although an invalid update of a record fails the others
+        of that record in the batch. Records that conflict are retried as
+        ``update_record_heads`` describes, up to ``retries`` times.
+
+        Returns a result per update, in order, with its ``record_id``,
+        ``revision_id`` and ``ok``, and on failure the ``error`` CouchDB gave.
+        """
+        updates = list(updates)
+        results = []
+        with self.metrics.phase("bulk_update_records"):
+            for start in range(0, len(updates), batch_size):
+                results.extend(
+                    self._bulk_update_batch(
+                        updates[start : start + batch_size], retries
+                    )
+                )
+        return results
+
+    def _bulk_update_batch(self, batch, retries):
+        results = [
+            {
+                "record_id": new_revision["record_id"],
+                "revision_id": new_revision["_id"],
+                "ok": False,
+            }
+            for new_revision, _ in batch
+        ]
+
+        def pending():
+            return [i for i, result in enumerate(results) if "error" not in result]
+
+        def upload(indices, docs):
+            if not docs:
+                return
+            for i, result in zip(indices, self._upload_docs_to_couchdb(docs)):
+                if "error" in result:
+                    results[i].setdefault("error", result)
+
+        avp_updates = [i for i, (_, new_avps) in enumerate(batch) for _ in new_avps]
+        upload(avp_updates, [avp for _, new_avps in batch for avp in new_avps])
+        indices = pending()
+        upload(indices, [batch[i][0] for i in indices])
+
+        indices = pending()
+        heads = self.update_record_heads(
+            [
+                (
+                    new_revision["record_id"],
+                    new_revision["parents"],
+                    new_revision["_id"],
+                )
+                for new_revision in (batch[i][0] for i in indices)
+            ],
+            retries,
         )
+        for i in indices:
+            result = heads[results[i]["record_id"]]
+            if "error" in result:
+                results[i]["error"] = result
+            else:
+                results[i]["ok"] = True
+
+        updated = sum(result["ok"] for result in results)
+        self.metrics.count("records_updated", updated)
+        if updated < len(results):
+            logging.warning(
+                f"{len(results) - updated} of {len(results)} record updates failed"
+            )
+        return results
+
+    def flatten_record(
+        self,
+        record_name,
+        key,
+        record,
+        per_field_users=False,
+        external_attachments=True,
+    ):
+        """
+        Flatten a single merged record from ``fetch_records_for_roundtrip``.
+
+        Returns ``(record, attachments, shapes)``: the record ready for
+        ``flatten_row``/``json_normalize``, the decoded attachments to write out and
+        the geojson features of its geometry fields, keyed by field label.
+        """
+        attachments = []
+        shapes = {}
+        identifier = record["metadata"].get("identifier") or key
+
+        for item in record:
+            # logging.debug((item, pformat(record[item].keys())))
+            for item_key in [
+                "conflict_history",
+                "newest_avp_id",
+                "record_id",
+                "element",
+                "label",
+                "type",
+            ]:
+                if item == "metadata":
+                    record["metadata"]["record_name"] = record_name
+                    if record["metadata"]["identifier"]:
+                        identifier = record["metadata"]["identifier"]
+
+                    record["metadata"]["updates"] = str(record["metadata"]["updates"])
+                    if "relationship" in record["metadata"]:
+                        logging.debug(record["metadata"])
+                    # logging.debug(pformat(record["metadata"]))
+                    if "parents" in record["metadata"]:
+                        del record["metadata"]["parents"]
+                else:
+                    if not per_field_users and "metadata" in record[item]:
+                        del record[item]["metadata"]
+                    if (
+                        "in_conflict" in record[item]
+                        and not record[item]["in_conflict"]
+                    ):
+                        del record[item]["in_conflict"]
+
+                    if item_key in record[item]:
+                        del record[item][item_key]
+                    if isinstance(record[item].get("data", {}).get("value"), list):
+                        if (
+                            record[item]["data"]["value"]
+                            and "record_label" in record[item]["data"]["value"][0]
+                        ):
+                            new_data = []
+                            for sub_item in record[item]["data"]["value"]:
+                                new_data.append(
+                                    sub_item.get("record_label", "label_unknown")
+                                )
+                            record[item]["data"]["value"] = new_data
+                        if not record[item]["data"]["value"]:
+                            record[item]["data"]["value"] = None
+
+                    if isinstance(record[item].get("data", {}).get("value"), dict):
+                        if "geometry" in record[item]["data"]["value"]:
+                            orig = record[item]["data"]["value"].copy()
+                            orig_json = geojson.loads(json.dumps(orig))
+                            orig_json["id"] = identifier
+                            orig_json["properties"]["title"] = identifier
+                            orig_json["record_id"] = key
+                            # logging.debug(orig_json)
+                            if item not in shapes:
+                                shapes[item] = []
+
+                            shapes[item].append(orig_json)
+
+                            # Imported here as shapely is slow to import
+                            from shapely.geometry import shape
+
+                            geo_shape = shape(orig["geometry"])
+                            record[item]["data"]["value"] = {}
+                            record[item]["data"]["value"]["geojson"] = geojson.dumps(
+                                orig_json
+                            )
+                            record[item]["data"]["value"]["wkt"] = geo_shape.wkt
+
+                            record[item]["data"]["value"]["y_latitude"] = orig[
+                                "geometry"
+                            ]["coordinates"][1]
+                            record[item]["data"]["value"]["x_longitude"] = orig[
+                                "geometry"
+                            ]["coordinates"][0]
+                            record[item]["data"]["value"]["accuracy"] = orig[
+                                "properties"
+                            ]["accuracy"]
+
+                            record[item]["data"]["value"]["timestamp"] = (
+                                datetime.datetime.fromtimestamp(
+                                    orig["properties"].get("timestamp", 0) / 1000.0,
+                                    LOCAL_TIMEZONE,
+                                )
+                            )
+
+                        elif "geojson" in record[item]["data"]["value"]:
+                            pass
+                        elif "record_label" in record[item]["data"]["value"]:
+                            record[item]["data"]["value"] = record[item]["data"][
+                                "value"
+                            ]["record_label"]
+                        else:
+                            record[item]["data"]["value"] = pformat(
+                                record[item]["data"]["value"]
+                            )
+
+                    # if record[item].get("faims_attachments"):
+                    # logging.debug((item, record[item].keys()))
+
+                    if external_attachments and record[item].get("attachments"):
+                        # logging.debug(identifier)
+                        record_attachments = record[item]["attachments"]
+                        record[item]["attached_files"] = []
+                        counter = defaultdict(int)
+
+                        for attachment in record_attachments:
+                            orig_filename = attachment["filename"]
+                            header, file = attachment["file"].split(",")
+                            header = re.sub(
+                                r"data:", r"", re.sub(";base64", "", header)
+                            )
+
+                            if orig_filename and "." in orig_filename:
+                                extension = ".".join(
+                                    [
+                                        slugify(
+                                            x,
+                                            max_length=64,
+                                            allow_unicode=True,
+                                            lowercase=False,
+                                        )
+                                        for x in orig_filename.split(".")
+                                    ]
+                                )
+                                extension = f".{extension}"
+                                # logging.debug((orig_filename, extension))
+                                # base_filename = f".{orig_filename}"
+                            else:
+                                extension = guess_extension(header)
+                                # base_filename = ""
+                            counter[key] += 1
+                            # logging.debug(
+                            #     f"*****attach****\n,{key},{identifier},{counter[key]},{extension}"
+                            # )
+                            #
+                            # attachment_path.mkdir(parents=True, exist_ok=True)
+                            record_nametype = f"{record_name}"
+                            attachment = {
+                                "path": f"{slugify(record_nametype, max_length=128, allow_unicode=True, lowercase=False)}/{slugify(item, max_length=128, allow_unicode=True, lowercase=False)}",
+                                "filename": f"{slugify(identifier, max_length=128, allow_unicode=True, lowercase=False)}.{slugify(item, max_length=64, allow_unicode=True, lowercase=False)}.{counter[key]}{extension}",
+                                "data": base64.standard_b64decode(file),
+                            }
+                            record[item]["attached_files"].append(
+                                str(f"{attachment['path']}/{attachment['filename']}")
+                            )
+                            attachments.append(attachment)
+                        if not record[item]["attached_files"]:
+                            del record[item]["attached_files"]
+                    if "attachments" in record[item]:
+                        del record[item]["attachments"]
+
+            # logging.debug(pformat(record[item]))
+
+        return record, attachments, shapes
 
     def flatten_records(
         self,
@@ -535,7 +1137,12 @@ class CouchDBHelper:
         # TODO remove empty cols for uncertainty, anntoations
         # Remove per-field user details (toggleable)
 
-        records = self.fetch_records_for_roundtrip(iterator=iterator)
+        # Imported here as pandas is slow to import and streaming exports
+        # don't need it
+        import pandas
+
+        with self.metrics.phase("fetch_records"):
+            records = self.fetch_records_for_roundtrip(iterator=iterator)
         dataframes = {}
         attachments = []
         shapes = {}
@@ -550,180 +1157,22 @@ class CouchDBHelper:
             for key in record:
                 # logging.debug(key)
                 # try:
-                identifier = record[key]["metadata"].get("identifier") or key
-
-                for item in record[key]:
-                    # logging.debug((item, pformat(record[key][item].keys())))
-                    for item_key in [
-                        "conflict_history",
-                        "newest_avp_id",
-                        "record_id",
-                        "element",
-                        "label",
-                        "type",
-                    ]:
-                        if item == "metadata":
-                            record[key]["metadata"]["record_name"] = record_name
-                            if record[key]["metadata"]["identifier"]:
-                                identifier = record[key]["metadata"]["identifier"]
-
-                            record[key]["metadata"]["updates"] = str(
-                                record[key]["metadata"]["updates"]
-                            )
-                            if "relationship" in record[key]["metadata"]:
-                                logging.debug(record[key]["metadata"])
-                            # logging.debug(pformat(record[key]["metadata"]))
-                            if "parents" in record[key]["metadata"]:
-                                del record[key]["metadata"]["parents"]
-                        else:
-                            if not per_field_users and "metadata" in record[key][item]:
-                                del record[key][item]["metadata"]
-                            if (
-                                "in_conflict" in record[key][item]
-                                and not record[key][item]["in_conflict"]
-                            ):
-                                del record[key][item]["in_conflict"]
-
-                            if item_key in record[key][item]:
-                                del record[key][item][item_key]
-                            if isinstance(
-                                record[key][item].get("data", {}).get("value"), list
-                            ):
-                                if (
-                                    record[key][item]["data"]["value"]
-                                    and "record_label"
-                                    in record[key][item]["data"]["value"][0]
-                                ):
-                                    new_data = []
-                                    for sub_item in record[key][item]["data"]["value"]:
-                                        new_data.append(
-                                            sub_item.get(
-                                                "record_label", "label_unknown"
-                                            )
-                                        )
-                                    record[key][item]["data"]["value"] = new_data
-                                if not record[key][item]["data"]["value"]:
-                                    record[key][item]["data"]["value"] = None
-
-                            if isinstance(
-                                record[key][item].get("data", {}).get("value"), dict
-                            ):
-                                if "geometry" in record[key][item]["data"]["value"]:
-                                    orig = record[key][item]["data"]["value"].copy()
-                                    orig_json = geojson.loads(json.dumps(orig))
-                                    orig_json["id"] = identifier
-                                    orig_json["properties"]["title"] = identifier
-                                    orig_json["record_id"] = key
-                                    # logging.debug(orig_json)
-                                    if record_name not in shapes:
-                                        shapes[record_name] = {}
-                                    if item not in shapes[record_name]:
-                                        shapes[record_name][item] = []
-
-                                    shapes[record_name][item].append(orig_json)
-
-                                    geo_shape = shape(orig["geometry"])
-                                    record[key][item]["data"]["value"] = {}
-                                    record[key][item]["data"]["value"][
-                                        "geojson"
-                                    ] = geojson.dumps(orig_json)
-                                    record[key][item]["data"]["value"][
-                                        "wkt"
-                                    ] = geo_shape.wkt
-
-                                    record[key][item]["data"]["value"][
-                                        "y_latitude"
-                                    ] = orig["geometry"]["coordinates"][1]
-                                    record[key][item]["data"]["value"][
-                                        "x_longitude"
-                                    ] = orig["geometry"]["coordinates"][0]
-                                    record[key][item]["data"]["value"][
-                                        "accuracy"
-                                    ] = orig["properties"]["accuracy"]
-
-                                    record[key][item]["data"]["value"][
-                                        "timestamp"
-                                    ] = datetime.datetime.fromtimestamp(
-                                        orig["properties"].get("timestamp", 0) / 1000.0,
-                                        LOCAL_TIMEZONE,
-                                    )
-
-                                elif "geojson" in record[key][item]["data"]["value"]:
-                                    pass
-                                elif (
-                                    "record_label" in record[key][item]["data"]["value"]
-                                ):
-                                    record[key][item]["data"]["value"] = record[key][
-                                        item
-                                    ]["data"]["value"]["record_label"]
-                                else:
-                                    record[key][item]["data"]["value"] = pformat(
-                                        record[key][item]["data"]["value"]
-                                    )
-
-                            # if record[key][item].get("faims_attachments"):
-                            # logging.debug((item, record[key][item].keys()))
-
-                            if external_attachments and record[key][item].get(
-                                "attachments"
-                            ):
-                                # logging.debug(identifier)
-                                record_attachments = record[key][item]["attachments"]
-                                record[key][item]["attached_files"] = []
-                                counter = defaultdict(int)
-
-                                for attachment in record_attachments:
-                                    orig_filename = attachment["filename"]
-                                    header, file = attachment["file"].split(",")
-                                    header = re.sub(
-                                        r"data:", r"", re.sub(";base64", "", header)
-                                    )
-
-                                    if orig_filename and "." in orig_filename:
-                                        extension = ".".join(
-                                            [
-                                                slugify(
-                                                    x,
-                                                    max_length=64,
-                                                    allow_unicode=True,
-                                                    lowercase=False,
-                                                )
-                                                for x in orig_filename.split(".")
-                                            ]
-                                        )
-                                        extension = f".{extension}"
-                                        # logging.debug((orig_filename, extension))
-                                        # base_filename = f".{orig_filename}"
-                                    else:
-                                        extension = guess_extension(header)
-                                        # base_filename = ""
-                                    counter[key] += 1
-                                    # logging.debug(
-                                    #     f"*****attach****\n,{key},{identifier},{counter[key]},{extension}"
-                                    # )
-                                    #
-                                    # attachment_path.mkdir(parents=True, exist_ok=True)
-                                    record_nametype = f"{record_name}"
-                                    attachment = {
-                                        "path": f"{slugify(record_nametype, max_length=128, allow_unicode=True, lowercase=False)}/{slugify(item, max_length=128, allow_unicode=True, lowercase=False)}",
-                                        "filename": f"{slugify(identifier, max_length=128, allow_unicode=True, lowercase=False)}.{slugify(item, max_length=64, allow_unicode=True, lowercase=False)}.{counter[key]}{extension}",
-                                        "data": base64.standard_b64decode(file),
-                                    }
-                                    record[key][item]["attached_files"].append(
-                                        str(
-                                            f"{attachment['path']}/{attachment['filename']}"
-                                        )
-                                    )
-                                    attachments.append(attachment)
-                                if not record[key][item]["attached_files"]:
-                                    del record[key][item]["attached_files"]
-                            if "attachments" in record[key][item]:
-                                del record[key][item]["attachments"]
-
-                    # logging.debug(pformat(record[key][item]))
+                record[key], record_attachments, record_shapes = self.flatten_record(
+                    record_name,
+                    key,
+                    record[key],
+                    per_field_users=per_field_users,
+                    external_attachments=external_attachments,
+                )
+                attachments.extend(record_attachments)
+                for item, features in record_shapes.items():
+                    shapes.setdefault(record_name, {}).setdefault(item, []).extend(
+                        features
+                    )
                 record_list.append(record[key])
 
-            df = pandas.json_normalize(record_list)
+            with self.metrics.phase("json_normalize"):
+                df = pandas.json_normalize(record_list)
             df = df.rename(columns=lambda x: re.sub(".data.value", "", x))
             # df.set_index("metadata.identifier", inplace=True)
             if hide_empty:
@@ -836,7 +1285,7 @@ class CouchDBHelper:
         # self.records = records
         # return records
 
-    def fetch_records_for_roundtrip(
+    def iter_records_for_roundtrip(
         self,
         match_uuids=[],
         disable_progress_bars=False,
@@ -844,17 +1293,24 @@ class CouchDBHelper:
         iterator="text",
     ):
         """
-        Gets all records from a FAIMS3 CouchDB instance.
+        Yields ``(record_type, record_id, record)`` as each record finishes merging.
 
-        Given a faims object produced by the faims3couchdb class, flatten to JSON and get
-        the latest avps for all record types.
+        Records are produced in the same shape as ``fetch_records_for_roundtrip``,
+        with all head revisions merged, but parent relationships are not
+        resolved (see ``resolve_relationships``) and nothing is kept once the
+        record has been yielded.
         """
 
-        records = {}
-
         logging.info(f"Exporting: {self.project}")
+        # Counted up front by exports; fetching only ids is cheap otherwise
+        total = self.metrics.expected.get("records")
+        if total is None and not disable_progress_bars:
+            total = self.count_records()
         record_iter = tqdm(
-            self.get_records(), desc=f"JSON records", disable=disable_progress_bars
+            self.iter_record_docs(),
+            desc=f"JSON records",
+            total=total,
+            disable=disable_progress_bars,
         )
 
         # new_revision_id = str(uuid4())
@@ -862,397 +1318,474 @@ class CouchDBHelper:
             # print(faims_record)
             if match_uuids and faims_record["_id"] not in match_uuids:
                 continue
-            # record_iter.write(pformat(f"{faims_record=}"))
-            record_type = faims_record["type"]
-            created = faims_record["created"]
-            # logging.debug(created)
-            created_by = faims_record["created_by"]
-            record_id = faims_record["_id"]
-            # pprint(faims_record)
-
-            # print(record_type)
-            # sys.exit(0)
-            try:
-                all_revisions = self.get_all_revisions_for_record(faims_record).items()
-            except Exception as e:
+            if faims_record.get("type") in self.skip_record_types:
                 continue
+            merged = self.merge_record(
+                faims_record, include_attachments=include_attachments
+            )
+            if merged is not None:
+                yield merged
 
-            try:
-                revisions = self.get_head_revisions_for_record(faims_record).items()
-            except Exception as e:
-                continue
+    def merge_record(self, faims_record, include_attachments=True):
+        """
+        Fetch a record's revisions and avps and merge its head revisions.
 
-            """
-            TODO
-
-            1. Exporter needs to obey "delete this record" (and figure out how it's being set)
-            2. Make sure each line is one and only one uuid
-                2a. That conflicts in avps are listed in each avp instead
-                2b. choose a value for each avp if there is only one
-                2c. show username, timestamp, value for each avp
-            3. Export label as part of each avp
-            """
-
-            revision_authordate = OrderedDict()
-            revision_bykey = {}
-            isdeleted = False
-            for revision_key, revision in all_revisions:
-                # print(revision_key)
-                revision_authordate[revision["created"]] = {
-                    "created_by": revision["created_by"],
-                    "created_at": revision["created"],
-                    "revision_key": revision_key,
-                    "deleted": revision.get("deleted", False),
-                }
-                revision_bykey[revision_key] = {
-                    "created_by": revision["created_by"],
-                    "created_at": revision["created"],
-                }
-                if "relationship" in revision:
-                    revision_bykey[revision_key]["relationship"] = revision[
-                        "relationship"
-                    ]
-            for revision_key, revision in revisions:
-                isdeleted = revision.get("deleted", False)
-            if isdeleted and not self.include_deleted:
-                continue
-            identifier = ""
-            # Revisions... should be only one.
-            for revision_key, revision in revisions:
-                record = OrderedDict()
-
-                updated_at = revision_bykey[revision_key]["created_at"]
-                updated_by = revision_bykey[revision_key]["created_by"]
-                record["metadata"] = {
-                    "identifier": None,
-                    "record_type": record_type,
-                    "updated_at": updated_at,
-                    "updated_by": updated_by,
-                    "in_conflict": False,
-                    "deleted": isdeleted,
-                    "parents": [],
-                    "record_id": faims_record["_id"],
-                }
+        Returns ``(record_type, record_id, record)`` as yielded by
+        ``iter_records_for_roundtrip``, or None if the record can't be fetched
+        or is deleted (and deleted records aren't being exported).
+        """
+        if self.profiler is None:
+            return self._merge_record(faims_record, include_attachments)
+        with self.profiler.time_record(faims_record) as outcome:
+            outcome["result"] = self._merge_record(faims_record, include_attachments)
+        return outcome["result"]
 
-                if revision_bykey[revision_key].get("relationship"):
-                    if "parent" in revision_bykey[revision_key]["relationship"]:
-                        this_reln = revision_bykey[revision_key]["relationship"][
-                            "parent"
-                        ]
-                        logging.debug(pformat(this_reln))
-                        # pprint(this_reln)
-
-                        if this_reln["relation_type_vocabPair"]:
-                            record["metadata"]["relationship_verb"] = this_reln[
-                                "relation_type_vocabPair"
-                            ][0]
-                        else:
-                            record["metadata"]["relationship_verb"] = "linked with"
-                        record["metadata"]["relationship_parent_record_hrid"] = None
-                        record["metadata"]["relationship_parent_record_form"] = None
-                        record["metadata"]["relationship_parent_record_id"] = this_reln[
-                            "record_id"
-                        ]
-                        record["metadata"]["relationship_parent_field_id"] = this_reln[
-                            "field_id"
-                        ]
-                    elif "linked" in revision_bykey[revision_key]["relationship"]:
-                        # BBS Resume
-
-                        this_reln = revision_bykey[revision_key]["relationship"][
-                            "linked"
-                        ]
-                        print(pformat(this_reln))
-                        logging.debug(pformat(this_reln))
+    def _merge_record(self, faims_record, include_attachments):
 
-                        record["metadata"]["relationship_verb"] = this_reln[
-                            "relation_type_vocabPair"
-                        ][0]
-                        record["metadata"]["relationship_linked_record_hrid"] = None
-                        record["metadata"]["relationship_linked_record_form"] = None
-                        record["metadata"]["relationship_linked_record_id"] = this_reln[
-                            "record_id"
-                        ]
-                        record["metadata"]["relationship_linked_field_id"] = this_reln[
-                            "field_id"
-                        ]
-
-                # get_all_revisions_for_record in case historical versions are indicated
-                # print("revision", revision_key)
-                record["metadata"]["parents"].append(revision_key)
-                record["metadata"]["updates"] = revision_authordate
-                type_rev_lookup = {}
-                for avp_type in revision["avps"]:
-                    type_rev_lookup[revision["avps"][avp_type]] = avp_type
-                # print(f"foo {record_type}")
-                # pprint(type_rev_lookup)
-
-                record_avps = self.get_all_avps_for_revision(revision)
-                # record_keys = dict.from_keys(['record_type', 'created_by', 'created_at'])
-                for key in record_avps:
-                    avp = record_avps[key]
+        records = {}
 
-                    # print(avp)
-                    avp_id = avp["_id"]
-                    avp_element = type_rev_lookup[avp_id]
+        # record_iter.write(pformat(f"{faims_record=}"))
+        record_type = faims_record["type"]
+        created = faims_record["created"]
+        # logging.debug(created)
+        created_by = faims_record["created_by"]
+        record_id = faims_record["_id"]
+        # pprint(faims_record)
 
-                    avp_type = self.field_mapping.get(
-                        avp_element, avp_element
-                    )  # try to lookup the human element name, if not return the generic element internal name
+        # print(record_type)
+        # sys.exit(0)
+        try:
+            all_revisions = self.get_all_revisions_for_record(faims_record).items()
+        except Exception as e:
+            return None
 
-                    avp_field_metadata = self.field_metadata.get(avp_element)
-                    # logging.debug(pformat(avp_field_metadata, width=200))
+        try:
+            revisions = self.get_head_revisions_for_record(faims_record).items()
+        except Exception as e:
+            return None
 
-                    if avp["type"] == "??:??":
-                        continue
-                    # pprint(avp_field_metadata)
+        """
+        TODO
+
+        1. Exporter needs to obey "delete this record" (and figure out how it's being set)
+        2. Make sure each line is one and only one uuid
+            2a. That conflicts in avps are listed in each avp instead
+            2b. choose a value for each avp if there is only one
+            2c. show username, timestamp, value for each avp
+        3. Export label as part of each avp
+        """
 
-                    # hierarchy = self.element_hierarchy[avp_element]
-                    # form = hierarchy['viewset']
-                    # view = hierarchy['view']
+        revision_authordate = OrderedDict()
+        revision_bykey = {}
+        isdeleted = False
+        for revision_key, revision in all_revisions:
+            # print(revision_key)
+            revision_authordate[revision["created"]] = {
+                "created_by": revision["created_by"],
+                "created_at": revision["created"],
+                "revision_key": revision_key,
+                "deleted": revision.get("deleted", False),
+            }
+            revision_bykey[revision_key] = {
+                "created_by": revision["created_by"],
+                "created_at": revision["created"],
+            }
+            if "relationship" in revision:
+                revision_bykey[revision_key]["relationship"] = revision["relationship"]
+        for revision_key, revision in revisions:
+            isdeleted = revision.get("deleted", False)
+        if isdeleted and not self.include_deleted:
+            return None
+        identifier = ""
+        # Revisions... should be only one.
+        for revision_key, revision in revisions:
+            record = OrderedDict()
+
+            updated_at = revision_bykey[revision_key]["created_at"]
+            updated_by = revision_bykey[revision_key]["created_by"]
+            record["metadata"] = {
+                "identifier": None,
+                "record_type": record_type,
+                "updated_at": updated_at,
+                "updated_by": updated_by,
+                "in_conflict": False,
+                "deleted": isdeleted,
+                "parents": [],
+                "record_id": faims_record["_id"],
+            }
+
+            if revision_bykey[revision_key].get("relationship"):
+                if "parent" in revision_bykey[revision_key]["relationship"]:
+                    this_reln = revision_bykey[revision_key]["relationship"]["parent"]
+                    logging.debug(pformat(this_reln))
+                    # pprint(this_reln)
+
+                    if this_reln["relation_type_vocabPair"]:
+                        record["metadata"]["relationship_verb"] = this_reln[
+                            "relation_type_vocabPair"
+                        ][0]
+                    else:
+                        record["metadata"]["relationship_verb"] = "linked with"
+                    record["metadata"]["relationship_parent_record_hrid"] = None
+                    record["metadata"]["relationship_parent_record_form"] = None
+                    record["metadata"]["relationship_parent_record_id"] = this_reln[
+                        "record_id"
+                    ]
+                    record["metadata"]["relationship_parent_field_id"] = this_reln[
+                        "field_id"
+                    ]
+                elif "linked" in revision_bykey[revision_key]["relationship"]:
+                    # BBS Resume
+
+                    this_reln = revision_bykey[revision_key]["relationship"]["linked"]
+                    print(pformat(this_reln))
+                    logging.debug(pformat(this_reln))
+
+                    record["metadata"]["relationship_verb"] = this_reln[
+                        "relation_type_vocabPair"
+                    ][0]
+                    record["metadata"]["relationship_linked_record_hrid"] = None
+                    record["metadata"]["relationship_linked_record_form"] = None
+                    record["metadata"]["relationship_linked_record_id"] = this_reln[
+                        "record_id"
+                    ]
+                    record["metadata"]["relationship_linked_field_id"] = this_reln[
+                        "field_id"
+                    ]
 
-                    try:
-                        # print(avp)
-                        # print(avp_type)
-                        # logging.debug(avp_type)
+            # get_all_revisions_for_record in case historical versions are indicated
+            # print("revision", revision_key)
+            record["metadata"]["parents"].append(revision_key)
+            record["metadata"]["updates"] = revision_authordate
+            type_rev_lookup = {}
+            for avp_type in revision["avps"]:
+                type_rev_lookup[revision["avps"][avp_type]] = avp_type
+            # print(f"foo {record_type}")
+            # pprint(type_rev_lookup)
+
+            record_avps = self.get_all_avps_for_revision(revision)
+            # record_keys = dict.from_keys(['record_type', 'created_by', 'created_at'])
+            for key in record_avps:
+                avp = record_avps[key]
+
+                # print(avp)
+                avp_id = avp["_id"]
+                avp_element = type_rev_lookup[avp_id]
+
+                avp_type = self.field_mapping.get(
+                    avp_element, avp_element
+                )  # try to lookup the human element name, if not return the generic element internal name
+
+                avp_field_metadata = self.field_metadata.get(avp_element)
+                # logging.debug(pformat(avp_field_metadata, width=200))
+
+                if avp["type"] == "??:??":
+                    continue
+                # pprint(avp_field_metadata)
+
+                # hierarchy = self.element_hierarchy[avp_element]
+                # form = hierarchy['viewset']
+                # view = hierarchy['view']
+
+                try:
+                    # print(avp)
+                    # print(avp_type)
+                    # logging.debug(avp_type)
 
-                        # if avp_type == "FIP Site ID":
-                        if avp_field_metadata and avp_field_metadata.get(
-                            "component-parameters", {}
-                        ).get("hrid", False):
-                            identifier = avp["data"]
-                            record["metadata"]["identifier"] = avp["data"]
-                            self.identifiers[faims_record["_id"]] = identifier
+                    # if avp_type == "FIP Site ID":
+                    if avp_field_metadata and avp_field_metadata.get(
+                        "component-parameters", {}
+                    ).get("hrid", False):
+                        identifier = avp["data"]
+                        record["metadata"]["identifier"] = avp["data"]
+                        self.identifiers[faims_record["_id"]] = identifier
 
-                        if (
-                            avp_field_metadata
-                            and avp_field_metadata.get("component-name")
-                            == "TemplatedStringField"
-                            and "hridFORM"
-                            in avp_field_metadata.get("component-parameters", {}).get(
-                                "id"
-                            )
-                        ):
-                            identifier = avp["data"]
-                            record["metadata"]["identifier"] = avp["data"]
-                            self.identifiers[faims_record["_id"]] = identifier
-                        # pprint(revision_authordate[avp['revision_id']])
-                        # logging.debug(pformat(avp))
-                        self.forms_from_record_id[faims_record["_id"]] = record_type
-                        record[avp_type] = {
-                            "record_id": faims_record["_id"],
-                            "newest_avp_id": avp["_id"],
-                            "element": avp_element,
-                            "label": avp_type,
-                            # 'form':form,
-                            # 'view':view,
-                            #'new_revision_id':new_revision_id,
-                            "type": avp["type"],
-                            "data": {
-                                "value": avp["data"],
-                                "annotation": avp["annotations"]["annotation"] or None,
-                                "uncertainty": avp["annotations"]["uncertainty"],
-                            },
-                            "metadata": revision_bykey[avp["revision_id"]],
-                            "attachments": [],
-                            "conflict_history": {},
-                            "in_conflict": False,
-                        }
-
-                        # if record_id in records.get(record_type,{}):
-                        #     old_data = records[record_type][record_id][avp_type]
-                        #     if record[avp_type]["data"] != old_data["data"] or record[avp_type]["metadata"] != old_data["metadata"]:
-                        #         print(record[avp_type]["data"], old_data["data"])
-                        #         record[avp_type]['conflict_history'].append({"data":old_data['data'],
-                        #                                                      "metadata":old_data['metadata']
-                        #                                                     })
-
-                        # Tranche 1.55 attachments
-                        if include_attachments:
-                            for attachment in avp.get("faims_attachments", {}):
-                                # logging.debug(pformat(avp))
-                                # logging.debug(identifier)
-                                # logging.debug(attachment)
-                                attach_url = f"{self.base_url}/{self.project}/{attachment['attachment_id']}/{attachment['attachment_id']}"
-                                try:
-                                    with requests.get(
-                                        attach_url,
-                                        auth=self.auth_token,
-                                    ) as attach_get:
-                                        attach_get.raise_for_status()
-                                        file = f"data:{attach_get.headers['Content-Type']};base64,{base64.b64encode(attach_get.content).decode('utf-8')}"
-                                        record[avp_type]["attachments"].append(
-                                            {
-                                                "filename": attachment["filename"],
-                                                "file": file,
-                                            }
-                                        )
-                                except requests.exceptions.HTTPError as e:
-                                    logging.error(
-                                        f"Could not fetch attachment for {attach_url}. Error: {e}\n"
-                                    )
-                            # Tranche 1 attachments
-                            for attachment in avp.get("_attachments", {}):
-                                # https://alpha.db.faims.edu.au
-                                # project         /data-farmer_incentive_program_data_collection_notebook_for_service_provider_sp_id_mon_24_jan_2022_22_32_36_aedt-5433d34e-7d09-11ec-acbe-9beb1ca0af9d
-                                # doc_id             /61d83be6-ddb2-4b10-9b37-49cdb0f6f253
-                                # attachment key  /b942e745-c25c-4a59-a7d7-8de49df46add
-                                # url =  f'{self.base_url}/{self.project}
-                                attach_url = f"{self.base_url}/{self.project}/{avp['_id']}/{attachment}"
-                                # print(attach_url)
-                                with requests.get(
+                    if (
+                        avp_field_metadata
+                        and avp_field_metadata.get("component-name")
+                        == "TemplatedStringField"
+                        and "hridFORM"
+                        in avp_field_metadata.get("component-parameters", {}).get("id")
+                    ):
+                        identifier = avp["data"]
+                        record["metadata"]["identifier"] = avp["data"]
+                        self.identifiers[faims_record["_id"]] = identifier
+                    # pprint(revision_authordate[avp['revision_id']])
+                    # logging.debug(pformat(avp))
+                    self.forms_from_record_id[faims_record["_id"]] = record_type
+                    record[avp_type] = {
+                        "record_id": faims_record["_id"],
+                        "newest_avp_id": avp["_id"],
+                        "element": avp_element,
+                        "label": avp_type,
+                        # 'form':form,
+                        # 'view':view,
+                        #'new_revision_id':new_revision_id,
+                        "type": avp["type"],
+                        "data": {
+                            "value": avp["data"],
+                            "annotation": avp["annotations"]["annotation"] or None,
+                            "uncertainty": avp["annotations"]["uncertainty"],
+                        },
+                        "metadata": revision_bykey[avp["revision_id"]],
+                        "attachments": [],
+                        "conflict_history": {},
+                        "in_conflict": False,
+                    }
+
+                    # if record_id in records.get(record_type,{}):
+                    #     old_data = records[record_type][record_id][avp_type]
+                    #     if record[avp_type]["data"] != old_data["data"] or record[avp_type]["metadata"] != old_data["metadata"]:
+                    #         print(record[avp_type]["data"], old_data["data"])
+                    #         record[avp_type]['conflict_history'].append({"data":old_data['data'],
+                    #                                                      "metadata":old_data['metadata']
+                    #                                                     })
+
+                    # Tranche 1.55 attachments
+                    if include_attachments:
+                        for attachment in avp.get("faims_attachments", {}):
+                            # logging.debug(pformat(avp))
+                            # logging.debug(identifier)
+                            # logging.debug(attachment)
+                            attach_url = f"{self.base_url}/{self.project}/{attachment['attachment_id']}/{attachment['attachment_id']}"
+                            try:
+                                with self.session.get(
                                     attach_url,
                                     auth=self.auth_token,
                                 ) as attach_get:
                                     attach_get.raise_for_status()
                                     file = f"data:{attach_get.headers['Content-Type']};base64,{base64.b64encode(attach_get.content).decode('utf-8')}"
                                     record[avp_type]["attachments"].append(
-                                        {"filename": None, "file": file}
+                                        {
+                                            "filename": attachment["filename"],
+                                            "file": file,
+                                        }
                                     )
-                        record[avp_type]["conflict_history"][updated_at] = {
-                            "created_by": updated_by,
-                            "created_at": updated_at,
-                            "data": record[avp_type]["data"].copy(),
-                            "attachment_count": len(record[avp_type]["attachments"]),
-                        }
-                    except Exception as e:
-                        traceback.print_exc()
-                        record_iter.write(
-                            f"No data in {avp['_id']}, {avp_element}, {avp_type}"
+                            except requests.exceptions.HTTPError as e:
+                                logging.error(
+                                    f"Could not fetch attachment for {attach_url}. Error: {e}\n"
+                                )
+                        # Tranche 1 attachments
+                        for attachment in avp.get("_attachments", {}):
+                            # https://alpha.db.faims.edu.au
+                            # project         /data-farmer_incentive_program_data_collection_notebook_for_service_provider_sp_id_mon_24_jan_2022_22_32_36_aedt-5433d34e-7d09-11ec-acbe-9beb1ca0af9d
+                            # doc_id             /61d83be6-ddb2-4b10-9b37-49cdb0f6f253
+                            # attachment key  /b942e745-c25c-4a59-a7d7-8de49df46add
+                            # url =  f'{self.base_url}/{self.project}
+                            attach_url = f"{self.base_url}/{self.project}/{avp['_id']}/{attachment}"
+                            # print(attach_url)
+                            with self.session.get(
+                                attach_url,
+                                auth=self.auth_token,
+                            ) as attach_get:
+                                attach_get.raise_for_status()
+                                file = f"data:{attach_get.headers['Content-Type']};base64,{base64.b64encode(attach_get.content).decode('utf-8')}"
+                                record[avp_type]["attachments"].append(
+                                    {"filename": None, "file": file}
+                                )
+                    record[avp_type]["conflict_history"][updated_at] = {
+                        "created_by": updated_by,
+                        "created_at": updated_at,
+                        "data": record[avp_type]["data"].copy(),
+                        "attachment_count": len(record[avp_type]["attachments"]),
+                    }
+                except Exception as e:
+                    traceback.print_exc()
+                    tqdm.write(f"No data in {avp['_id']}, {avp_element}, {avp_type}")
+                    # sys.exit(1)
+
+            # iterate this at the revision level
+            if record_type not in records:
+                records[record_type] = {}
+            if record_id in records.get(record_type):
+                extant_record = records[record_type][record_id].copy()
+                logging.debug(f"Conflict: {identifier}")
+                record["metadata"]["in_conflict"] = True
+                # pprint(records[record_type][record_id].keys())
+
+                # logging.debug(
+                #     pformat(
+                #         records[record_type][record_id]["metadata"]["updated_at"]
+                #     )
+                # )
+                # logging.debug((record["metadata"]["updated_at"]))
+
+                for key in record:
+                    if "conflict_history" in record[key]:
+                        records[record_type][record_id][key]["conflict_history"].update(
+                            record[key]["conflict_history"]
                         )
-                        # sys.exit(1)
-
-                # iterate this at the revision level
-                if record_type not in records:
-                    records[record_type] = {}
-                if record_id in records.get(record_type):
-                    extant_record = records[record_type][record_id].copy()
-                    logging.debug(f"Conflict: {identifier}")
-                    record["metadata"]["in_conflict"] = True
-                    # pprint(records[record_type][record_id].keys())
-
-                    # logging.debug(
-                    #     pformat(
-                    #         records[record_type][record_id]["metadata"]["updated_at"]
-                    #     )
-                    # )
-                    # logging.debug((record["metadata"]["updated_at"]))
-
-                    for key in record:
-                        if "conflict_history" in record[key]:
-                            records[record_type][record_id][key][
-                                "conflict_history"
-                            ].update(record[key]["conflict_history"])
-                            record[key]["conflict_history"].update(
-                                extant_record[key]["conflict_history"]
+                        record[key]["conflict_history"].update(
+                            extant_record[key]["conflict_history"]
+                        )
+                    for datavaluetype in ["value", "annotation", "uncertainty"]:
+                        if "data" not in record[key]:
+                            continue
+                        if (
+                            records[record_type][record_id][key]["data"][datavaluetype]
+                            is None
+                            or records[record_type][record_id][key]["data"][
+                                datavaluetype
+                            ]
+                            == ""
+                        ) and (
+                            record[key]["data"][datavaluetype] is not None
+                            and record[key]["data"][datavaluetype] != ""
+                        ):
+                            logging.debug(
+                                f"new -> old {key} {datavaluetype} = {record[key]['data'][datavaluetype]}"
                             )
-                        for datavaluetype in ["value", "annotation", "uncertainty"]:
-                            if "data" not in record[key]:
-                                continue
-                            if (
-                                records[record_type][record_id][key]["data"][
-                                    datavaluetype
-                                ]
-                                is None
-                                or records[record_type][record_id][key]["data"][
-                                    datavaluetype
-                                ]
-                                == ""
-                            ) and (
-                                record[key]["data"][datavaluetype] is not None
-                                and record[key]["data"][datavaluetype] != ""
-                            ):
-                                logging.debug(
-                                    f"new -> old {key} {datavaluetype} = {record[key]['data'][datavaluetype]}"
-                                )
-                                records[record_type][record_id][key]["data"][
-                                    datavaluetype
-                                ] = record[key]["data"][datavaluetype]
-
-                            if (
-                                record[key]["data"][datavaluetype] is not None
-                                or record[key]["data"][datavaluetype] == ""
-                            ) and (
-                                records[record_type][record_id][key]["data"][
-                                    datavaluetype
-                                ]
-                                is not None
-                                and records[record_type][record_id][key]["data"][
-                                    datavaluetype
-                                ]
-                                != ""
-                            ):
-                                # logging.debug(
-                                #     f"old -> new {key} {datavaluetype} = {extant_record[key]['data'][datavaluetype]}"
-                                # )
-                                record[key]["data"][datavaluetype] == extant_record[
-                                    key
-                                ]["data"][datavaluetype]
-
-                            if (
+                            records[record_type][record_id][key]["data"][
+                                datavaluetype
+                            ] = record[key]["data"][datavaluetype]
+
+                        if (
+                            record[key]["data"][datavaluetype] is not None
+                            or record[key]["data"][datavaluetype] == ""
+                        ) and (
+                            records[record_type][record_id][key]["data"][datavaluetype]
+                            is not None
+                            and records[record_type][record_id][key]["data"][
+                                datavaluetype
+                            ]
+                            != ""
+                        ):
+                            # logging.debug(
+                            #     f"old -> new {key} {datavaluetype} = {extant_record[key]['data'][datavaluetype]}"
+                            # )
+                            record[key]["data"][datavaluetype] == extant_record[key][
+                                "data"
+                            ][datavaluetype]
+
+                        if (
+                            record[key]["attachments"]
+                            and not extant_record[key]["attachments"]
+                        ):
+                            logging.debug(f"new -> old, attachment {key}")
+                            records[record_type][record_id][key]["attachments"] = (
                                 record[key]["attachments"]
-                                and not extant_record[key]["attachments"]
-                            ):
-                                logging.debug(f"new -> old, attachment {key}")
-                                records[record_type][record_id][key][
-                                    "attachments"
-                                ] = record[key]["attachments"]
-
-                            if (
-                                extant_record[key]["attachments"]
-                                and not record[key]["attachments"]
-                            ):
-                                logging.debug(f"old -> new, attachment {key}")
-                                record[key]["attachments"] = records[record_type][
-                                    record_id
-                                ][key]["attachments"]
+                            )
 
-                    if (
-                        extant_record["metadata"]["updated_at"]
-                        < record["metadata"]["updated_at"]
-                    ):
-                        records[record_type][record_id] = record
+                        if (
+                            extant_record[key]["attachments"]
+                            and not record[key]["attachments"]
+                        ):
+                            logging.debug(f"old -> new, attachment {key}")
+                            record[key]["attachments"] = records[record_type][
+                                record_id
+                            ][key]["attachments"]
+
+                if (
+                    extant_record["metadata"]["updated_at"]
+                    < record["metadata"]["updated_at"]
+                ):
+                    records[record_type][record_id] = record
+
+            else:
+                records[record_type][
+                    record_id
+                ] = record  # 3.9 feature of dict union operator. Works exactly the way I wanted it to.
+
+            self.record_count[record_type] += 1
+        if record_id in records.get(record_type, {}):
+            self.metrics.count("records")
+            return record_type, record_id, records[record_type].pop(record_id)
+        return None
+
+    def resolve_relationships(self, metadata, strict=True):
+        """
+        Fill in the hrid and form of a record's parent from its record id.
 
-                else:
-                    records[record_type][
-                        record_id
-                    ] = record  # 3.9 feature of dict union operator. Works exactly the way I wanted it to.
+        Takes the ``metadata`` of a record (or a flattened row keyed by
+        ``metadata.*``). With ``strict=False`` a parent which hasn't been seen
+        yet is left unresolved and False is returned, so streaming exports can
+        patch it once every record has been fetched.
+        """
+        prefix = "" if "relationship_parent_record_id" in metadata else "metadata."
+        parent_id = metadata.get(f"{prefix}relationship_parent_record_id")
+        if not parent_id:
+            return True
+        if not strict and parent_id not in self.forms_from_record_id:
+            return False
+        metadata[f"{prefix}relationship_parent_record_hrid"] = self.identifiers.get(
+            parent_id,
+            "unknown parent",
+        )
+        metadata[f"{prefix}relationship_parent_record_form"] = self.record_type_names[
+            self.forms_from_record_id[parent_id]
+        ]
+        logging.debug(pformat(metadata))
+        return True
+
+    def iter_flattened_records(
+        self,
+        per_field_users=False,
+        external_attachments=True,
+        iterator="text",
+    ):
+        """
+        Yields ``(record_name, row, attachments, resolved)`` as records finish merging.
+
+        ``row`` has the same columns ``flatten_records`` gives its DataFrames.
+        ``resolved`` is False when the record's parent hasn't been fetched yet;
+        pass the row through ``resolve_relationships`` once everything is in.
+        """
+        for record_type, record_id, record in self.iter_records_for_roundtrip(
+            iterator=iterator
+        ):
+            record_name = self.record_type_names[record_type]
+            resolved = self.resolve_relationships(record["metadata"], strict=False)
+            record, attachments, _ = self.flatten_record(
+                record_name,
+                record_id,
+                record,
+                per_field_users=per_field_users,
+                external_attachments=external_attachments,
+            )
+            yield record_name, flatten_row(record), attachments, resolved
+
+    def fetch_records_for_roundtrip(
+        self,
+        match_uuids=[],
+        disable_progress_bars=False,
+        include_attachments=True,
+        iterator="text",
+    ):
+        """
+        Gets all records from a FAIMS3 CouchDB instance.
+
+        Given a faims object produced by the faims3couchdb class, flatten to JSON and get
+        the latest avps for all record types.
+        """
+
+        records = {}
+        for record_type, record_id, record in self.iter_records_for_roundtrip(
+            match_uuids=match_uuids,
+            disable_progress_bars=disable_progress_bars,
+            include_attachments=include_attachments,
+            iterator=iterator,
+        ):
+            if record_type not in records:
+                records[record_type] = {}
+            records[record_type][record_id] = record
 
-                self.record_count[record_type] += 1
         for form in records:
             for key in records[form]:
-                record = records[form][key]
-                if "relationship_parent_record_id" in record["metadata"]:
-                    records[form][key]["metadata"][
-                        "relationship_parent_record_hrid"
-                    ] = self.identifiers.get(
-                        records[form][key]["metadata"]["relationship_parent_record_id"],
-                        "unknown parent",
-                    )
-
-                    records[form][key]["metadata"][
-                        "relationship_parent_record_form"
-                    ] = self.record_type_names[
-                        self.forms_from_record_id[
-                            records[form][key]["metadata"][
-                                "relationship_parent_record_id"
-                            ]
-                        ]
-                    ]
-                    logging.debug(pformat(record["metadata"]))
+                self.resolve_relationships(records[form][key]["metadata"])
 
         self.records = records
         return records
 
     def get_fetched_records(self):
         """
-        Fetches and flattens if needed, otherwise returns records dict.
+        Fetches the records if needed (see ``fetch_records_for_roundtrip``),
+        otherwise returns records dict.
         """
 
         if self.records:
             return self.records
         else:
-            return self.fetch_and_flatten_records()
+            return self.fetch_records_for_roundtrip()
 
     def fetch_project_metadata(self, metadata_key="project-metadata-"):
         """
@@ -1261,7 +1794,7 @@ class CouchDBHelper:
         """
         project_metadata = {}
         url = f"{self.base_url}/{self.metadata}/_all_docs"
-        r = requests.post(
+        r = self.session.post(
             url,
             auth=self.auth_token,
             json={
@@ -1289,7 +1822,7 @@ class CouchDBHelper:
                     attach_base_url = f'{self.base_url}/{self.metadata}/{row["key"]}'
                     for attachment in row["doc"]["_attachments"]:
                         attach_url = f"{attach_base_url}/{attachment}"
-                        with requests.get(
+                        with self.session.get(
                             attach_url, auth=self.auth_token, stream=True
                         ) as attach_get:
                             attach_get.raise_for_status()
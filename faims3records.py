@@ -1,7 +1,9 @@
 import csv
 import datetime
 import geopandas
+import json
 import os
+import pandas
 import re
 import shutil
 import sys
@@ -9,8 +11,11 @@ import textwrap
 import unicodedata
 import tqdm
 from faims3couchdb import CouchDBHelper
+from export_writers import iter_dataframe_rows
+from export_geospatial import encode_features
+from export_parallel import run_output_tasks, write_layers_task
 
-from shapely.geometry import Point
+from shapely.geometry import shape
 import fiona
 from pathlib import Path
 
@@ -38,21 +43,27 @@ def slugify(value, allow_unicode=True):
     return re.sub(r'[-\s]+', '-', textwrap.shorten(value, width=200, placeholder=placeholder)).strip('-_')
 
 class FAIMS3Record:
-    def __init__(self, *, user, token, base_url, project_key):
+    def __init__(self, *, user, token, base_url, project_key, bearer_token=None):
         self.export_date = f"{datetime.date.today().isoformat()}"
         self.faims = CouchDBHelper(user=user
                           ,token=token
                           ,base_url=base_url
                           ,project_key=project_key
+                          ,bearer_token=bearer_token
                           )
         
 
-        self.records = self.faims.get_fetched_records()
-        self.record_fieldnames = self.faims.record_fieldnames
-        self.record_definitions = self.faims.record_definitions
+        # One DataFrame of flattened records per form, by form name
+        self.records, self.attachments, _ = self.faims.flatten_records()
+        self.record_fieldnames = {record_name: list(frame.columns)
+                                  for record_name, frame in self.records.items()}
+        # The fields of each form, by form name
+        self.record_definitions = {record_name: self.faims.form_fields.get(record_type, [])
+                                   for record_type, record_name in self.faims.record_type_names.items()}
         self.record_lookup_definitions = self.faims.record_fieldnames_odict
         self.field_metadata = self.faims.field_metadata
         self.records_with_points_gdf = None
+        self.geodataframes = {}
         self.clean_project_name = slugify(self.faims.project_id)
         self.base_export_path = Path(f'FAIMS3_Export+{self.export_date}+{self.clean_project_name}')
         self.project_metadata = self.faims.project_metadata
@@ -67,38 +78,79 @@ class FAIMS3Record:
         all_fields = self.field_metadata
 
 
-    def get_fetched_geodataframe(self):
-        if type(self.records_with_points_gdf) == None:
-            return self.get_geodataframes_for_take_points()
-        return self.records_with_points_gdf
+    def get_fetched_geodataframe(self, crs="EPSG:4326"):
+        """
+        Return the geodataframes for ``crs``, building them on first use.
+
+        Built layers are cached per CRS; other CRSs are reprojected from the
+        EPSG:4326 build rather than rebuilt from the records.
+        """
+        if crs not in self.geodataframes:
+            if crs == "EPSG:4326":
+                self.get_geodataframes_for_take_points(crs=crs)
+            else:
+                self.geodataframes[crs] = {
+                    layer: gdf.to_crs(crs)
+                    for layer, gdf in self.get_fetched_geodataframe().items()
+                }
+        return self.geodataframes[crs]
+
+
+    def get_geometry_columns(self, columns):
+        """
+        Find the geometry fields in a record type's columns.
+
+        Returns ``{field: (longitude column, latitude column)}`` for fields
+        with ``.x_longitude`` and ``.y_latitude`` columns, which are built
+        vectorised, and ``{field: geojson column}`` for fields only stored
+        as GeoJSON.
+        """
+        geometry_columns = {}
+        for column in columns:
+            if column.endswith('.y_latitude'):
+                field = column[:-len('.y_latitude')]
+                if f"{field}.x_longitude" in columns:
+                    geometry_columns[field] = (f"{field}.x_longitude", column)
+        for column in columns:
+            if column.endswith('.geojson'):
+                geometry_columns.setdefault(column[:-len('.geojson')], column)
+        return geometry_columns
 
 
     def get_geodataframes_for_take_points(self, crs="EPSG:4326"):
-        """ Make geodataframes for all geospatial records containing a take point button"""
+        """ Make geodataframes for every geometry field of every record type
+
+        Layers are keyed by record type, or ``record type-field`` when a
+        record type has more than one geometry field.
+        """
 
         records = self.records
         records_with_points_gdf = {}
         for recordtype in records:
-            #print(recordtype)
-            try:
-                #TODO this will need to be generalised for multiple geospatial datatypes
-                #     But it will wait until type is properly passed over to the data.
-                latitude_key = [x for x in records[recordtype][0].keys() if 'latitude' in x].pop()
-                longitude_key = [x for x in records[recordtype][0].keys() if 'longitude' in x].pop()                
-                geo_list_for_df = []
-                if latitude_key and longitude_key:
-                    for record in records[recordtype]:
-                        if longitude := record.get(longitude_key):
-                            if latitutde := record.get(latitude_key):
-                                geo_record = record | {'geometry': Point(longitude, latitutde)}
-                                geo_list_for_df.append(geo_record)
-                if geo_list_for_df:
-                    records_with_points_gdf[recordtype] = geopandas.GeoDataFrame(geo_list_for_df, crs=crs)
-            except IndexError:
-                # No key found
-                continue
-
-        self.records_with_points_gdf = records_with_points_gdf
+            frame = pandas.DataFrame(records[recordtype])
+            geometry_columns = self.get_geometry_columns(list(frame.columns))
+            for field, columns in geometry_columns.items():
+                if isinstance(columns, tuple):
+                    longitude = pandas.to_numeric(frame[columns[0]], errors='coerce')
+                    latitude = pandas.to_numeric(frame[columns[1]], errors='coerce')
+                    # Matches the old truthiness check, which skipped 0 and missing values
+                    present = longitude.notna() & latitude.notna() & (longitude != 0) & (latitude != 0)
+                    geometry = geopandas.points_from_xy(longitude[present], latitude[present], crs=crs)
+                else:
+                    present = frame[columns].notna()
+                    geometry = geopandas.GeoSeries(
+                        [shape(json.loads(value) if isinstance(value, str) else value)
+                         for value in frame.loc[present, columns]],
+                        crs=crs).values
+                if not present.any():
+                    continue
+                layer = recordtype if len(geometry_columns) == 1 else f"{recordtype}-{slugify(field)}"
+                records_with_points_gdf[layer] = geopandas.GeoDataFrame(
+                    frame.loc[present].reset_index(drop=True), geometry=geometry, crs=crs)
+
+        self.geodataframes[crs] = records_with_points_gdf
+        if crs == "EPSG:4326":
+            self.records_with_points_gdf = records_with_points_gdf
         return records_with_points_gdf
 
 
@@ -142,7 +194,7 @@ class FAIMS3Record:
             csvs[record_type]=({ 'record_type': record_type
                         , 'record_definition': self.record_definitions[record_type]
                         , 'field_mappings': self.record_fieldnames
-                        , 'csv_file':self.to_csv(records=records[record_type]
+                        , 'csv_file':self.to_csv(records=iter_dataframe_rows(records[record_type])
                                            ,fieldnames=self.record_fieldnames[record_type]
                                            ,basedir=basedir
                                            ,filename=f"{basefilename}-{record_type}")})
@@ -157,12 +209,11 @@ class FAIMS3Record:
                      , delimiter="+"):
 
         if basefilename is None:
-            basefilename = f"{self.export_date}+{self.project_id}"
+            basefilename = f"{self.export_date}+{self.clean_project_name}"
         
-        records = self.records
         gdf = self.get_fetched_geodataframe()
 
-        for recordtype in records:
+        for recordtype in gdf:
             gdf[recordtype].to_file(f"{basefilename}{delimiter}{recordtype}.shp", driver="ESRI Shapefile")                            
 
     def to_geojson(self
@@ -170,38 +221,41 @@ class FAIMS3Record:
                   , delimiter="+"):
         
         if basefilename is None:
-            basefilename = f"{self.export_date}+{self.project_id}"
+            basefilename = f"{self.export_date}+{self.clean_project_name}"
 
-        records = self.get_fetched_records()
         gdf = self.get_fetched_geodataframe()
 
-
-        for recordtype in records:
+        for recordtype in gdf:
             gdf[recordtype].to_file(f"{basefilename}{delimiter}{recordtype}.geojson", driver='GeoJSON')                            
 
     def to_geopackage(self
                      , basefilename=None):
         
         if basefilename is None:
-            basefilename = f"{self.export_date}+{self.project_id}"
+            basefilename = f"{self.export_date}+{self.clean_project_name}"
 
-        records = self.records
         gdf = self.get_fetched_geodataframe()
         
-        for recordtype in records:
+        for recordtype in gdf:
             gdf[recordtype].to_file(f"{basefilename}.gpkg", layer=recordtype, driver="GPKG")                            
 
 
     def write_all_geospatial_to_dirs(self
-                                    , basedir = None):
+                                    , basedir = None
+                                    , workers = 4):
         """
-        Placeholder until we get geojson stuffs, but this should detect lat-long and dump a shapefile.
+        Write every geospatial layer as a Shapefile, GeoJSON, KML and a GeoPackage layer.
+
+        Each layer is prepared once and the four drivers run as separate
+        tasks, ``workers`` at a time.
         """
 
         if basedir is None:
             basedir = self.base_export_path
 
-        gdf = self.get_geodataframes_for_take_points()
+        gdf = self.get_fetched_geodataframe()
+        encoded = {recordtype: encode_features(gdf[recordtype]) for recordtype in gdf}
+        basefilename = f"{self.export_date}+{self.clean_project_name}"
         
         shapedir = basedir / "shapefile"
         geojsondir = basedir / "geojson"
@@ -211,11 +265,18 @@ class FAIMS3Record:
         geojsondir.mkdir(parents=True, exist_ok=True)
         kmldir.mkdir(parents=True, exist_ok=True)
 
-        for recordtype in gdf:
-            gdf[recordtype].to_file( shapedir / f"{self.export_date}+{self.clean_project_name}+{recordtype}.shp", driver="ESRI Shapefile")
-            gdf[recordtype].to_file( geojsondir / f"{self.export_date}+{self.clean_project_name}+{recordtype}.geojson", driver='GeoJSON')
-            gdf[recordtype].to_file( basedir / f"{self.export_date}+{self.clean_project_name}+sqlite.gpkg", layer=recordtype, driver="GPKG")
-            gdf[recordtype].to_file( kmldir / f"{self.export_date}+{self.clean_project_name}+{recordtype}.kml", driver='KML')
+        tasks = []
+        for driver, directory, extension in (("ESRI Shapefile", shapedir, "shp")
+                                             , ("GeoJSON", geojsondir, "geojson")
+                                             , ("KML", kmldir, "kml")):
+            outputs = [(recordtype, directory / f"{basefilename}+{recordtype}.{extension}", None)
+                       for recordtype in encoded]
+            tasks.append((driver, write_layers_task, (driver, outputs)))
+        outputs = [(recordtype, basedir / f"{basefilename}+sqlite.gpkg", recordtype)
+                   for recordtype in encoded]
+        tasks.append(("GPKG", write_layers_task, ("GPKG", outputs)))
+
+        return run_output_tasks(tasks, encoded, workers=workers)
 
     def move_metadata_attachments_to_dir(self,
                                          basedir = None):
@@ -7,9 +7,12 @@ from pprint import pprint, pformat
 
 
 import requests
-from faims3couchdb import CouchDBHelper, create_new_avp, create_new_revision
-from faims3records import FAIMS3Record
-from export_csv import export_csv
+from export_csv import FORMATS
+from export_form_cache import FORM_CACHE_DIR
+from export_job import archive_filename
+from export_jobs import ExportJob
+from export_preflight import describe_settings
+from export_workspace import WorkspaceManager
 from pathlib import Path
 from slugify import slugify
 import datetime
@@ -17,18 +20,16 @@ import logging
 import shutil
 import os
 from tqdm.auto import tqdm
-import zipfile
 from IPython.display import FileLink, HTML, display
 import IPython
-from notebook import notebookapp
-import tarfile
 import logging
 import time
 import os
-from github import Github
 import traceback
 import textwrap
 import functools
+import html
+import threading
 
 
 class BearerAuth(requests.auth.AuthBase):
@@ -46,6 +47,18 @@ log.setLevel(logging.INFO)
 
 
 OUTPUT = Path("output")
+# ui-specifications fetched by this kernel, revalidated before each reuse
+SCHEMA_CACHE = {}
+# Each export is written to its own workspace under OUTPUT/users/<user>
+WORKSPACES = WorkspaceManager(
+    OUTPUT,
+    ttl=float(os.environ.get("EXPORT_TTL_HOURS", 24 * 7)) * 3600,
+    quota=(
+        int(os.environ["EXPORT_QUOTA_MB"]) * 1024 * 1024
+        if os.environ.get("EXPORT_QUOTA_MB")
+        else None
+    ),
+)
 FORMAT = (
     "[%(asctime)s %(filename)s->%(funcName)s():%(lineno)s]%(levelname)s: %(message)s"
 )
@@ -64,14 +77,22 @@ layout_visible = widgets.Layout(display="block")
 desc_style = {"description_width": "initial"}
 
 
-envvars = []
-for name, value in os.environ.items():
-    envvars.append("<li><pre>{0}: {1}</pre></li>".format(name, value))
-display(
-    HTML(
-        f"<details><summary>Debug Variables</summary><ul>{' '.join(envvars)}</ul></details>"
-    )
-)
+debug_out = widgets.Output(layout={"border": "0px solid black"})
+
+
+def show_debug_variables(button):
+    # Only built when asked for, rather than on every page load
+    envvars = []
+    for name, value in os.environ.items():
+        envvars.append("<li><pre>{0}: {1}</pre></li>".format(name, value))
+    with debug_out:
+        debug_out.clear_output()
+        display(HTML(f"<ul>{' '.join(envvars)}</ul>"))
+
+
+debug_button = widgets.Button(description="Debug variables", icon="bug")
+debug_button.on_click(show_debug_variables)
+display(widgets.VBox([debug_button, debug_out]))
 
 
 bearer_token = widgets.Text(
@@ -132,6 +153,9 @@ def validateURL(change):
                 organisation = urlsplit[3]
                 repo_name = urlsplit[4]
                 display(HTML(f"<li>Parsed {organisation=} {repo_name=}</li>"))
+                # Imported here as PyGithub is slow to import
+                from github import Github
+
                 g = Github()
                 repo = g.get_repo(f"{organisation}/{repo_name}")
                 readme = repo.get_contents("README.md")
@@ -251,10 +275,12 @@ def validate_database_connection(button):
             notebook_select.observe(get_notebook_readme, names="value")
             get_notebook_readme(change={"new": notebook_select.value})
             display(notebook_select)
-            # display(overwrite_checkbox)
             # display(list_checkbox)
             display(github_url_text)
             display(out_url)
+            display(xlsx_checkbox)
+            display(stream_checkbox)
+            display(resume_checkbox)
             display(export_button)
             # list_notebooks()
             display(out2)
@@ -326,154 +352,124 @@ def export_notebook(button):
     token = decode_token()
     notebook_id = notebook_select.value["notebook"]["_id"]
     server = token["base_url"]
-    export_path_test = OUTPUT / f"{slugify(server)}+{notebook_id}"
-    backup = export_path_test / "database_backup"
-
-    zip_filename = f"{slugify(datetime.datetime.now().isoformat(timespec='minutes'))}+{notebook_id}+{slugify(server.replace('https',''))}.zip"
-    tar_filename = f"{slugify(datetime.datetime.now().isoformat(timespec='minutes'))}+{notebook_id}+{slugify(server.replace('https',''))}.tgz"
-    if export_path_test.exists():
-        if overwrite_checkbox.value:
-            shutil.rmtree(OUTPUT, ignore_errors=True)
-            # shutil.rmtree(OUTPUT / zip_filename, ignore_errors=True)
-        else:
-            print("Output path exists. Please check 'overwrite' and try again!'")
-            return
-    print(f"Exporting notebook with id: {notebook_id} on {server}")
 
-    export_csv(
-        user=None,
-        token=None,
-        bearer_token=token["jwt_token"],
-        base_url=server,
-        project_key=notebook_id,
-        inline_attachments=False,
-        external_attachments=True,
-    )
-
-    backup.mkdir(parents=True)
-    # Get readme, citation.cff, zipped repository, and replication streams for data and metadata
-    metadata_doc = get_exporter_metadata()
-    if "repository" in metadata_doc:
-        g = Github()
-        repo = g.get_repo(f"{metadata_doc['organisation']}/{metadata_doc['repo_name']}")
-        try:
-            readme = repo.get_contents("README.md")
-            with open(export_path_test / "README.md", "wb") as readme_file:
-                readme_file.write(base64.b64decode(readme.content))
-        except Exception as e:
-            print(f"Unable to save README.md. Reason: {e}")
-        try:
-            citation = repo.get_contents("CITATION.cff")
-            with open(export_path_test / "CITATION.cff", "wb") as citation_file:
-                citation_file.write(base64.b64decode(citation.content))
-        except Exception as e:
-            print(f"Unable to save CITATION.cff. Reason: {e}")
-
-        # print(repo.master_branch)
-        archive_url = repo.get_archive_link("tarball")
-        # archive_url.format({'archive_format': "zip", })
-        print(f"Downloading: {archive_url}")
-        try:
-            with requests.get(archive_url, stream=True) as archive_download:
-                with open(
-                    backup
-                    / f"{metadata_doc['organisation']}-{metadata_doc['repo_name']}.zip",
-                    "wb",
-                ) as archive_file:
-                    archive_download.raw.read = functools.partial(
-                        archive_download.raw.read, decode_content=True
-                    )
+    tar_filename = archive_filename(server, notebook_id)
+    resume = resume_checkbox.value and not stream_checkbox.value
+    workspace = WORKSPACES.create(token["sub"], server, notebook_id, resume=resume)
+    if workspace.resumed:
+        print("Resuming the previous export of this notebook")
+    print(f"Exporting notebook with id: {notebook_id} on {server}")
 
-                    shutil.copyfileobj(archive_download.raw, archive_file)
-        except Exception as e:
-            print(f"Unable to download repository. Reason: {e}")
-
-    def export_all_docs(token, db_prefix, notebook_id, filename):
-        auth_token = BearerAuth(token["jwt_token"])
-        url = f"{token['base_url']}/{db_prefix}-{notebook_id}/_all_docs"
-
-        # Get number of couchdb documents to fetch
-        prefetch_url = f"{token['base_url']}/{db_prefix}-{notebook_id}/_all_docs?limit=1"
-        with requests.get(prefetch_url, auth=auth_token) as response:
-            response.raise_for_status()
-            total = response.json()["total_rows"] + 2 # to account for start and end plus the total row count
-
-        print("Number of records to fetch", total)
-        current=0
-        with requests.post(
-            url,
-            auth=auth_token,
-            json={"include_docs": True, "attachments": True},
-            stream=True,
-        ) as response:
-            response.raise_for_status()
-            with tqdm(
-                    desc=f"Writing {db_prefix} as json backup",
-                    # set the total to total
-                    total=total,
-                    unit="recs",
-                    ) as iterator:
-                with open(filename, "wb") as json_file:
-                    # json.dump(response.json(), json_file)
-                    for chunk in response.iter_content(chunk_size=8192):
-                        # update tqdm iterator when we get to the end of a record, defined as a newline
-                        if "\n" in chunk.decode("utf-8"):
-                            # Count number of newlines, since a chunk may have zero or more
-                            current += chunk.decode("utf-8").count("\n")
-                            iterator.n = current
-                            iterator.refresh()
-                            # iterator.write(f"Current record: {current}")
-                        json_file.write(chunk)
-
-    export_all_docs(
-        token,
-        "metadata",
+    if stream_checkbox.value:
+        stream_path = (workspace.path / tar_filename).relative_to(OUTPUT).as_posix()
+        display(
+            HTML(
+                f"<li><a href='{os.environ.get('VOILA_BASE_URL', '/')}export-stream/{stream_path}'>Download export as it is written: {tar_filename}</a></li>"
+            )
+        )
+    job = ExportJob(
+        server,
         notebook_id,
-        backup / f"metadata_db-{notebook_id}.json",
+        workspace=workspace,
+        schema_cache=SCHEMA_CACHE,
+        bearer_token=token["jwt_token"],
+        formats=[
+            table_format
+            for table_format in FORMATS
+            if table_format != "xlsx" or xlsx_checkbox.value
+        ],
+        # Estimated on the job's thread, which then picks the settings
+        preflight=True,
+        streaming=stream_checkbox.value,
+        stream_archive=stream_checkbox.value,
+        resume=resume,
+        # The workspace only holds this user's exports of this notebook, so
+        # the "Output path exists" prompt and its overwrite checkbox went:
+        # an export that isn't resumed replaces the previous one
+        overwrite=True,
+        archive_name=tar_filename,
+        # e.g. EXPORT_PROFILE=sampling to diagnose a slow notebook
+        profile=os.environ.get("EXPORT_PROFILE") or None,
+        prometheus_file=os.environ.get("EXPORT_PROMETHEUS_FILE"),
+        # Shared by every workspace, which only live as long as their job
+        form_cache=OUTPUT / FORM_CACHE_DIR,
     )
-    export_all_docs(
-        token, "data", notebook_id, backup / f"data_db-{notebook_id}.json"
+    # The export runs on its own thread so the kernel keeps handling widget
+    # messages, such as the cancel button, while it runs
+    progress_bar = widgets.FloatProgress(
+        value=0, min=0, max=1, description="Exporting", style=desc_style
     )
+    progress_text = widgets.HTML()
+    cancel_button = widgets.Button(description="Cancel export", icon="stop")
+    cancel_button.on_click(lambda button: job.cancel())
+    display(widgets.HBox([progress_bar, cancel_button]), progress_text)
+    export_button.disabled = True
+    job.start()
+    threading.Thread(
+        target=watch_export,
+        args=(job, progress_bar, progress_text, cancel_button),
+        daemon=True,
+    ).start()
+
+
+def describe_progress(progress):
+    parts = [progress["state"]]
+    if progress["phases"]:
+        parts.append(progress["phases"][-1].replace("_", " "))
+    if progress["expected"] is not None:
+        parts.append(f"{progress['records']} of {progress['expected']} records")
+    else:
+        parts.append(f"{progress['records']} records")
+    if progress["records_per_second"]:
+        parts.append(f"{progress['records_per_second']:.1f} records/s")
+    if progress["megabytes_per_second"]:
+        parts.append(f"{progress['megabytes_per_second']:.2f} MB/s")
+    parts.append(f"{progress['elapsed']:.0f}s elapsed")
+    if progress["eta"] is not None:
+        parts.append(f"about {progress['eta']:.0f}s left")
+    return ", ".join(parts)
+
+
+def watch_export(job, progress_bar, progress_text, cancel_button, interval=0.5):
+    """
+    Update the progress widgets of ``job`` until it finishes, then list the
+    downloads. Runs on its own thread, so output goes to ``out2`` with
+    ``append_display_data`` rather than ``capture``.
+    """
+    estimated = False
+    while job.is_alive():
+        if not estimated and (job.settings or job.preflight_error):
+            estimated = True
+            if job.settings:
+                out2.append_stdout(f"{describe_settings(job.settings)}\n")
+            else:
+                out2.append_stdout(
+                    "Unable to estimate the export, using the default settings: "
+                    f"{job.preflight_error}\n"
+                )
+        progress = job.progress()
+        if progress["fraction"] is not None:
+            progress_bar.value = progress["fraction"]
+        progress_text.value = describe_progress(progress)
+        job.join(interval)
+    progress = job.progress()
+    progress_text.value = describe_progress(progress)
+    cancel_button.disabled = True
+    export_button.disabled = False
+    if job.state == "done":
+        progress_bar.value = 1
+        progress_bar.bar_style = "success"
+    else:
+        progress_bar.bar_style = "danger" if job.state == "failed" else "warning"
+        out2.append_display_data(
+            HTML(f"<p>Export {job.state}: {html.escape(repr(job.error))}</p>")
+        )
+    out2.append_display_data(HTML(downloads_html(job.workspace.user)))
 
-    if export_path_test.exists():
-        # print("Zipping output/ directory")
-        # with zipfile.ZipFile(
-        #     OUTPUT / zip_filename,
-        #     mode="w",
-        #     compression=zipfile.ZIP_BZIP2,
-        #     compresslevel=5,
-        # ) as outputzip:
-        #     with tqdm(
-        #         export_path_test.glob("**/*"),
-        #         desc="Preparing zip file",
-        #     ) as iterator:
-        #         for file in iterator:
-        #             target_file = str(file).replace(
-        #                 f"{OUTPUT / slugify(server)}",
-        #                 f"{datetime.date.today().isoformat()}",
-        #             )
-        #             # if list_checkbox.value:
-        #             #     iterator.write(target_file)
-
-        #             outputzip.write(file, arcname=target_file)
-        with tarfile.open(OUTPUT / tar_filename, "w:gz") as outputtar:
-            with tqdm(
-                export_path_test.glob("**/*"),
-                desc="Preparing tar file",
-                total=len(list(export_path_test.glob("**/*"))),
-            ) as iterator:
-                for file in iterator:
-                    target_file = str(file).replace(
-                        f"{OUTPUT / slugify(server)}",
-                        f"{datetime.date.today().isoformat()}",
-                    )
-                    outputtar.add(file, arcname=target_file, recursive=False)
-                    # if list_checkbox.value:
-                    #     iterator.write(target_file)
 
-    else:
-        print("No records exported")
-    display(HTML("<h2>Downloads</h2><ul>"))
+def downloads_html(user):
+    # Imported here as it is only needed once an export has finished
+    from notebook import notebookapp
 
     running_in_voila = os.environ.get("SERVER_SOFTWARE", "jupyter").startswith("voila")
 
@@ -488,13 +484,14 @@ def export_notebook(button):
     # )
     # print(running_in_voila and os.environ.get("SERVER_PORT") == "8866")
 
-    for file in OUTPUT.glob("*.tgz"):
-        local_url = HTML(
+    links = []
+    for download in WORKSPACES.downloads(user):
+        file = OUTPUT / download["archive"]
+        links.append(
             f"<li><a href='{os.environ.get('VOILA_BASE_URL', '/')}{files_path}{file}'>Download export: {str(file).replace('output/','')}</li>"
         )
         # local_file = FileLink(file, result_html_prefix="Click here to download: ")
-        display(local_url)
-    display(HTML("</ul>"))
+    return f"<h2>Downloads</h2><ul>{''.join(links)}</ul>"
 
 
 @out_url.capture()
@@ -518,14 +515,26 @@ notebook_select = widgets.Dropdown(
 )
 
 
-overwrite_checkbox = widgets.Checkbox(
+list_checkbox = widgets.Checkbox(
+    value=True, description="List files in export", indent=False, style=desc_style
+)
+resume_checkbox = widgets.Checkbox(
     value=True,
-    description="Overwrite output directory when exporting",
+    description="Resume an interrupted export of this notebook (not with streaming archives)",
     indent=False,
     style=desc_style,
 )
-list_checkbox = widgets.Checkbox(
-    value=True, description="List files in export", indent=False, style=desc_style
+stream_checkbox = widgets.Checkbox(
+    value=False,
+    description="Stream the archive while exporting (the download starts straight away)",
+    indent=False,
+    style=desc_style,
+)
+xlsx_checkbox = widgets.Checkbox(
+    value=True,
+    description="Include Excel (.xlsx) spreadsheets (slower for large notebooks)",
+    indent=False,
+    style=desc_style,
 )
 
 export_button = widgets.Button(
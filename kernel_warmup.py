@@ -0,0 +1,157 @@
+"""
+Support for the pool of preheated Voila kernels configured in ``voila.py``.
+
+A preheated kernel runs ``exporter.ipynb`` before anyone asks for it, as far
+as ``wait_for_session``: the interface is built, and ``warm_up`` imports the
+rest of the exporter stack, including the dependencies the exporter
+otherwise imports on first use. The kernel then waits there until Voila hands
+it to a visitor, who sees the token field straight away.
+
+Every session is logged to SESSION_LOG as a hit (a preheated kernel) or a
+miss (a kernel started for the visitor, because the pool was empty or
+disabled), with how long the visitor waited for it. ``python
+kernel_warmup.py`` summarises the log, to size the pool for busy days.
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from importlib import import_module
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Hidden from the Voila file server, which blocks dot files
+SESSION_LOG = Path(os.environ.get("EXPORTER_SESSION_LOG", ".kernel-sessions.jsonl"))
+# Imported by warm_up: the exporter modules, then what they import on demand
+WARM_MODULES = (
+    "export_job",
+    "export_jobs",
+    "export_workspace",
+    "pandas",
+    "shapely.geometry",
+    "xlsxwriter",
+    "export_geospatial",
+    "github",
+)
+
+
+def preheated():
+    """
+    Whether this kernel belongs to Voila's pool of preheated kernels.
+    """
+    return os.environ.get("VOILA_PREHEAT") == "True"
+
+
+def warm_up(modules=WARM_MODULES):
+    """
+    Import ``modules``, skipping any that aren't installed. Returns the
+    seconds taken.
+    """
+    start = time.perf_counter()
+    for module in modules:
+        try:
+            import_module(module)
+        except ImportError as e:
+            log.warning(f"Not warming {module}: {e}")
+    return time.perf_counter() - start
+
+
+def _kernel_age():
+    if psutil is None:
+        return None
+    return time.time() - psutil.Process().create_time()
+
+
+def wait_for_session():
+    """
+    In a preheated kernel, warm up and then wait for Voila to hand the
+    kernel to a visitor, whose request (query string and so on) is then in
+    ``os.environ``. Elsewhere this returns straight away.
+
+    Either way the session is logged to SESSION_LOG.
+    """
+    entry = {"hit": preheated()}
+    if entry["hit"]:
+        entry["warm_up_seconds"] = warm_up()
+        from voila.utils import wait_for_request
+
+        waiting = time.perf_counter()
+        wait_for_request()
+        entry["pooled_seconds"] = time.perf_counter() - waiting
+        # The visitor only waited for the page to be sent
+        entry["startup_seconds"] = 0.0
+    else:
+        # The visitor waited for the kernel to start and run the notebook
+        entry["startup_seconds"] = _kernel_age()
+    entry["time"] = time.time()
+    record_session(entry)
+    return entry
+
+
+def record_session(entry, path=SESSION_LOG):
+    try:
+        # One short append per line, so kernels can share the log
+        with open(path, "a") as session_log:
+            session_log.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        log.warning(f"Unable to log the kernel session to {path}: {e}")
+
+
+def summarise(path=SESSION_LOG, since=None):
+    """
+    Hits, misses and hit rate of the sessions logged at or after ``since``
+    (a Unix time), with the median and 95th percentile wait on a miss.
+    """
+    counts = Counter()
+    miss_waits = []
+    with open(path) as session_log:
+        for line in session_log:
+            entry = json.loads(line)
+            if since is not None and entry["time"] < since:
+                continue
+            counts["hits" if entry["hit"] else "misses"] += 1
+            if not entry["hit"] and entry.get("startup_seconds") is not None:
+                miss_waits.append(entry["startup_seconds"])
+    miss_waits.sort()
+    sessions = counts["hits"] + counts["misses"]
+    return {
+        "sessions": sessions,
+        "hits": counts["hits"],
+        "misses": counts["misses"],
+        "hit_rate": counts["hits"] / sessions if sessions else None,
+        "miss_wait_median": statistics.median(miss_waits) if miss_waits else None,
+        "miss_wait_p95": (
+            miss_waits[int(0.95 * (len(miss_waits) - 1))] if miss_waits else None
+        ),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarise the hits and misses of the preheated kernel pool."
+    )
+    parser.add_argument("--log", type=Path, default=SESSION_LOG)
+    parser.add_argument(
+        "--hours", type=float, help="Only count sessions from the last HOURS"
+    )
+    args = parser.parse_args(argv)
+    since = time.time() - args.hours * 3600 if args.hours else None
+    for name, value in summarise(args.log, since).items():
+        print(f"{name}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,504 @@
+"""
+Re-import an edited export back into CouchDB, writing only what changed.
+
+This is the roundtrip described in ``export_csv``: ``plan_reimport`` loads
+an edited form table (the CSV or XLSX of one form from an export) and
+diffs it against the revisions its rows were exported from, and
+``reimport`` commits the differences, as new AVPs and revisions on top of
+the records' current heads, with ``CouchDBHelper.bulk_update_records``.
+
+The diff is column-wise over the whole table: the exported values are
+fetched a batch of records at a time (the records, their head revisions and
+their AVPs, one ``_all_docs`` request each, and the same again for the
+revisions of records edited since the export), rendered the way the export
+writes them, and compared with the edited table in one vectorised
+comparison. Only the cells that differ are parsed back into values, so a
+50,000 row sheet with a dozen edits costs a dozen new AVPs and revisions.
+
+Rows are matched by ``metadata.record_id``, and to the revision they were
+exported from by ``metadata.updated_at`` and ``metadata.updates``. Columns
+are matched to fields by the labels ``fetch_field_metadata`` gives them.
+Values, annotations and uncertainty can be edited; locations, attachments,
+relationships and the other metadata columns can't, and are ignored.
+
+This is a three-way diff, so edits made in CouchDB since the export are
+kept: a cell edited in the table is written unless CouchDB changed it too,
+in which case it is left alone and reported as a conflict. Records in
+conflict (with several heads) are skipped, as are rows whose record or
+exported revision is missing or deleted.
+
+From the command line::
+
+    python reimport.py --project KEY --token "$FAIMS_TOKEN" --by "me" Form.csv
+"""
+
+import argparse
+import ast
+import datetime
+import logging
+import os
+import re
+import sys
+from pathlib import Path
+from uuid import uuid4
+
+import pandas
+
+from export_job import parse_bearer_token
+from faims3couchdb import CouchDBHelper, create_new_avp, create_new_revision
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+ID_COLUMN = "metadata.record_id"
+# Together give the revision a row was exported from
+UPDATED_AT_COLUMN = "metadata.updated_at"
+UPDATES_COLUMN = "metadata.updates"
+# Types whose values the export flattens into several columns or files
+UNEDITABLE_TYPES = {
+    "faims-pos::Location",
+    "faims-attachment::Files",
+    "faims-core::Relationship",
+}
+# Records fetched per batch of requests when reading the current values
+FETCH_BATCH = 500
+
+
+def load_table(path, sheet_name=0):
+    """
+    Load an edited form table, every cell as the text it shows.
+    """
+    path = Path(path)
+    if path.suffix.lower() in (".xlsx", ".xls"):
+        table = pandas.read_excel(
+            path, sheet_name=sheet_name, dtype=str, keep_default_na=False
+        )
+    else:
+        table = pandas.read_csv(path, dtype=str, keep_default_na=False)
+    for column in (ID_COLUMN, UPDATED_AT_COLUMN, UPDATES_COLUMN):
+        if column not in table.columns:
+            raise ValueError(f"{path} has no {column} column to match records by")
+    return table
+
+
+def exported_revision(updated_at, updates):
+    """
+    The id of the revision a row was exported from: the one its
+    ``metadata.updates`` lists as created at its ``metadata.updated_at``.
+    None if that can't be told.
+    """
+    # Much quicker than parsing every row's history
+    match = re.search(
+        rf"\('{re.escape(updated_at)}', \{{[^{{}}]*'revision_key': '([^']+)'",
+        updates,
+    )
+    if match:
+        return match[1]
+    if updates.startswith("OrderedDict(") and updates.endswith(")"):
+        updates = updates[len("OrderedDict(") : -1]
+    try:
+        updates = ast.literal_eval(updates)
+    except (ValueError, SyntaxError):
+        return None
+    if isinstance(updates, dict):
+        updates = updates.items()
+    for created, update in updates:
+        if created == updated_at and isinstance(update, dict):
+            return update.get("revision_key")
+    return None
+
+
+def render(value):
+    """
+    A value as the export writes it to CSV.
+    """
+    if value is None:
+        return ""
+    return str(value)
+
+
+def parse(text, current):
+    """
+    Edited ``text`` as a value of the type of the ``current`` value.
+
+    Raises ValueError when the text can't be one.
+    """
+    if isinstance(current, bool):
+        if text.strip().lower() in ("true", "1", "yes"):
+            return True
+        if text.strip().lower() in ("false", "0", "no", ""):
+            return False
+        raise ValueError(f"{text!r} is not a boolean")
+    if text == "" and not isinstance(current, str):
+        return None
+    if isinstance(current, int):
+        try:
+            return int(text)
+        except ValueError:
+            return float(text)
+    if isinstance(current, float):
+        return float(text)
+    if isinstance(current, list):
+        value = ast.literal_eval(text)
+        if not isinstance(value, list):
+            raise ValueError(f"{text!r} is not a list")
+        return value
+    return text
+
+
+def editable(value):
+    return not (
+        isinstance(value, dict)
+        or isinstance(value, list)
+        and any(isinstance(item, (dict, list)) for item in value)
+    )
+
+
+def form_columns(helper, record_type, columns):
+    """
+    The editable columns of the form ``record_type`` present in
+    ``columns``, as a dict of column to ``(field, part)``, where part is
+    "value", "annotation" or "uncertainty".
+    """
+    planned = {}
+    for field in helper.form_fields.get(record_type, []):
+        data = helper.field_metadata.get(field)
+        if not data:
+            continue
+        label = helper.field_mapping.get(field, field)
+        if data["type-returned"] not in UNEDITABLE_TYPES:
+            planned[label] = (field, "value")
+        planned[f"{label}.data.annotation"] = (field, "annotation")
+        planned[f"{label}.data.uncertainty"] = (field, "uncertainty")
+    return {column: planned[column] for column in columns if column in planned}
+
+
+def _current_value(avp, part):
+    if part == "value":
+        return avp.get("data")
+    annotations = avp.get("annotations") or {}
+    if part == "annotation":
+        return annotations.get("annotation") or None
+    return bool(annotations.get("uncertainty"))
+
+
+def _fetch_revisions(helper, revision_ids):
+    revisions = helper.get_documents(revision_ids)
+    avps = helper.get_documents(
+        avp_id
+        for revision in revisions.values()
+        if not revision.get("deleted")
+        for avp_id in revision["avps"].values()
+    )
+    return {
+        revision_id: (
+            revision,
+            {
+                field: avps[avp_id]
+                for field, avp_id in revision["avps"].items()
+                if avp_id in avps
+            },
+        )
+        for revision_id, revision in revisions.items()
+        if not revision.get("deleted")
+    }
+
+
+def fetch_revisions(helper, revision_ids):
+    """
+    Each revision in ``revision_ids`` which isn't deleted and its AVPs, by
+    field, as ``{revision_id: (revision, avps)}``.
+    """
+    found = {}
+    revision_ids = list(revision_ids)
+    for start in range(0, len(revision_ids), FETCH_BATCH):
+        found.update(
+            _fetch_revisions(helper, revision_ids[start : start + FETCH_BATCH])
+        )
+    return found
+
+
+def fetch_heads(helper, record_ids):
+    """
+    The head revision and its AVPs, by field, of each record in
+    ``record_ids`` with a single head, as ``{record_id: (revision, avps)}``,
+    and the ids of those in conflict (with several heads).
+    """
+    heads = {}
+    conflicted = []
+    record_ids = list(record_ids)
+    for start in range(0, len(record_ids), FETCH_BATCH):
+        records = helper.get_documents(record_ids[start : start + FETCH_BATCH])
+        head_ids = {}
+        for record_id, record in records.items():
+            if len(record.get("heads", [])) != 1:
+                conflicted.append(record_id)
+                continue
+            head_ids[record["heads"][0]] = record_id
+        for revision_id, head in _fetch_revisions(helper, head_ids).items():
+            heads[head_ids[revision_id]] = head
+    return heads, conflicted
+
+
+def plan_reimport(helper, table, created_by, created=None):
+    """
+    Diff an edited form ``table`` (see ``load_table``) against the revisions
+    its rows were exported from, and plan writing the differences on top of
+    the records' current head revisions.
+
+    Returns ``(updates, changes)``: the ``(new_revision, new_avps)`` to pass
+    to ``bulk_update_records``, and a DataFrame of the cells changed, with
+    the record, column, exported (``old``), current and new value. Cells
+    also changed in CouchDB since the export are flagged in ``conflict``
+    and left out of the updates.
+    """
+    created = created or datetime.datetime.now(datetime.timezone.utc).isoformat()
+    table = table.drop_duplicates(ID_COLUMN, keep="last").set_index(ID_COLUMN)
+    exported = {
+        record_id: exported_revision(updated_at, updates)
+        for record_id, updated_at, updates in zip(
+            table.index, table[UPDATED_AT_COLUMN], table[UPDATES_COLUMN]
+        )
+    }
+    unknown = [record_id for record_id, revision in exported.items() if not revision]
+    if unknown:
+        log.warning(
+            f"Skipping {len(unknown)} rows whose exported revision isn't known "
+            f"from their {UPDATED_AT_COLUMN} and {UPDATES_COLUMN}"
+        )
+    heads, conflicted = fetch_heads(helper, table.index.difference(unknown))
+    if conflicted:
+        log.warning(f"Skipping {len(conflicted)} rows whose record is in conflict")
+    missing = table.index.difference(list(heads)).difference(unknown + conflicted)
+    if len(missing):
+        log.warning(f"Skipping {len(missing)} rows without a record to update")
+
+    # Records edited since the export are diffed against the exported revision
+    edited_since = {
+        record_id: exported[record_id]
+        for record_id, (revision, _) in heads.items()
+        if revision["_id"] != exported[record_id]
+    }
+    earlier = fetch_revisions(helper, set(edited_since.values()))
+    bases = {
+        record_id: (
+            earlier.get(edited_since[record_id]) if record_id in edited_since else head
+        )
+        for record_id, head in heads.items()
+    }
+    lost = [record_id for record_id, base in bases.items() if base is None]
+    if lost:
+        log.warning(f"Skipping {len(lost)} rows whose exported revision is gone")
+    if len(edited_since) > len(lost):
+        log.info(
+            f"{len(edited_since) - len(lost)} records were edited since the "
+            "export; their edits are kept"
+        )
+    table = table.loc[table.index.isin([key for key, base in bases.items() if base])]
+
+    changes = []
+    for record_type, rows in table.groupby(
+        [heads[record_id][0]["type"] for record_id in table.index]
+    ):
+        columns = form_columns(helper, record_type, rows.columns)
+        if not columns:
+            continue
+        exported_values = pandas.DataFrame.from_dict(
+            {
+                record_id: {
+                    column: render(_current_value(bases[record_id][1][field], part))
+                    for column, (field, part) in columns.items()
+                    if field in bases[record_id][1]
+                }
+                for record_id in rows.index
+            },
+            orient="index",
+        ).reindex(index=rows.index, columns=list(columns))
+        edited = rows[list(columns)]
+        # Fields the exported revision has no AVP for compare as missing
+        differs = edited.ne(exported_values) & exported_values.notna()
+        cells = differs.stack()
+        for record_id, column in cells[cells].index:
+            field, part = columns[column]
+            old = _current_value(bases[record_id][1][field], part)
+            if part == "value" and not editable(old):
+                continue
+            try:
+                new = parse(edited.at[record_id, column], old)
+            except (ValueError, SyntaxError) as e:
+                log.warning(f"Skipping {column} of {record_id}: {e}")
+                continue
+            if new == old:
+                continue
+            head_avp = heads[record_id][1].get(field)
+            current = None if head_avp is None else _current_value(head_avp, part)
+            if head_avp is not None and current == new:
+                # Already made in CouchDB
+                continue
+            changes.append(
+                {
+                    "record_id": record_id,
+                    "column": column,
+                    "field": field,
+                    "part": part,
+                    "old": old,
+                    "current": current,
+                    "new": new,
+                    "conflict": head_avp is None or current != old,
+                }
+            )
+
+    changes = pandas.DataFrame(
+        changes,
+        columns=[
+            "record_id",
+            "column",
+            "field",
+            "part",
+            "old",
+            "current",
+            "new",
+            "conflict",
+        ],
+    ).astype({"conflict": bool})
+    if changes["conflict"].any():
+        log.warning(
+            f"Not writing {changes['conflict'].sum()} cells of "
+            f"{changes.loc[changes['conflict'], 'record_id'].nunique()} records "
+            "which were also changed in CouchDB since the export"
+        )
+    updates = []
+    for record_id, record_changes in changes.loc[~changes["conflict"]].groupby(
+        "record_id", sort=False
+    ):
+        revision, avps = heads[record_id]
+        new_revision_id = f"frev-{uuid4()}"
+        new_avps = {}
+        for change in record_changes.itertuples():
+            avp = avps[change.field]
+            if change.field not in new_avps:
+                new_avps[change.field] = create_new_avp(
+                    data=avp.get("data"),
+                    revision_id=new_revision_id,
+                    record_id=record_id,
+                    annotations=dict(avp.get("annotations") or {}),
+                    type=avp["type"],
+                )
+            if change.part == "value":
+                new_avps[change.field]["data"] = change.new
+            else:
+                new_avps[change.field]["annotations"][change.part] = change.new
+        new_revision = create_new_revision(
+            avps=dict(
+                revision["avps"],
+                **{field: avp["_id"] for field, avp in new_avps.items()},
+            ),
+            record_id=record_id,
+            new_id=new_revision_id,
+            parents=[revision["_id"]],
+            created_by=created_by,
+            created=created,
+            type=revision["type"],
+        )
+        updates.append((new_revision, list(new_avps.values())))
+    return updates, changes
+
+
+def reimport(helper, path, created_by, dry_run=False, sheet_name=0):
+    """
+    Re-import the edited form table at ``path``, with the new revisions
+    created by ``created_by``.
+
+    Returns the changes (see ``plan_reimport``), with whether each was
+    written in ``ok``, unless it was a ``dry_run``. Conflicts never are.
+    """
+    updates, changes = plan_reimport(helper, load_table(path, sheet_name), created_by)
+    log.info(
+        f"{(~changes['conflict']).sum()} cells of {len(updates)} records changed "
+        f"in {path}"
+    )
+    if dry_run or not updates:
+        return changes
+    results = helper.bulk_update_records(updates)
+    counts = helper.metrics.report()["counts"]
+    if counts.get("record_head_conflicts"):
+        log.info(
+            f"{counts['record_head_conflicts']} record saves conflicted with other "
+            f"changes and were retried ({counts.get('record_head_retries', 0)} "
+            f"rounds)"
+        )
+    ok = {result["record_id"]: result["ok"] for result in results}
+    return changes.assign(
+        ok=changes["record_id"].map(ok).fillna(False).astype(bool)
+        & ~changes["conflict"]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Re-import edited form tables, writing only what changed."
+    )
+    parser.add_argument("tables", nargs="+", type=Path, help="CSV or XLSX files")
+    parser.add_argument(
+        "--server", help="CouchDB url, if not given by the bearer token"
+    )
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("FAIMS_TOKEN"),
+        help="Bearer token from the interface, or a JWT (default: $FAIMS_TOKEN)",
+    )
+    parser.add_argument("--user", help="CouchDB user, instead of a bearer token")
+    parser.add_argument(
+        "--password",
+        default=os.environ.get("FAIMS_PASSWORD"),
+        help="Password for --user (default: $FAIMS_PASSWORD)",
+    )
+    parser.add_argument("--project", required=True, metavar="KEY")
+    parser.add_argument(
+        "--by", required=True, help="Who the new revisions are created by"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="List the changes without writing"
+    )
+    parser.add_argument("--report", type=Path, help="Write the changes to this CSV")
+    args = parser.parse_args(argv)
+
+    base_url, bearer_token = args.server, None
+    if args.token:
+        token_url, bearer_token = parse_bearer_token(args.token)
+        base_url = base_url or token_url
+    if not base_url:
+        parser.error("--server is required unless the bearer token gives it")
+    helper = CouchDBHelper(
+        user=args.user,
+        token=args.password,
+        base_url=base_url,
+        project_key=args.project,
+        bearer_token=bearer_token,
+    )
+    reports = [
+        reimport(helper, table, args.by, dry_run=args.dry_run).assign(table=str(table))
+        for table in args.tables
+    ]
+    report = pandas.concat(reports, ignore_index=True)
+    if args.report:
+        report.to_csv(args.report, index=False)
+    report["conflict"] = report["conflict"].astype(bool)
+    conflicts = report.loc[report["conflict"], "record_id"].nunique()
+    if conflicts:
+        log.error(
+            f"{conflicts} records had cells changed in CouchDB since the export, "
+            "which were not written; see the conflict column of --report"
+        )
+    # Tables with nothing to write have no ok column
+    ok = report.get("ok", pandas.Series(True, index=report.index))
+    not_written = ~ok.fillna(True).astype(bool) & ~report["conflict"]
+    if not_written.any():
+        failed = report.loc[not_written, "record_id"].nunique()
+        log.error(f"{failed} records failed to update")
+        return 1
+    return 1 if conflicts else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
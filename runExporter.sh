@@ -1,4 +1,5 @@
 #!/usr/bin/env bash
 
-voila exporter.ipynb --VoilaConfiguration.file_whitelist="['.*']" \
-  --VoilaConfiguration.file_blacklist="['private.*', '.*\.(ipynb)']"
\ No newline at end of file
+# Voila, with the handler serving streamed archives (see export_stream.py)
+python export_stream.py exporter.ipynb --VoilaConfiguration.file_whitelist="['.*']" \
+  --VoilaConfiguration.file_blacklist="['private.*', '.*\.(ipynb)']"
@@ -1,3 +1,4 @@
+import os
 from pprint import pprint, pformat
 
 
@@ -10,4 +11,18 @@ def hook_function(req, notebook, cwd):
     return notebook
 
 
-c.Voila.prelaunch_hook = hook_function
+# Kernels kept ready with exporter.ipynb already run (see kernel_warmup), so
+# visitors don't wait for a kernel to start. Raise EXPORTER_KERNEL_POOL_SIZE
+# for workshops, when many people open the exporter at once; 0 starts a
+# kernel for each visitor instead.
+pool_size = int(os.environ.get("EXPORTER_KERNEL_POOL_SIZE", 2))
+c.VoilaConfiguration.preheat_kernel = pool_size > 0
+c.VoilaKernelManager.kernel_pools_config = {"default": {"pool_size": pool_size}}
+# Seconds before a kernel taken from the pool is replaced
+c.VoilaKernelManager.fill_delay = float(
+    os.environ.get("EXPORTER_KERNEL_POOL_FILL_DELAY", 0)
+)
+
+if pool_size == 0:
+    # Voila doesn't run prelaunch hooks for preheated kernels
+    c.Voila.prelaunch_hook = hook_function